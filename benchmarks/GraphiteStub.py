@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GraphiteStub:
+    # A local stand-in for the hosted Graphite /metrics endpoint. Counts the points it receives and can be told
+    # to add latency or fail requests, to simulate a slow or unavailable sink.
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.available = True
+        self.points = 0
+        self.requests = 0
+        self.received = []
+        self.keep_points = False
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if not stub.available:
+                    self._respond(503, b'{"message": "unavailable"}')
+                    return
+                points = json.loads(body)
+                with stub.lock:
+                    stub.requests += 1
+                    stub.points += len(points)
+                    if stub.keep_points:
+                        stub.received.extend(points)
+                self._respond(200, json.dumps({'published': len(points), 'errors': []}).encode())
+
+            def _respond(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}/metrics'.format(*self.server.server_address)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,167 @@
+# End-to-end load test of CourseworkClient without TTN or Graphite credentials: synthetic TTN uplinks for many
+# devices are published through the embedded MqttStub broker, and the client's Graphite writer posts to a
+# GraphiteStub. Reports throughput, latency from publish until the uplink's points are handed to the Graphite
+# writer, and peak RSS, for the threaded or asyncio runtime. Run with main.py loadgen, or
+#   python -m benchmarks.LoadGenerator --devices 1000 --messages 50000 --uplinks-per-sec 2000 --runtime asyncio
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import click
+import numpy as np
+from benchmarks.GraphiteStub import GraphiteStub
+from benchmarks.MqttStub import MqttStub
+from benchmarks.SyntheticData import ttn_uplinks
+from coursework.KitchenSensor import parse_timestamp
+
+
+def current_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def loadgen_config(broker, graphite, path, overrides=None):
+    config = {
+        'TTN_MQTT_BROKER': broker.host,
+        'TTN_MQTT_PORT': broker.port,
+        'TTN_MQTT_USER': 'loadgen',
+        'TTN_MQTT_PASS': 'loadgen',
+        'GRAPHITE_URL': graphite.url,
+        'GRAPHITE_USER': 'loadgen',
+        'GRAPHITE_API_KEY': 'loadgen',
+        'GRAPHITE_SPOOL': {'path': os.path.join(path, 'graphite_spool')},
+        'STORAGE': {'path': os.path.join(path, 'sensor_data')},
+        'RADIO': {'path': os.path.join(path, 'radio_log')},
+        'ACTIVITY_STATE': os.path.join(path, 'activity_state.bin'),
+        'DEAD_LETTERS': os.path.join(path, 'dead_letters.jsonl'),
+    }
+    config.update(overrides or {})
+    return config
+
+
+def run_load(devices, messages, rate=0, timeout=60, overrides=None, runtime='threads', graphite_latency=0.0):
+    # Publishes `messages` uplinks round-robin from `devices` devices, at `rate` uplinks/sec (0 for as fast as the
+    # client accepts them), and waits until every uplink has reached the Graphite writer or `timeout` seconds pass,
+    # then until the writer has sent every point. graphite_latency delays each POST, as a slow Graphite would.
+    if runtime == 'asyncio':
+        from coursework.AsyncCourseworkClient import AsyncCourseworkClient as CourseworkClient
+    else:
+        from coursework.CourseworkClient import CourseworkClient
+    uplinks = []
+    index = {}  # (device, sent time) -> uplink number
+    for topic, payload in ttn_uplinks(messages, devices=devices):
+        envelope = json.loads(payload)
+        index[(envelope['dev_id'], parse_timestamp(envelope['metadata']['time']))] = len(uplinks)
+        uplinks.append((topic, payload))
+    published = np.zeros(messages)
+    latencies = []
+    done = threading.Event()
+
+    with MqttStub() as broker, GraphiteStub(latency=graphite_latency) as graphite, \
+            tempfile.TemporaryDirectory() as path:
+        rss_before = current_rss()
+        client = CourseworkClient(loadgen_config(broker, graphite, path, overrides), run=False)
+        if runtime == 'asyncio':
+            relay = client.relay_to_grafana
+        else:
+            stage = next(stage for stage in client.pipeline.stages if stage.name == 'graphite')
+            relay = stage.handler
+
+        def timed_relay(payload):
+            result = relay(payload)
+            i = index.get((payload.device_id, payload.time))
+            if i is not None:
+                latencies.append(time.perf_counter() - published[i])
+                if len(latencies) == messages:
+                    done.set()
+            return result
+
+        if runtime == 'asyncio':
+            client.relay_to_grafana = timed_relay
+        else:
+            stage.handler = timed_relay
+        runner = threading.Thread(target=client.run, name='loadgen-client', daemon=True)
+        runner.start()
+        deadline = time.monotonic() + 10
+        while broker.subscriber_count() == 0:
+            if time.monotonic() > deadline:
+                raise RuntimeError('CourseworkClient did not subscribe to the MqttStub broker')
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        for i, (topic, payload) in enumerate(uplinks):
+            if rate and i % 16 == 0:
+                # Hold to the target rate, checking every few uplinks so pacing doesn't cost more than publishing
+                ahead = start + i / rate - time.perf_counter()
+                if ahead > 0:
+                    time.sleep(ahead)
+            published[i] = time.perf_counter()
+            broker.publish(topic, payload)
+        publish_elapsed = time.perf_counter() - start
+        done.wait(timeout)
+        elapsed = time.perf_counter() - start
+        deadline = time.monotonic() + timeout
+        while client.graphite.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        delivered = time.perf_counter() - start
+
+        metrics = client.metrics()
+        client.stop()
+        runner.join(timeout)
+        rss_after = current_rss()
+
+    handled = len(latencies)
+    percentiles = np.percentile(latencies, [50, 99, 100]) * 1000 if latencies else [float('nan')] * 3
+    return {
+        'runtime': runtime,
+        'devices': devices,
+        'published': messages,
+        'publish_rate': messages / publish_elapsed,
+        'handled': handled,
+        'throughput': handled / elapsed,
+        'latency_p50_ms': percentiles[0],
+        'latency_p99_ms': percentiles[1],
+        'latency_max_ms': percentiles[2],
+        'graphite_points': graphite.points,
+        'graphite_delivered_s': delivered,
+        'dead_letters': metrics['dead_letters'],
+        'stage_dropped': sum(stage['dropped'] for stage in metrics['pipeline'].values()),
+        'stage_errors': sum(stage['errors'] for stage in metrics['pipeline'].values()),
+        'rss_growth_mb': (rss_after - rss_before) / 2 ** 20,
+        'peak_rss_mb': peak_rss() / 2 ** 20,
+    }
+
+
+def report(results):
+    print('Published {published} uplinks from {devices} devices at {publish_rate:.0f}/s to the {runtime} runtime'.format(
+        **results))
+    print('Handled {handled} uplinks at {throughput:.0f} msg/s'.format(**results))
+    print('Latency publish -> Graphite writer: p50 {latency_p50_ms:.1f} ms, p99 {latency_p99_ms:.1f} ms, '
+          'max {latency_max_ms:.1f} ms'.format(**results))
+    print('Graphite received {graphite_points} points, all sent {graphite_delivered_s:.1f}s after the first uplink'.format(
+        **results))
+    print('Dead letters {dead_letters}, stage drops {stage_dropped}, '
+          'stage errors {stage_errors}'.format(**results))
+    print('RSS growth {rss_growth_mb:.1f} MiB, peak RSS {peak_rss_mb:.1f} MiB'.format(**results))
+
+
+@click.command()
+@click.option('--devices', default=1000)
+@click.option('--messages', default=50000)
+@click.option('--uplinks-per-sec', default=0.0, help='Publish rate, 0 for as fast as the client accepts them')
+@click.option('--timeout', default=60.0, help='Seconds to wait for the client to handle every uplink')
+@click.option('--runtime', default='threads', type=click.Choice(['threads', 'asyncio', 'both']))
+@click.option('--graphite-latency', default=0.0, help='Seconds the Graphite stub takes to answer each POST')
+def main(devices, messages, uplinks_per_sec, timeout, runtime, graphite_latency):
+    for name in ('threads', 'asyncio') if runtime == 'both' else (runtime,):
+        report(run_load(devices, messages, uplinks_per_sec, timeout, runtime=name, graphite_latency=graphite_latency))
+
+
+if __name__ == '__main__':
+    main()
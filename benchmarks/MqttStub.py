@@ -0,0 +1,179 @@
+import itertools
+import socket
+import socketserver
+import struct
+import threading
+
+# MQTT 3.1.1 control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type, body=b'', flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload):
+    return packet(PUBLISH, encode_string(topic) + payload)
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MqttStub:
+    # A minimal embedded MQTT 3.1.1 broker for local testing and benchmarks: CONNECT, SUBSCRIBE (with + and #
+    # wildcards and $share/<group>/ shared subscriptions), PUBLISH at QoS 0-2 and keepalive pings. Messages are
+    # delivered to subscribers at QoS 0, nothing is retained and sessions aren't persisted.
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        self.subscriptions = []  # (connection, topic filter)
+        self.shared = {}  # (group, topic filter) -> [connections]
+        self.round_robin = {}
+        self.published = 0
+        self.delivered = 0
+        stub = self
+
+        class Connection(socketserver.BaseRequestHandler):
+
+            def setup(self):
+                self.write_lock = threading.Lock()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def send(self, data):
+                with self.write_lock:
+                    try:
+                        self.request.sendall(data)
+                    except OSError:
+                        pass
+
+            def read_exact(self, length):
+                data = bytearray()
+                while len(data) < length:
+                    chunk = self.request.recv(length - len(data))
+                    if not chunk:
+                        raise ConnectionError
+                    data.extend(chunk)
+                return bytes(data)
+
+            def handle(self):
+                try:
+                    while True:
+                        header = self.read_exact(1)[0]
+                        length, multiplier = 0, 1
+                        while True:
+                            byte = self.read_exact(1)[0]
+                            length += (byte & 0x7F) * multiplier
+                            multiplier *= 128
+                            if not byte & 0x80:
+                                break
+                        body = self.read_exact(length)
+                        if not stub.handle_packet(self, header >> 4, header & 0x0F, body):
+                            return
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    stub.remove(self)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Connection)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, topic, payload):
+        self.published += 1
+        data = publish_packet(topic, payload)
+        targets = []
+        with self.lock:
+            targets.extend(connection for connection, topic_filter in self.subscriptions
+                           if topic_matches(topic_filter, topic))
+            for (group, topic_filter), connections in self.shared.items():
+                if connections and topic_matches(topic_filter, topic):
+                    counter = self.round_robin.setdefault((group, topic_filter), itertools.count())
+                    targets.append(connections[next(counter) % len(connections)])
+        for connection in targets:
+            connection.send(data)
+        self.delivered += len(targets)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscriptions) + sum(len(connections) for connections in self.shared.values())
+
+    def remove(self, connection):
+        with self.lock:
+            self.subscriptions = [(c, f) for c, f in self.subscriptions if c is not connection]
+            for connections in self.shared.values():
+                if connection in connections:
+                    connections.remove(connection)
+
+    def handle_packet(self, connection, packet_type, flags, body):
+        if packet_type == CONNECT:
+            connection.send(packet(CONNACK, b'\x00\x00'))
+        elif packet_type == SUBSCRIBE:
+            packet_id, position, granted = body[:2], 2, bytearray()
+            while position < len(body):
+                length = struct.unpack('!H', body[position:position + 2])[0]
+                topic_filter = body[position + 2:position + 2 + length].decode('utf-8')
+                granted.append(min(body[position + 2 + length], 2))
+                position += 3 + length
+                self.subscribe(connection, topic_filter)
+            connection.send(packet(SUBACK, packet_id + bytes(granted)))
+        elif packet_type == UNSUBSCRIBE:
+            connection.send(packet(UNSUBACK, body[:2]))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            length = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + length].decode('utf-8')
+            position = 2 + length
+            if qos:
+                packet_id = body[position:position + 2]
+                position += 2
+                connection.send(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+            self.publish(topic, body[position:])
+        elif packet_type == PUBREL:
+            connection.send(packet(PUBCOMP, body[:2]))
+        elif packet_type == PINGREQ:
+            connection.send(packet(PINGRESP))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def subscribe(self, connection, topic_filter):
+        with self.lock:
+            if topic_filter.startswith('$share/'):
+                _, group, topic_filter = topic_filter.split('/', 2)
+                connections = self.shared.setdefault((group, topic_filter), [])
+                if connection not in connections:
+                    connections.append(connection)
+            else:
+                self.subscriptions.append((connection, topic_filter))
@@ -0,0 +1,76 @@
+import base64
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from coursework.KitchenSensor import KitchenData
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+def kitchen_data(count, interval=120, seed=0):
+    # Uplinks every `interval` seconds, with PIR / fridge times that stay the same for runs of messages like the
+    # real sensor's do
+    rng = random.Random(seed)
+    pir_time = fridge_time = START
+    for i in range(count):
+        sent = START + timedelta(seconds=i * interval, microseconds=rng.randrange(1000000))
+        if rng.random() < 0.2:
+            pir_time = sent - timedelta(seconds=rng.randrange(interval))
+        if rng.random() < 0.05:
+            fridge_time = sent - timedelta(seconds=rng.randrange(interval))
+        spreading_factor = rng.choice((7, 7, 7, 8, 9, 10, 12))
+        yield KitchenData(sent, (sent + timedelta(milliseconds=rng.randrange(50, 500))).astimezone(),
+                          rng.randrange(-120, -40), round(rng.uniform(-10, 12), 1),
+                          'SF{}BW125'.format(spreading_factor), spreading_factor,
+                          rng.randrange(1500, 2800) / 100, rng.randrange(30, 70), rng.randrange(0, 1024),
+                          int((sent - pir_time).total_seconds()), pir_time,
+                          int((sent - fridge_time).total_seconds()), fridge_time, rng.randrange(8, 14))
+
+
+def ttn_uplinks(count, devices=1, interval=120, seed=0, gateways=8, loss=0.0):
+    # (topic, payload) pairs shaped like The Things Network v2 uplink messages, carrying SensorPayload protobufs.
+    # Each device is in range of up to three of `gateways` gateways, which each hear an uplink most of the time,
+    # further ones more weakly. A `loss` fraction of frames is never delivered, leaving gaps in the frame counters.
+    from pb import SensorPayload_pb2
+    rng = random.Random(seed)
+    gateway_ids = ['eui-b827ebfffe{:06x}'.format(rng.randrange(1 << 24)) for _ in range(gateways)]
+    in_range = [rng.sample(range(gateways), min(gateways, rng.choice((1, 2, 2, 3)))) for _ in range(devices)]
+    counters = [0] * devices
+    for i in range(count):
+        device = 'kitchen-sensor-{}'.format(i % devices)
+        while loss and rng.random() < loss:
+            counters[i % devices] += 1
+        counter = counters[i % devices]
+        counters[i % devices] += 1
+        sensor_payload = SensorPayload_pb2.SensorPayload(temperature=rng.randrange(1500, 2800),
+                                                         ldr=rng.randrange(0, 1024), humidity=rng.randrange(30, 70))
+        if rng.random() < 0.9:
+            sensor_payload.sec_since_pir = rng.randrange(0, 3600)
+        if rng.random() < 0.9:
+            sensor_payload.sec_since_fridge = rng.randrange(0, 3600)
+        sent = START + timedelta(seconds=i // devices * interval, microseconds=rng.randrange(1000000))
+        heard_by = [gateway for distance, gateway in enumerate(in_range[i % devices])
+                    if distance == 0 or rng.random() < 0.7]
+        gateway_list = [{'gtw_id': gateway_ids[gateway], 'timestamp': rng.randrange(1 << 32),
+                         'time': sent.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 'channel': rng.randrange(8),
+                         'rssi': rng.randrange(-120, -40) - 10 * distance,
+                         'snr': round(rng.uniform(-10, 12) - 3 * distance, 1), 'rf_chain': 0,
+                         'latitude': 50.93, 'longitude': -1.39} for distance, gateway in enumerate(heard_by)]
+        envelope = {
+            'app_id': 'kitchen-iot',
+            'dev_id': device,
+            'hardware_serial': '00{:014X}'.format(i % devices),
+            'port': 3,
+            'counter': counter,
+            'payload_raw': base64.b64encode(sensor_payload.SerializeToString()).decode(),
+            'metadata': {
+                'time': sent.strftime('%Y-%m-%dT%H:%M:%S.%f') + '123Z',
+                'frequency': rng.choice((868.1, 868.3, 868.5)),
+                'modulation': 'LORA',
+                'data_rate': 'SF{}BW125'.format(rng.choice((7, 7, 7, 8, 9, 10, 12))),
+                'airtime': 46336000,
+                'coding_rate': '4/5',
+                'gateways': gateway_list,
+            },
+        }
+        yield 'kitchen-iot/devices/{}/up'.format(device), json.dumps(envelope).encode()
@@ -0,0 +1,95 @@
+# Outbound Graphite volume and per-uplink cost of sending raw gauges (MetricSchema.points) against windowed
+# roll-ups (Aggregator), for a fleet of devices reporting frequently. Also checks the roll-ups against exact stats.
+#   python -m benchmarks.bench_aggregate --devices 1000 --hours 1 --interval 10
+import heapq
+import json
+import statistics
+import time
+import click
+from benchmarks.SyntheticData import kitchen_data
+from coursework.Aggregator import Aggregator, P2Quantile
+from coursework.EventStore import ActivityTracker
+from coursework.GraphiteSchema import MetricSchema
+
+
+def fleet(devices, hours, interval):
+    # Every device's uplinks, merged into arrival order
+    count = hours * 3600 // interval
+    streams = []
+    for device in range(devices):
+        stream = []
+        for payload in kitchen_data(count, interval=interval, seed=device):
+            payload.device_id = 'kitchen-sensor-{}'.format(device)
+            stream.append(payload)
+        streams.append(stream)
+    return list(heapq.merge(*streams, key=lambda payload: payload.time))
+
+
+def timed(name, payloads, serialise):
+    start = time.perf_counter()
+    points = 0
+    for payload in payloads:
+        points += len(serialise(payload))
+    elapsed = time.perf_counter() - start
+    print('{:<34} {:>10} points {:>8.2f} us/uplink'.format(name, points, elapsed / len(payloads) * 1e6))
+    return points
+
+
+def check_quantiles(values):
+    for p in (0.5, 0.95):
+        sketch = P2Quantile(p)
+        for value in values:
+            sketch.add(value)
+        exact = statistics.quantiles(values, n=100, method='inclusive')[int(p * 100) - 1]
+        print('P2 p{:.0f} over {} values: {:.2f} (exact {:.2f})'.format(p * 100, len(values), sketch.value(), exact))
+
+
+def check_window(payloads, resolution):
+    # A fleet-wide window's temperature roll-up against the exact stats of the uplinks in it
+    aggregator = Aggregator(MetricSchema(), resolution=resolution)
+    activity = ActivityTracker()
+    points = []
+    for payload in payloads:
+        points.extend(aggregator.add(payload, activity))
+    points.extend(aggregator.flush())
+    start = int(payloads[0].time.timestamp()) // resolution * resolution
+    first = {point['name']: point['value'] for point in map(json.loads, points) if point['time'] == start}
+    values = [payload.temperature for payload in payloads
+              if int(payload.time.timestamp()) // resolution * resolution == start]
+    assert first['kitcheniot.sensor.temperature.count'] == len(values)
+    assert first['kitcheniot.sensor.temperature.min'] == min(values)
+    assert first['kitcheniot.sensor.temperature.max'] == max(values)
+    assert abs(first['kitcheniot.sensor.temperature.mean'] - statistics.fmean(values)) < 1e-9
+    check_quantiles(values)
+
+
+@click.command()
+@click.option('--devices', default=1000)
+@click.option('--hours', default=1)
+@click.option('--interval', default=10, help='Seconds between each device\'s uplinks')
+@click.option('--resolution', default=600, help='Seconds per aggregation window')
+def main(devices, hours, interval, resolution):
+    payloads = fleet(devices, hours, interval)
+    print('{} uplinks from {} devices'.format(len(payloads), devices))
+    check_window(payloads, resolution)
+
+    raw = MetricSchema()
+    raw_activity = ActivityTracker()
+    raw_points = timed('raw gauges', payloads, lambda payload: raw.points(payload, raw_activity))
+
+    for name, schema, sliding_window in (('fleet roll-ups', MetricSchema(), 0),
+                                         ('fleet roll-ups + sliding 1h', MetricSchema(), 3600),
+                                         ('per-device roll-ups', MetricSchema(names={
+                                             key: 'kitcheniot.{device}.' + key for key in
+                                             ('rssi', 'snr', 'data_rate', 'payload_size', 'temperature', 'humidity',
+                                              'ldr')}), 0)):
+        aggregator = Aggregator(schema, resolution=resolution, sliding_window=sliding_window)
+        activity = ActivityTracker()
+        points = timed(name, payloads, lambda payload: aggregator.add(payload, activity))
+        points += len(aggregator.flush())
+        print('{:<34} {:>10} points, {:.0f}x fewer than raw, {} late'.format(
+            '', points, raw_points / points, aggregator.late))
+
+
+if __name__ == '__main__':
+    main()
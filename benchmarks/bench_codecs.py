@@ -0,0 +1,47 @@
+# Bytes on air, LoRa airtime and encode/decode cost of each payload codec, for the same sensor readings.
+#   python -m benchmarks.bench_codecs --messages 50000
+import time
+import click
+from benchmarks.SyntheticData import kitchen_data
+from coursework.Codecs import CODECS, CodecRegistry, SensorReading, cbor2
+from coursework.RadioStats import LORAWAN_OVERHEAD, lora_airtime
+
+
+def readings(count):
+    return [SensorReading(payload.temperature, payload.humidity, payload.ldr, payload.sec_since_pir,
+                          payload.sec_since_fridge) for payload in kitchen_data(count)]
+
+
+@click.command()
+@click.option('--messages', default=50000)
+def main(messages):
+    sample = readings(messages)
+    print('{:<10} {:>10} {:>10} {:>11} {:>11} {:>12} {:>12}'.format(
+        'codec', 'bytes', 'on air', 'SF7 ms', 'SF12 ms', 'encode us', 'decode us'))
+    for name, codec_class in CODECS.items():
+        if name == 'cbor' and cbor2 is None:
+            print('{:<10} skipped, cbor2 is not installed'.format(name))
+            continue
+        codec = codec_class()
+        registry = CodecRegistry()
+        registry.register(3, codec)
+
+        start = time.perf_counter()
+        encoded = [codec.encode(reading) for reading in sample]
+        encode_time = (time.perf_counter() - start) / messages
+
+        # Decoded through the registry, as parse_message does
+        start = time.perf_counter()
+        decoded = [registry.decode('kitchen-sensor', 3, data) for data in encoded]
+        decode_time = (time.perf_counter() - start) / messages
+        assert decoded == sample, name
+
+        size = sum(map(len, encoded)) / messages
+        on_air = size + LORAWAN_OVERHEAD
+        print('{:<10} {:>10.1f} {:>10.1f} {:>11.1f} {:>11.1f} {:>12.2f} {:>12.2f}'.format(
+            name, size, on_air, lora_airtime(round(on_air), 7) * 1000, lora_airtime(round(on_air), 12) * 1000,
+            encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Decode throughput of KitchenSensorParser.parse_message over a corpus of TTN uplinks, against the original
+# decoder (json + dateutil + descriptor introspection + prints).
+#   python -m benchmarks.bench_decode --messages 20000
+#   python -m benchmarks.bench_decode --corpus recorded_uplinks.jsonl   (one TTN uplink JSON document per line)
+import base64
+import contextlib
+import io
+import json
+import time
+from datetime import datetime, timedelta
+import click
+from dateutil import parser
+from benchmarks.SyntheticData import ttn_uplinks
+from coursework import KitchenSensor
+from coursework.KitchenSensor import KitchenSensorParser, KitchenData
+from coursework.Pipeline import RawMessage
+from pb import SensorPayload_pb2
+
+
+def legacy_parse_message(message, received_time):
+    payload_dict = json.loads(message.payload)
+    time = parser.parse(payload_dict['metadata']['time'])
+    rssi = payload_dict['metadata']['gateways'][0]['rssi']
+    snr = payload_dict['metadata']['gateways'][0]['snr']
+    data_rate_raw = payload_dict['metadata']['data_rate']
+    data_rate = int(''.join(filter(str.isdigit, data_rate_raw)))
+    payload_hex = base64.b64decode(payload_dict['payload_raw'])
+    sensor_payload = SensorPayload_pb2.SensorPayload()
+    sensor_payload.ParseFromString(payload_hex)
+    payload_fields = set([field.name for field in sensor_payload._fields])
+    sec_since_pir = PIR_triggered_time = sec_since_fridge = fridge_opened_time = None
+    if 'sec_since_pir' in payload_fields:
+        print(str(sensor_payload.sec_since_pir) + " seconds since last PIR activity")
+        sec_since_pir = sensor_payload.sec_since_pir
+        PIR_triggered_time = time - timedelta(seconds=sensor_payload.sec_since_pir)
+        print("So, the PIR was triggered at:", PIR_triggered_time)
+    if 'sec_since_fridge' in payload_fields:
+        print(str(sensor_payload.sec_since_fridge) + " seconds since the fridge was opened")
+        sec_since_fridge = sensor_payload.sec_since_fridge
+        fridge_opened_time = time - timedelta(seconds=sensor_payload.sec_since_fridge)
+        print("So, the fridge was opened at:", fridge_opened_time)
+    return KitchenData(time, received_time, rssi, snr, data_rate_raw, data_rate, sensor_payload.temperature / 100,
+                       sensor_payload.humidity, sensor_payload.ldr, sec_since_pir, PIR_triggered_time,
+                       sec_since_fridge, fridge_opened_time, len(payload_hex))
+
+
+def load_corpus(corpus):
+    with open(corpus, 'rb') as corpus_file:
+        for line in corpus_file:
+            if line.strip():
+                uplink = json.loads(line)
+                yield '{}/devices/{}/up'.format(uplink['app_id'], uplink['dev_id']), line.strip()
+
+
+def timed(name, messages, decode):
+    received_time = datetime.now().astimezone()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for message in messages:
+            decode(message, received_time)
+    print('{:<36} {:>10.0f} messages/sec'.format(name, len(messages) / (time.perf_counter() - start)))
+
+
+@click.command()
+@click.option('--messages', default=20000, help='Number of synthetic uplinks, when no corpus is given')
+@click.option('--corpus', type=click.Path(exists=True), help='File of recorded TTN uplinks, one JSON per line')
+def main(messages, corpus):
+    uplinks = load_corpus(corpus) if corpus else ttn_uplinks(messages, devices=50)
+    messages = [RawMessage(topic, payload, None) for topic, payload in uplinks]
+    timed('original parse_message', messages, legacy_parse_message)
+    timed('parse_message ({})'.format(KitchenSensor.json_loads.__module__), messages,
+          KitchenSensorParser.parse_message)
+    KitchenSensor.json_loads, orjson_loads = json.loads, KitchenSensor.json_loads
+    timed('parse_message (json)', messages, KitchenSensorParser.parse_message)
+    KitchenSensor.json_loads = orjson_loads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Compares the old one-POST-per-uplink relay against the batched, pooled GraphiteWriter.
+#   python -m benchmarks.bench_graphite --messages 2000
+import json
+import time
+import click
+import requests
+from benchmarks.GraphiteStub import GraphiteStub
+from coursework.GraphiteWriter import GraphiteWriter
+
+POINTS_PER_MESSAGE = 9
+
+
+def message_points(i):
+    return [{"name": "kitcheniot.bench.{}".format(n), "value": i, "interval": 120, "unit": "", "time": 1600000000 + i,
+             "mtype": "gauge"} for n in range(POINTS_PER_MESSAGE)]
+
+
+def serialised_points(i):
+    return [json.dumps(point) for point in message_points(i)]
+
+
+def bench_per_message(url, messages):
+    start = time.perf_counter()
+    for i in range(messages):
+        result = requests.post(url, auth=('user', 'key'), json=message_points(i))
+        if result.status_code != 200:
+            raise Exception(result.text)
+    return time.perf_counter() - start
+
+
+def bench_batched(url, messages, max_points, flush_interval_ms):
+    writer = GraphiteWriter(url, 'user', 'key', max_points=max_points, flush_interval_ms=flush_interval_ms)
+    start = time.perf_counter()
+    for i in range(messages):
+        writer.write(serialised_points(i))
+    writer.close()
+    return time.perf_counter() - start, writer.metrics()
+
+
+@click.command()
+@click.option('--messages', default=2000, help='Number of uplinks to relay')
+@click.option('--latency', default=0.0, help='Seconds of simulated server latency per request')
+@click.option('--max-points', default=500)
+@click.option('--flush-interval-ms', default=1000)
+def main(messages, latency, max_points, flush_interval_ms):
+    points = messages * POINTS_PER_MESSAGE
+    with GraphiteStub(latency=latency) as stub:
+        elapsed = bench_per_message(stub.url, messages)
+        print('requests.post per message: {:>10.0f} points/sec ({} requests)'.format(points / elapsed, stub.requests))
+
+    with GraphiteStub(latency=latency) as stub:
+        elapsed, metrics = bench_batched(stub.url, messages, max_points, flush_interval_ms)
+        print('GraphiteWriter batched:    {:>10.0f} points/sec ({} requests)'.format(points / elapsed, stub.requests))
+        assert stub.points == points, metrics
+
+
+if __name__ == '__main__':
+    main()
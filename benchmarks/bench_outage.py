@@ -0,0 +1,100 @@
+# Graphite outage and recovery through the write-ahead Spool: points are written while the sink is down, the
+# writer is then killed mid-write (leaving a torn record), and a new writer drains the spool once the sink is back.
+# Checks every point arrives exactly once, memory stays flat during the outage, and sent segments are compacted
+# away, and exits non-zero if not.
+#   python -m benchmarks.bench_outage --messages 50000
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+import click
+from benchmarks.GraphiteStub import GraphiteStub
+from benchmarks.bench_graphite import POINTS_PER_MESSAGE, message_points, serialised_points
+from coursework.GraphiteWriter import GraphiteWriter
+from coursework.Spool import Spool
+
+
+def writer(url, spool_dir, segment_kb):
+    return GraphiteWriter(url, 'user', 'key', max_points=500, flush_interval_ms=100, max_backoff=1,
+                          spool=Spool(spool_dir, segment_bytes=segment_kb * 1024))
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+
+
+@click.command()
+@click.option('--messages', default=50000, help='Uplinks relayed while Graphite is down')
+@click.option('--segment-kb', default=1024)
+@click.option('--max-memory-mb', default=64.0, help='Peak Python memory allowed while spooling the outage')
+@click.option('--timeout', default=120.0, help='Seconds allowed to drain the spool once Graphite is back')
+def main(messages, segment_kb, max_memory_mb, timeout):
+    # Exits non-zero if any point is lost or sent twice, memory grows with the outage, or the spool isn't compacted
+    points = messages * POINTS_PER_MESSAGE
+    failures = []
+    with GraphiteStub() as stub, tempfile.TemporaryDirectory() as spool_dir:
+        stub.available = False
+        stub.keep_points = True
+        outage = writer(stub.url, spool_dir, segment_kb)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(messages):
+            outage.write(serialised_points(i))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        spooled = outage.metrics()['spool']
+        print('Outage: spooled {} points at {:.0f} points/sec, {} segments, {:.1f} MB on disk, '
+              'peak Python memory {:.1f} MB'.format(spooled['pending'], points / elapsed, spooled['segments'],
+                                                     spooled['bytes'] / 1e6, peak / 1e6))
+        check(failures, stub.points == 0, '{} points were accepted during the outage'.format(stub.points))
+        check(failures, spooled['pending'] == points,
+              '{} points spooled, expected {}'.format(spooled['pending'], points))
+        check(failures, peak <= max_memory_mb * 1e6,
+              'peak Python memory {:.1f} MB during the outage, over {} MB'.format(peak / 1e6, max_memory_mb))
+
+        # Kill the writer without closing it, as if the process died part way through appending a record
+        outage.spool.file.write(b'\x40\x00\x00\x00torn')
+        outage.spool.file.flush()
+        outage.spool = None
+        outage.close()
+
+        stub.available = True
+        recovered = writer(stub.url, spool_dir, segment_kb)
+        print('Recovered spool: {} pending points, {} corrupt tail truncated'.format(
+            recovered.pending(), recovered.spool.corrupt))
+        check(failures, recovered.spool.corrupt == 1,
+              '{} torn records truncated, expected 1'.format(recovered.spool.corrupt))
+        start = time.perf_counter()
+        while recovered.pending() and time.perf_counter() - start < timeout:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        check(failures, not recovered.pending(),
+              '{} points still pending after {}s'.format(recovered.pending(), timeout))
+        recovered.close()
+        print('Drained {} points in {:.2f}s ({:.0f} points/sec, {} requests)'.format(
+            stub.points, elapsed, stub.points / elapsed, stub.requests))
+        files = sorted(name for name in os.listdir(spool_dir) if name.endswith('.wal'))
+        print('Segments left after compaction:', files)
+
+        # Every point once: each message's points share its time, and are named per point
+        received = Counter((point['name'], point['time']) for point in stub.received)
+        expected = {(point['name'], point['time']) for i in range(messages) for point in message_points(i)}
+        lost = len(expected - set(received))
+        duplicated = sum(count - 1 for count in received.values() if count > 1)
+        unexpected = len(set(received) - expected)
+        check(failures, not lost, '{} points lost'.format(lost))
+        check(failures, not duplicated, '{} points sent more than once'.format(duplicated))
+        check(failures, not unexpected, '{} points received that were never written'.format(unexpected))
+        check(failures, len(files) == 1 and recovered.spool.size() == 0,
+              'spool not compacted: {} segments, {} bytes left'.format(len(files), recovered.spool.size()))
+
+    if failures:
+        raise click.ClickException('outage check failed: ' + '; '.join(failures))
+    print('OK: every point delivered once, spool compacted')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# SensorQuery against full scans of a large synthetic SensorStore: range scans, last-N and aggregates only read
+# the records they need, so they should stay fast as the history grows.
+#   python -m benchmarks.bench_query --rows 5000000 --devices 200
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+import click
+import numpy as np
+from benchmarks.SyntheticData import START
+from coursework.KitchenTable import KitchenTable, RECORD_DTYPE
+from coursework.SensorQuery import SensorQuery
+from coursework.SensorStore import SensorStore, FORMAT_VERSION, RECORD, to_epoch_us
+
+MINUTE_US = 60 * 1000000
+
+
+def build_store(path, rows, devices, interval, chunk_records):
+    # Writes chunk files and index.json directly, as appending millions of uplinks one by one takes minutes
+    os.makedirs(path)
+    rng = np.random.default_rng(0)
+    start_us = to_epoch_us(START)
+    chunks = []
+    for number, first in enumerate(range(0, rows, chunk_records)):
+        i = np.arange(first, min(first + chunk_records, rows))
+        records = np.zeros(len(i), dtype=RECORD_DTYPE)
+        device = i % devices
+        records['time'] = start_us + i * (interval * 1000000 // devices) + rng.integers(0, 1000000, len(i))
+        records['received_time'] = records['time'] + 200000
+        # Fridge opened every 90 minutes and PIR triggered every 20, at different times on each device
+        records['fridge_opened_time'] = records['time'] - (records['time'] + device * 7 * MINUTE_US) % (90 * MINUTE_US)
+        records['PIR_triggered_time'] = records['time'] - (records['time'] + device * 3 * MINUTE_US) % (20 * MINUTE_US)
+        records['sec_since_fridge'] = (records['time'] - records['fridge_opened_time']) // 1000000
+        records['sec_since_pir'] = (records['time'] - records['PIR_triggered_time']) // 1000000
+        records['temperature'] = rng.uniform(15, 28, len(i))
+        records['snr'] = rng.uniform(-10, 12, len(i))
+        records['rssi'] = rng.integers(-120, -40, len(i))
+        records['humidity'] = rng.integers(30, 70, len(i))
+        records['ldr'] = rng.integers(0, 1024, len(i))
+        records['payload_size'] = 11
+        records['spreading_factor'] = 7
+        records['bandwidth'] = 125
+        records['device'] = device + 1
+        name = 'chunk-{:06d}.bin'.format(number)
+        records.tofile(os.path.join(path, name))
+        chunks.append({'file': name, 'count': len(records), 'min_time': int(records['time'].min()),
+                       'max_time': int(records['time'].max())})
+    with open(os.path.join(path, 'index.json'), 'w') as index_file:
+        json.dump({'version': FORMAT_VERSION, 'record_size': RECORD.size, 'chunks': chunks,
+                   'devices': [None] + ['kitchen-sensor-{}'.format(d) for d in range(devices)]}, index_file)
+    return records['time'].max()
+
+
+def timed(name, query):
+    start = time.perf_counter()
+    result = query()
+    elapsed = time.perf_counter() - start
+    print('  {:<44} {:>10.2f} ms  ({} results)'.format(name, elapsed * 1000, len(result)))
+    return result
+
+
+def scan_range(store, start, end, device):
+    # The full-scan equivalent: every record of the overlapping chunks, filtered with numpy
+    table = KitchenTable.from_store(store, start, end)
+    return table[table['device'] == store.device_index[device]]
+
+
+@click.command()
+@click.option('--rows', default=5000000)
+@click.option('--devices', default=200)
+@click.option('--interval', default=120, help='Seconds between each device\'s uplinks')
+@click.option('--chunk-records', default=65536)
+def main(rows, devices, interval, chunk_records):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'store')
+        start = time.perf_counter()
+        build_store(path, rows, devices, interval, chunk_records)
+        store = SensorStore(path, read_only=True)
+        days = rows // devices * interval / 86400
+        print('{} rows, {} devices, {:.0f} days, {} chunks, built in {:.1f}s'.format(
+            rows, devices, days, len(store.chunks), time.perf_counter() - start))
+        device = 'kitchen-sensor-7'
+        day_start = START + timedelta(days=days // 2)
+        day_end = day_start + timedelta(days=1)
+        week_end = day_start + timedelta(days=7)
+
+        print('Full scans:')
+        timed('one device, one day (KitchenTable.from_store)', lambda: scan_range(store, day_start, day_end, device))
+        timed('one device, whole history', lambda: scan_range(store, None, None, device))
+        timed('one device, last 100 (whole history)', lambda: scan_range(store, None, None, device)[-100:])
+        timed('one device, one day (SensorStore.scan)',
+              lambda: [p for p in store.scan(day_start, day_end) if p.device_id == device])
+
+        for run in ('cold, building indexes', 'warm, saved indexes'):
+            history = SensorQuery(store)
+            print('SensorQuery ({}):'.format(run))
+            timed('one device, one day', lambda: history.range(day_start, day_end, device))
+            timed('all devices, one day', lambda: history.range(day_start, day_end))
+            timed('one device, last 100', lambda: history.last(100, device))
+            timed('all devices, last 1000', lambda: history.last(1000))
+            timed('one device, mean temperature per hour, 1 week',
+                  lambda: history.aggregate('temperature', 'hour', 'mean', day_start, week_end, device))
+            timed('one device, fridge openings per day, 1 week',
+                  lambda: history.events('fridge', 'day', day_start, week_end, device))
+            timed('all devices, fridge openings per day, history',
+                  lambda: history.events('fridge', 'day'))
+
+        # The indexed range must match the scan
+        expected = scan_range(store, day_start, day_end, device)
+        actual = history.range(day_start, day_end, device)
+        assert np.array_equal(np.sort(expected['time']), actual['time'])
+        last = history.last(100, device)
+        assert np.array_equal(last['time'], np.sort(scan_range(store, None, None, device)['time'])[-100:])
+        openings = history.events('fridge', 'day', day_start, day_start + timedelta(days=1), device)
+        print('Fridge openings on {}: {}'.format(day_start.date(), openings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Cost of the RadioLog: per-uplink append (with the running stats), disk use per gateway reception, rebuilding the
+# stats when reopened, and the device/gateway tables, plus how closely the frame-counter loss matches the loss the
+# synthetic uplinks were generated with.
+#   python -m benchmarks.bench_radio --messages 200000 --devices 2000 --loss 0.03
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+import click
+from benchmarks.SyntheticData import ttn_uplinks
+from coursework.KitchenSensor import KitchenSensorParser
+from coursework.Pipeline import RawMessage
+from coursework.RadioStats import RadioLog
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+@click.command()
+@click.option('--messages', default=200000)
+@click.option('--devices', default=2000)
+@click.option('--gateways', default=40)
+@click.option('--loss', default=0.03, help='Fraction of frames the synthetic devices lose')
+def main(messages, devices, gateways, loss):
+    received_time = datetime.now(timezone.utc)
+    messages_in = [RawMessage(topic, payload, received_time)
+                   for topic, payload in ttn_uplinks(messages, devices=devices, gateways=gateways, loss=loss)]
+    start = time.perf_counter()
+    payloads = [KitchenSensorParser.parse_message(message, received_time) for message in messages_in]
+    print('{:<36} {:>10.2f} us/uplink'.format('parse_message (all gateways)',
+                                            (time.perf_counter() - start) / messages * 1e6))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'radio_log')
+        log = RadioLog(path)
+        start = time.perf_counter()
+        for payload in payloads:
+            log.append(payload)
+        log.close()
+        print('{:<36} {:>10.2f} us/uplink'.format('RadioLog.append', (time.perf_counter() - start) / messages * 1e6))
+        print('{:<36} {:>10.1f} bytes/reception ({} receptions)'.format('on disk', directory_size(path) / len(log),
+                                                                      len(log)))
+
+        start = time.perf_counter()
+        stats = RadioLog(path, read_only=True).query()
+        print('{:<36} {:>10.1f} ms'.format('reopen and rebuild stats', (time.perf_counter() - start) * 1000))
+        start = time.perf_counter()
+        device_rows = stats.device_table()
+        gateway_rows = stats.gateway_table()
+        print('{:<36} {:>10.1f} ms ({} devices, {} gateways)'.format(
+            'device and gateway tables', (time.perf_counter() - start) * 1000, len(device_rows), len(gateway_rows)))
+
+        totals = stats.totals()
+        print('{:<36} {:>10.4f} (generated with {})'.format(
+            'measured frame loss', totals['lost'] / (totals['uplinks'] + totals['lost']), loss))
+
+
+if __name__ == '__main__':
+    main()
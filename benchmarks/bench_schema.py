@@ -0,0 +1,57 @@
+# Per-message cost of turning a KitchenData into Graphite points: the old approach of building dicts for every
+# uplink and JSON-encoding them, against MetricSchema's pre-rendered templates.
+#   python -m benchmarks.bench_schema --messages 50000
+import json
+import time
+import click
+from benchmarks.SyntheticData import kitchen_data
+from coursework.EventStore import ActivityTracker
+from coursework.GraphiteSchema import MetricSchema, round_minute
+
+GAUGES = [('kitcheniot.meta.rssi', 'rssi', 'rssi'), ('kitcheniot.meta.snr', 'dB', 'snr'),
+          ('kitcheniot.meta.data_rate', '', 'data_rate'), ('kitcheniot.meta.payload_size', 'b', 'payload_size'),
+          ('kitcheniot.sensor.temperature', '°C', 'temperature'), ('kitcheniot.sensor.humidity', '%', 'humidity'),
+          ('kitcheniot.sensor.ldr', '', 'ldr')]
+
+
+def legacy_graphite_json(payload, activity):
+    # Equivalent of the original relay_to_grafana: fresh dicts, bins and timestamp() calls per uplink
+    interval = 120
+    graphite_data = [{"name": name, "value": getattr(payload, field), "interval": interval, "unit": unit,
+                      "time": int(payload.time.timestamp()), "mtype": "gauge"} for name, unit, field in GAUGES]
+    hist_bins = ['{:02d}{:02d}'.format(h, m) for h in range(24) for m in (0, 30)]
+    fridge = round_minute(int(payload.fridge_opened_time.timestamp()))
+    pir = round_minute(int(payload.PIR_triggered_time.timestamp()))
+    fridge_new, pir_new = activity.update(payload.device_id, fridge, pir)
+    for kind, new, event_time in (('fridge', fridge_new, fridge), ('pir', pir_new, pir)):
+        if new:
+            index = event_time // 60 % 1440 // 30
+            for name in ('kitcheniot.activity.' + kind, 'kitcheniot.activity.{}.{}'.format(kind, hist_bins[index])):
+                graphite_data.append({"name": name, "value": 1, "interval": interval, "unit": "", "time": event_time,
+                                      "mtype": "gauge"})
+    return json.dumps(graphite_data)
+
+
+def timed(name, payloads, serialise):
+    activity = ActivityTracker()
+    start = time.perf_counter()
+    for payload in payloads:
+        serialise(payload, activity)
+    elapsed = time.perf_counter() - start
+    print('{:<28} {:>8.2f} us/message'.format(name, elapsed / len(payloads) * 1e6))
+
+
+@click.command()
+@click.option('--messages', default=50000)
+def main(messages):
+    payloads = list(kitchen_data(messages))
+    schema = MetricSchema()
+    timed('legacy dicts + json.dumps', payloads, legacy_graphite_json)
+    timed('MetricSchema.to_json', payloads, schema.to_json)
+    timed('MetricSchema.points', payloads, schema.points)
+    timed('MetricSchema.to_plaintext', payloads, schema.to_plaintext)
+    timed('MetricSchema.to_pickle', payloads, schema.to_pickle)
+
+
+if __name__ == '__main__':
+    main()
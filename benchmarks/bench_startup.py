@@ -0,0 +1,72 @@
+# Startup cost of the CLI: wall time of `main.py --help`, against importing everything main.py used to import up
+# front, the slowest imports of a cold `coursework` start (python -X importtime), and the config loaders.
+#   python -m benchmarks.bench_startup --runs 20
+import os
+import statistics
+import subprocess
+import sys
+import time
+import click
+import yaml
+from coursework.Config import CONFIG_PATH, load_config
+
+
+def wall_time(command, runs):
+    # Median seconds for a fresh interpreter to run `command`
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(statement, count):
+    # (cumulative microseconds, module) of the imports that statement pulls in and their direct imports, slowest first
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], check=True, text=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented by two spaces per level
+        if len(name) - len(name.lstrip()) <= 3:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def per_call(function, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs
+
+
+@click.command()
+@click.option('--runs', default=20, help='Interpreter starts per measurement')
+def main(runs):
+    python = sys.executable
+    baseline = wall_time([python, '-c', 'pass'], runs)
+    print('{:<52} {:>8.1f} ms'.format('python -c pass', baseline * 1000))
+    print('{:<52} {:>8.1f} ms'.format('main.py --help', wall_time([python, 'main.py', '--help'], runs) * 1000))
+    print('{:<52} {:>8.1f} ms'.format('eager imports (labs.Lab2, coursework.CourseworkClient)', wall_time(
+        [python, '-c', 'import click, dateutil.parser, labs.Lab2, coursework.CourseworkClient'], runs) * 1000))
+
+    print('\nSlowest imports of the coursework command, and of what they import:')
+    for cumulative, name in slowest_imports('import main, coursework.Config, coursework.CourseworkClient', 12):
+        print('  {:<50} {:>8.1f} ms'.format(name, cumulative / 1000))
+
+    print('\nLoading {}:'.format(os.path.relpath(CONFIG_PATH)))
+    with open(CONFIG_PATH) as configuration:
+        text = configuration.read()
+    for name, loader in (('yaml FullLoader', yaml.FullLoader), ('yaml SafeLoader', yaml.SafeLoader),
+                         ('yaml CSafeLoader', getattr(yaml, 'CSafeLoader', None))):
+        if loader is None:
+            print('  {:<50} skipped, PyYAML was built without libyaml'.format(name))
+            continue
+        print('  {:<50} {:>8.3f} ms'.format(name, per_call(lambda: yaml.load(text, Loader=loader), 50) * 1000))
+    load_config()
+    print('  {:<50} {:>8.3f} ms'.format('load_config (cached, validated)', per_call(load_config, 200) * 1000))
+
+
+if __name__ == '__main__':
+    main()
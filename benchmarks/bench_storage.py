@@ -0,0 +1,60 @@
+# Compares write and scan throughput of the per-message CSV (log_to_csv / parse_csv_row) against SensorStore.
+#   python -m benchmarks.bench_storage --rows 20000
+import csv
+import os
+import tempfile
+import time
+import click
+from benchmarks.SyntheticData import kitchen_data
+from coursework.CourseworkClient import log_to_csv
+from coursework.KitchenSensor import KitchenSensorParser
+from coursework.SensorStore import SensorStore
+
+
+def report(name, rows, elapsed):
+    print('{:<28} {:>10.0f} rows/sec'.format(name, rows / elapsed))
+
+
+@click.command()
+@click.option('--rows', default=20000)
+def main(rows):
+    payloads = list(kitchen_data(rows))
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'sensor_data.csv')
+        start = time.perf_counter()
+        for payload in payloads:
+            log_to_csv(payload, csv_path)
+        report('log_to_csv write', rows, time.perf_counter() - start)
+
+        store = SensorStore(os.path.join(tmp, 'store'), chunk_records=8192)
+        start = time.perf_counter()
+        for payload in payloads:
+            store.append(payload)
+        store.sync()
+        report('SensorStore write', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with open(csv_path, 'r', encoding='utf-8') as past_data:
+            reader = csv.reader(past_data)
+            next(reader)
+            scanned = sum(1 for row in reader if KitchenSensorParser.parse_csv_row(row))
+        report('CSV scan + parse_csv_row', scanned, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        scanned = sum(1 for _ in store.scan())
+        report('SensorStore scan', scanned, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        scanned = sum(1 for _ in store.records())
+        report('SensorStore raw records', scanned, time.perf_counter() - start)
+
+        window_start, window_end = payloads[rows // 2].time, payloads[rows // 2 + 100].time
+        start = time.perf_counter()
+        scanned = sum(1 for _ in store.scan(window_start, window_end))
+        print('{:<28} {:>10.2f} ms for {} rows'.format('SensorStore window scan', (time.perf_counter() - start) * 1000,
+                                                      scanned))
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Load time and retained memory of per-row KitchenData objects versus the columnar KitchenTable.
+#   python -m benchmarks.bench_table --rows 100000
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+import click
+from benchmarks.SyntheticData import kitchen_data
+from coursework.CourseworkClient import log_to_csv
+from coursework.KitchenSensor import KitchenSensorParser
+from coursework.KitchenTable import KitchenTable
+from coursework.SensorStore import SensorStore
+
+
+def load_rows(csv_path):
+    with open(csv_path, 'r', encoding='utf-8') as past_data:
+        reader = csv.reader(past_data)
+        next(reader)
+        return [KitchenSensorParser.parse_csv_row(row) for row in reader]
+
+
+def measure(name, rows, load):
+    # Timed and traced separately, as tracemalloc slows numpy's allocations down far more than Python objects'
+    start = time.perf_counter()
+    load()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = load()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('{:<32} {:>10.0f} rows/sec {:>10.1f} MiB retained'.format(name, rows / elapsed, retained / 2 ** 20))
+    return result
+
+
+@click.command()
+@click.option('--rows', default=100000)
+def main(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'sensor_data.csv')
+        store = SensorStore(os.path.join(tmp, 'store'))
+        for payload in kitchen_data(rows):
+            log_to_csv(payload, csv_path)
+            store.append(payload)
+        store.sync()
+
+        measure('CSV -> [KitchenData]', rows, lambda: load_rows(csv_path))
+        table = measure('CSV -> KitchenTable', rows, lambda: KitchenTable.from_csv(csv_path))
+        measure('SensorStore -> KitchenTable', rows, lambda: KitchenTable.from_store(store))
+        print('KitchenTable column bytes: {:.1f} MiB'.format(table.nbytes() / 2 ** 20))
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Rows/sec for each timestamp parsing path used by KitchenSensorParser.
+#   python -m benchmarks.bench_timestamps --rows 20000
+import csv
+import io
+import time
+import click
+from dateutil import parser
+from benchmarks.SyntheticData import kitchen_data
+from coursework import KitchenSensor
+from coursework.KitchenSensor import KitchenSensorParser, parse_timestamp, parse_repeated_timestamp
+
+
+def csv_rows(count):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    for payload in kitchen_data(count):
+        writer.writerow([payload.time, payload.received_time, payload.rssi, payload.snr, payload.data_rate_raw,
+                         payload.temperature, payload.humidity, payload.ldr, payload.sec_since_pir,
+                         payload.PIR_triggered_time, payload.sec_since_fridge, payload.fridge_opened_time,
+                         payload.payload_size])
+    return list(csv.reader(io.StringIO(output.getvalue())))
+
+
+def timed(name, count, function, unit='rows'):
+    start = time.perf_counter()
+    function()
+    print('{:<36} {:>10.0f} {}/sec'.format(name, count / (time.perf_counter() - start), unit))
+
+
+@click.command()
+@click.option('--rows', default=20000)
+def main(rows):
+    data = csv_rows(rows)
+
+    def timestamps(parse):
+        for row in data:
+            parse(row[0]), parse(row[1]), parse(row[9]), parse(row[11])
+
+    timed('dateutil.parser.parse (4 per row)', rows, lambda: timestamps(parser.parse))
+    timed('parse_timestamp (4 per row)', rows, lambda: timestamps(parse_timestamp))
+    parse_repeated_timestamp.cache_clear()
+    timed('parse_csv_row (memoized PIR/fridge)', rows, lambda: [KitchenSensorParser.parse_csv_row(row) for row in data])
+    print('    memo cache:', parse_repeated_timestamp.cache_info())
+
+    # TTN metadata layout, with nanosecond precision
+    ttn_times = [row[0].replace(' ', 'T').replace('+00:00', '') + '123Z' for row in data]
+    timed('TTN time: dateutil', rows, lambda: [parser.parse(text) for text in ttn_times], 'timestamps')
+    timed('TTN time: parse_timestamp', rows, lambda: [parse_timestamp(text) for text in ttn_times], 'timestamps')
+    timed('TTN time: ISO_TIME regex (pre-3.11)', rows,
+          lambda: [KitchenSensor.ISO_TIME.match(text).groups() for text in ttn_times], 'timestamps')
+
+
+if __name__ == '__main__':
+    main()
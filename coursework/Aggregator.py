@@ -0,0 +1,296 @@
+import threading
+from collections import deque
+from coursework.EventStore import PendingEvents
+from coursework.GraphiteSchema import GAUGES, MetricSchema
+from coursework.KitchenSensor import KitchenData
+
+STATS = ('min', 'max', 'mean', 'count', 'p50', 'p95')
+# Stats that can be combined across the panes of a sliding window (the quantile sketches can't be merged)
+SLIDING_STATS = ('min', 'max', 'mean', 'count')
+
+
+class P2Quantile:
+    # Streaming quantile estimate in constant memory, using the P-square algorithm (Jain & Chlamtac, 1985):
+    # five markers track the minimum, p/2, p, (1+p)/2 quantiles and maximum, adjusted with a parabolic fit.
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(x)
+            heights.sort()
+            return
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def value(self):
+        if len(self.heights) < 5:
+            # Too few values for the markers yet, so use the exact quantile
+            return self.heights[min(int(self.p * len(self.heights)), len(self.heights) - 1)] if self.heights else None
+        return self.heights[2]
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+
+class Summary:
+    # Running stats of one metric over one window
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'quantiles')
+
+    def __init__(self, quantiles):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        for quantile in self.quantiles:
+            quantile.add(value)
+
+
+class Window:
+    # The open tumbling window of one series group (a device, or all devices), with one Summary per gauge
+    __slots__ = ('start', 'summaries')
+
+    def __init__(self, start, gauges, quantiles):
+        self.start = start
+        self.summaries = [Summary(quantiles) for _ in range(gauges)]
+
+
+class ActivityRing:
+    # Fridge or PIR events counted per time-of-day histogram bin: a fixed ring of one slot per bin, each holding
+    # the start of the bin it is counting (epoch seconds) and its count. A slot is reused, and reset, when an
+    # event falls in the same bin on a later day. Changed slots are emitted when the group's window closes.
+    __slots__ = ('starts', 'counts', 'changed')
+
+    def __init__(self, bins):
+        self.starts = [0] * bins
+        self.counts = [0] * bins
+        self.changed = set()
+
+    def add(self, bin_index, bin_start):
+        if bin_start > self.starts[bin_index]:
+            self.starts[bin_index] = bin_start
+            self.counts[bin_index] = 0
+        elif bin_start < self.starts[bin_index]:
+            return False  # Older than the day this bin is counting
+        self.counts[bin_index] += 1
+        self.changed.add(bin_index)
+        return True
+
+
+class Aggregator:
+    # Rolls uplinks up into windows before they are sent to Graphite. Each gauge is summarised per tumbling window
+    # of `resolution` seconds (min/max/mean/count and streaming p50/p95), and optionally over a sliding window of
+    # the last `sliding_window` seconds, emitted as <gauge name>.<stat> and <gauge name>.sliding.<stat>.
+    # Series are grouped per device if the schema's names contain {device}, otherwise across all devices.
+    # Activity events become counts per histogram bin, sent as activity.<kind> and activity.<kind>.<bin> at the
+    # start of the bin, instead of a point per event.
+    # A window is closed by a later uplink of its group, or once uplinks from any group are `lateness` seconds past
+    # its end. Uplinks for an already closed window are counted as late and not aggregated.
+    # Events are only recorded as sent in the activity store once the counts they are in have been emitted.
+
+    def __init__(self, schema: MetricSchema, resolution=600, sliding_window=0, stats=STATS, lateness=120):
+        unknown = set(stats) - set(STATS)
+        if unknown:
+            raise ValueError('Unknown aggregation stats {}, expected some of {}'.format(sorted(unknown), STATS))
+        if sliding_window % resolution:
+            raise ValueError('sliding_window must be a multiple of resolution, got {}'.format(sliding_window))
+        self.schema = schema
+        self.resolution = resolution
+        self.panes = sliding_window // resolution
+        self.stats = [stat for stat in STATS if stat in stats]
+        self.sliding_stats = [stat for stat in SLIDING_STATS if stat in stats] if self.panes > 1 else []
+        self.quantiles = [int(stat[1:]) / 100 for stat in self.stats if stat.startswith('p')]
+        self.units = [GAUGES[key][1] for key, _ in schema.getters]
+        self.bin_interval = schema.bin_minutes * 60
+        self.lateness = lateness
+        self.lock = threading.Lock()
+        self.windows = {}  # group -> Window
+        self.sliding = {}  # group -> deque of (start, [(count, total, min, max) per gauge])
+        self.activity = {}  # group -> {kind: ActivityRing}
+        self.pending = None  # PendingEvents over the activity store, set by the first add
+        self.pending_devices = {}  # group -> devices with events in its rings that aren't recorded as sent yet
+        self.prefixes = {}  # (name, interval) -> JSON prefix
+        self.watermark = 0
+        self.swept = 0
+
+        # Metrics
+        self.uplinks = 0
+        self.late = 0
+        self.points_out = 0
+
+    @classmethod
+    def from_config(cls, schema, config):
+        aggregation = config.get('AGGREGATION', {})
+        if not aggregation.get('enabled', False):
+            return None
+        return cls(schema, resolution=aggregation.get('resolution', 600),
+                   sliding_window=aggregation.get('sliding_window', 0), stats=aggregation.get('stats', STATS),
+                   lateness=aggregation.get('lateness', 120))
+
+    def add(self, payload: KitchenData, activity):
+        # Returns Graphite JSON fragments for any windows this uplink closed, usually none
+        group = payload.device_id if self.schema.per_device else None
+        time = int(payload.time.timestamp())
+        start = time - time % self.resolution
+        points = []
+        with self.lock:
+            if self.pending is None or self.pending.store is not activity:
+                self.pending = PendingEvents(activity)
+            events = self.schema.events(payload, self.pending)
+            self.uplinks += 1
+            window = self.windows.get(group)
+            if window is not None and start > window.start:
+                self._close(group, window, points)
+                window = None
+            if window is None and start + self.resolution + self.lateness > self.watermark:
+                window = self.windows[group] = Window(start, len(self.units), self.quantiles)
+            if window is None or start < window.start:
+                self.late += 1
+            else:
+                for summary, (_, getter) in zip(window.summaries, self.schema.getters):
+                    summary.add(getter(payload))
+            if events:
+                rings = self.activity.get(group)
+                if rings is None:
+                    rings = self.activity[group] = {kind: ActivityRing(len(self.schema.bins))
+                                                    for kind in ('fridge', 'pir')}
+                for kind, bin_index, bin_start, _ in events:
+                    if not rings[kind].add(bin_index, bin_start):
+                        self.late += 1
+                self.pending_devices.setdefault(group, set()).add(payload.device_id)
+            if time > self.watermark:
+                self.watermark = time
+                if self.watermark - self.swept >= self.resolution:
+                    self._sweep(points)
+            self.points_out += len(points)
+        return points
+
+    def flush(self):
+        # Close every open window, e.g. on shutdown, and send the activity counts of groups without one, which
+        # late uplinks have changed since their window closed
+        points = []
+        with self.lock:
+            for group, window in list(self.windows.items()):
+                self._close(group, window, points)
+            for group in list(self.pending_devices):
+                self._emit_activity(group, points)
+            self.points_out += len(points)
+        return points
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'windows': len(self.windows),
+                'uplinks': self.uplinks,
+                'late': self.late,
+                'points_out': self.points_out,
+            }
+
+    def _sweep(self, points):
+        # Close windows of groups that have gone quiet
+        self.swept = self.watermark
+        for group, window in list(self.windows.items()):
+            if window.start + self.resolution + self.lateness <= self.watermark:
+                self._close(group, window, points)
+
+    def _close(self, group, window, points):
+        del self.windows[group]
+        gauges, activity_templates = self.schema.template(group)
+        time = ', "time": {}}}'.format(window.start)
+        panes = None
+        if self.sliding_stats:
+            panes = self.sliding.get(group)
+            if panes is None:
+                panes = self.sliding[group] = deque(maxlen=self.panes)
+            panes.append((window.start, [(summary.count, summary.total, summary.minimum, summary.maximum)
+                                         for summary in window.summaries]))
+        for i, ((name, _, _), unit, summary) in enumerate(zip(gauges, self.units, window.summaries)):
+            if not summary.count:
+                continue
+            quantiles = iter(summary.quantiles)
+            for stat in self.stats:
+                if stat == 'min':
+                    value = summary.minimum
+                elif stat == 'max':
+                    value = summary.maximum
+                elif stat == 'mean':
+                    value = summary.total / summary.count
+                elif stat == 'count':
+                    value = summary.count
+                else:
+                    value = next(quantiles).value()
+                points.append(self._prefix(name + '.' + stat, unit, self.resolution) + repr(value) + time)
+            if panes is not None:
+                # Panes older than the sliding window are skipped, e.g. after the group was quiet for a while
+                recent = [pane[i] for start, pane in panes if start > window.start - self.panes * self.resolution]
+                count = sum(pane[0] for pane in recent)
+                for stat in self.sliding_stats:
+                    if stat == 'min':
+                        value = min(pane[2] for pane in recent if pane[0])
+                    elif stat == 'max':
+                        value = max(pane[3] for pane in recent if pane[0])
+                    elif stat == 'mean':
+                        value = sum(pane[1] for pane in recent) / count
+                    else:
+                        value = count
+                    points.append(self._prefix(name + '.sliding.' + stat, unit, self.resolution * self.panes) +
+                                  repr(value) + time)
+        self._emit_activity(group, points, activity_templates)
+
+    def _emit_activity(self, group, points, activity_templates=None):
+        # Changed activity counts of the group, after which its events can be recorded as sent
+        if activity_templates is None:
+            activity_templates = self.schema.template(group)[1]
+        for kind, ring in self.activity.get(group, {}).items():
+            name, _, histogram, _ = activity_templates[kind]
+            for bin_index in sorted(ring.changed):
+                value = repr(ring.counts[bin_index]) + ', "time": {}}}'.format(ring.starts[bin_index])
+                points.append(self._prefix(name, '', self.bin_interval) + value)
+                points.append(self._prefix(histogram[bin_index], '', self.bin_interval) + value)
+            ring.changed.clear()
+        self.pending.commit(self.pending_devices.pop(group, ()))
+
+    def _prefix(self, name, unit, interval):
+        prefix = self.prefixes.get((name, interval))
+        if prefix is None:
+            prefix = self.prefixes[(name, interval)] = self.schema.json_prefix(name, unit, interval)
+        return prefix
@@ -0,0 +1,275 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from coursework.Instrumentation import REGISTRY
+from coursework.KitchenSensor import KitchenData
+
+logger = logging.getLogger(__name__)
+ALERTS_FIRED = REGISTRY.counter('kitcheniot_alerts_fired_total', 'Alerts that started firing')
+FIELDS = ('temperature', 'humidity', 'ldr', 'rssi', 'snr')
+
+# What a rule reports for an uplink: whether its condition holds, and the value it was judged on
+Verdict = collections.namedtuple('Verdict', 'firing value')
+
+
+class Threshold:
+    # Fires once `field` has been above `above` or below `below` for `count` uplinks in a row
+
+    def __init__(self, name, field, above=None, below=None, count=1, devices=None):
+        if field not in FIELDS:
+            raise ValueError('Alert rule {}: unknown field {}, expected one of {}'.format(name, field, FIELDS))
+        if above is None and below is None:
+            raise ValueError('Alert rule {}: a threshold needs above or below'.format(name))
+        self.name = name
+        self.field = field
+        self.above = above
+        self.below = below
+        self.count = count
+        self.devices = devices
+
+    def describe(self, value):
+        limit = 'above {}'.format(self.above) if self.above is not None and value > self.above else \
+            'below {}'.format(self.below)
+        return '{} {} {} for {} uplinks'.format(self.field, value, limit, self.count)
+
+    def evaluate(self, state, payload: KitchenData):
+        value = getattr(payload, self.field)
+        outside = (self.above is not None and value > self.above) or (self.below is not None and value < self.below)
+        state['run'] = state.get('run', 0) + 1 if outside else 0
+        return Verdict(state['run'] >= self.count, value)
+
+
+class RateOfChange:
+    # Fires when `field` changes faster than max_per_minute (either way) between consecutive uplinks of a device
+
+    def __init__(self, name, field, max_per_minute, devices=None):
+        if field not in FIELDS:
+            raise ValueError('Alert rule {}: unknown field {}, expected one of {}'.format(name, field, FIELDS))
+        self.name = name
+        self.field = field
+        self.max_per_minute = max_per_minute
+        self.devices = devices
+
+    def describe(self, value):
+        return '{} changing by {:+.3g}/min, more than {}/min'.format(self.field, value, self.max_per_minute)
+
+    def evaluate(self, state, payload: KitchenData):
+        value = getattr(payload, self.field)
+        sent = payload.time.timestamp()
+        previous = state.get('last')
+        if previous is not None and sent <= previous[0]:
+            # Out of order or repeated uplink, no rate to judge
+            return None
+        state['last'] = (sent, value)
+        if previous is None:
+            return None
+        rate = (value - previous[1]) / ((sent - previous[0]) / 60)
+        return Verdict(abs(rate) > self.max_per_minute, rate)
+
+
+class FridgeOpen:
+    # The sensor only reports when the fridge was last opened, not when it closed. A door left open keeps the reed
+    # switch triggering, so the fridge counts as open while every uplink reports an opening since the one before.
+    # Fires once that has lasted `minutes`.
+
+    def __init__(self, name, minutes, devices=None):
+        self.name = name
+        self.minutes = minutes
+        self.devices = devices
+
+    def describe(self, value):
+        return 'fridge open for {:.0f} minutes, more than {}'.format(value, self.minutes)
+
+    def evaluate(self, state, payload: KitchenData):
+        opened = payload.fridge_opened_time
+        sent = payload.time.timestamp()
+        previous = state.get('previous')
+        state['previous'] = sent
+        if opened is None or previous is None or opened.timestamp() < previous:
+            state.pop('since', None)
+            return Verdict(False, 0)
+        since = state.setdefault('since', min(opened.timestamp(), previous))
+        minutes = (sent - since) / 60
+        return Verdict(minutes > self.minutes, minutes)
+
+
+class Silence:
+    # Fires when a device hasn't been heard from for `intervals` uplink intervals (METRICS interval), or `minutes`.
+    # Judged by the engine's periodic check rather than per uplink.
+
+    def __init__(self, name, timeout, devices=None):
+        self.name = name
+        self.timeout = timeout
+        self.devices = devices
+
+    def describe(self, value):
+        return 'no uplink for {:.0f} seconds'.format(value)
+
+    def evaluate(self, state, payload: KitchenData):
+        return Verdict(False, 0)
+
+
+RULES = {'threshold': Threshold, 'rate_of_change': RateOfChange, 'fridge_open': FridgeOpen, 'silence': Silence}
+
+
+class LogSink:
+    # ALERTS sinks: {log: true} logs alerts as warnings, and their resolution as info
+
+    def __init__(self, option=True):
+        pass
+
+    def send(self, alert):
+        level = logging.WARNING if alert['state'] == 'firing' else logging.INFO
+        logger.log(level, 'Alert %s %s for %s: %s', alert['rule'], alert['state'], alert['device'], alert['message'],
+                   extra={'alert': alert})
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    # ALERTS sinks: {file: alerts.jsonl} appends each alert to a JSON lines file
+
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def send(self, alert):
+        self.file.write(json.dumps(alert) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Sinks by config name. Anything with send(alert) and close() can be added, here or with AlertEngine.add_sink.
+SINKS = {'log': LogSink, 'file': FileSink}
+
+
+class AlertEngine:
+    # Evaluates the ALERTS rules against each uplink as it is ingested, keeping a little state per rule and device,
+    # so each uplink costs O(1) per rule. An alert is sent to the sinks when its condition starts to hold
+    # (state firing) and again when it stops (state resolved). Silence rules are checked every check_interval
+    # seconds on a background thread, going through devices from the longest silent.
+
+    def __init__(self, rules, sinks=(), check_interval=10):
+        self.rules = rules
+        self.uplink_rules = [rule for rule in rules if not isinstance(rule, Silence)]
+        self.silence_rules = [rule for rule in rules if isinstance(rule, Silence)]
+        self.sinks = list(sinks)
+        self.state = collections.defaultdict(dict)  # (rule name, device) -> rule state
+        self.active = {}  # (rule name, device) -> alert
+        self.last_seen = collections.OrderedDict()  # device -> epoch seconds, least recently heard from first
+        self.lock = threading.Lock()
+        self.fired = 0
+        self.stopping = threading.Event()
+        self.checker = None
+        if self.silence_rules:
+            self.checker = threading.Thread(target=self._check_periodically, args=(check_interval,),
+                                            name='alert-silence', daemon=True)
+            self.checker.start()
+
+    @classmethod
+    def from_config(cls, config, suffix=''):
+        # ALERTS:
+        #   sinks: {log: true, file: alerts.jsonl}
+        #   rules:
+        #     - {name: fridge-warm, type: threshold, field: temperature, above: 8, count: 3}
+        #     - {name: temperature-spike, type: rate_of_change, field: temperature, max_per_minute: 0.5}
+        #     - {name: fridge-left-open, type: fridge_open, minutes: 5}
+        #     - {name: sensor-silent, type: silence, intervals: 3}
+        # Returns None without any rules
+        alerts = config.get('ALERTS', {})
+        if not alerts.get('rules'):
+            return None
+        interval = config.get('METRICS', {}).get('interval', 120)
+        rules = []
+        for options in alerts['rules']:
+            options = dict(options)
+            kind = options.pop('type')
+            if kind not in RULES:
+                raise ValueError('Unknown alert rule type {}, expected one of {}'.format(kind, sorted(RULES)))
+            if kind == 'silence':
+                minutes = options.pop('minutes', None)
+                options['timeout'] = minutes * 60 if minutes else options.pop('intervals', 3) * interval
+            rules.append(RULES[kind](**options))
+        names = [rule.name for rule in rules]
+        if len(set(names)) != len(names):
+            raise ValueError('Alert rule names must be unique: {}'.format(names))
+
+        sinks = []
+        for name, option in alerts.get('sinks', {'log': True}).items():
+            if name not in SINKS:
+                raise ValueError('Unknown alert sink {}, expected one of {}'.format(name, sorted(SINKS)))
+            if name == 'file':
+                root, extension = os.path.splitext(option)
+                option = root + suffix + extension
+            sinks.append(SINKS[name](option))
+        return cls(rules, sinks, check_interval=alerts.get('check_interval', 10))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def evaluate(self, payload: KitchenData):
+        device = payload.device_id
+        with self.lock:
+            if self.silence_rules:
+                self.last_seen[device] = payload.received_time.timestamp()
+                self.last_seen.move_to_end(device)
+            for rule in self.uplink_rules:
+                if rule.devices is None or device in rule.devices:
+                    verdict = rule.evaluate(self.state[(rule.name, device)], payload)
+                    if verdict is not None:
+                        self._update(rule, device, verdict, payload.time.timestamp())
+            for rule in self.silence_rules:
+                if (rule.name, device) in self.active:
+                    self._update(rule, device, Verdict(False, 0), payload.received_time.timestamp())
+
+    def check(self, now=None):
+        # Fire silence alerts for devices that haven't been heard from in time
+        now = time.time() if now is None else now
+        with self.lock:
+            for device, seen in self.last_seen.items():
+                quiet = now - seen
+                if quiet < min(rule.timeout for rule in self.silence_rules):
+                    # Every device after this one was heard from more recently
+                    break
+                for rule in self.silence_rules:
+                    if (rule.devices is None or device in rule.devices) and quiet >= rule.timeout:
+                        self._update(rule, device, Verdict(True, quiet), now)
+
+    def metrics(self):
+        with self.lock:
+            return {'fired': self.fired, 'active': len(self.active)}
+
+    def close(self):
+        self.stopping.set()
+        if self.checker is not None:
+            self.checker.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def _update(self, rule, device, verdict, timestamp):
+        key = (rule.name, device)
+        if verdict.firing == (key in self.active):
+            return
+        alert = {'rule': rule.name, 'device': device, 'state': 'firing' if verdict.firing else 'resolved',
+                 'time': timestamp, 'value': verdict.value,
+                 'message': rule.describe(verdict.value if verdict.firing else self.active[key]['value'])}
+        if verdict.firing:
+            self.active[key] = alert
+            self.fired += 1
+            ALERTS_FIRED.inc()
+        else:
+            alert['fired_time'] = self.active.pop(key)['time']
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            except Exception as e:
+                logger.warning('Alert sink %s failed: %r', type(sink).__name__, e)
+
+    def _check_periodically(self, interval):
+        while not self.stopping.wait(interval):
+            self.check()
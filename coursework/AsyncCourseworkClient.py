@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from coursework.AsyncGraphiteWriter import AsyncGraphiteWriter
+from coursework.Config import load_config, redacted
+from coursework.CourseworkClient import CourseworkClient, ON_MESSAGE_SECONDS, STORAGE_SECONDS, log_to_csv, \
+    metrics_endpoint, shard_of, spool_from_config
+from coursework.Pipeline import RawMessage
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCourseworkClient(CourseworkClient):
+    # The CourseworkClient on a single asyncio event loop instead of threads: paho reads and writes its socket when
+    # the loop says it's ready, and decoding, Graphite POSTs (several in flight at once, see AsyncGraphiteWriter)
+    # and storage writes run as tasks, connected by bounded queues. When the parse queue is full the broker socket
+    # stops being read until it drains, so backpressure reaches the broker rather than blocking the loop.
+    # Storage appends run on an executor thread in batches, so fsyncs don't stall the loop.
+
+    def __init__(self, config=None, shard=0, shards=1, run=True):
+        self.config = config or load_config()
+        logger.info('Config: %s', redacted(self.config))
+        self.metrics_server = None
+        self.shard = shard
+        self.shards = shards
+        self.received = 0
+        self.skipped = 0
+        self.loop = asyncio.new_event_loop()
+
+        suffix = '' if shards == 1 else '-{}'.format(shard)
+        self.open_sinks(suffix)
+        self.graphite = async_graphite_writer(self.config, suffix=suffix)
+
+        # The parse queue is bounded by pausing the broker socket at parse_limit, rather than by the queue itself
+        pipeline = self.config.get('PIPELINE', {})
+        self.parse_limit = pipeline.get('parse', {}).get('maxsize', 1000)
+        self.queues = {'parse': asyncio.Queue(),
+                       'storage': asyncio.Queue(maxsize=pipeline.get('storage', {}).get('maxsize', 1000))}
+        self.stage_metrics = {name: {'processed': 0, 'errors': 0, 'max_depth': 0} for name in self.queues}
+        self.paused = False
+        self.stopped = asyncio.Event()
+        self.misc = None
+
+        self.ttn_broker = self.mqtt_client()
+        self.ttn_broker.on_socket_open = self.on_socket_open
+        self.ttn_broker.on_socket_close = self.on_socket_close
+        self.ttn_broker.on_socket_register_write = self.on_socket_register_write
+        self.ttn_broker.on_socket_unregister_write = self.on_socket_unregister_write
+        self.ttn_broker.connect(host=self.config['TTN_MQTT_BROKER'], port=self.config.get('TTN_MQTT_PORT', 1883))
+        self.ttn_broker.subscribe(topic=self.topic)
+        self.metrics_server = metrics_endpoint(self, self.config)
+
+        if run:
+            self.run()
+
+    def run(self):
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.close_sinks()
+            self.loop.close()
+
+    async def serve(self):
+        await self.graphite.start()
+        tasks = [self.loop.create_task(self.decode()), self.loop.create_task(self.persist())]
+        await self.stopped.wait()
+
+        # Finish what has been received before closing the sinks
+        for queue in self.queues.values():
+            await queue.join()
+        for task in tasks:
+            task.cancel()
+        if self.aggregator is not None:
+            self.graphite.write(self.aggregator.flush())
+        await self.graphite.close()
+
+    def stop(self):
+        # Thread-safe: disconnects from the broker, after which run() returns once every queued uplink has been handled
+        self.loop.call_soon_threadsafe(self.ttn_broker.disconnect)
+
+    def metrics(self):
+        pipeline = {}
+        for name, queue in self.queues.items():
+            stage = self.stage_metrics[name]
+            pipeline[name] = {'depth': queue.qsize(), 'max_depth': stage['max_depth'], 'spill_depth': 0,
+                              'processed': stage['processed'], 'dropped': 0, 'spilled': 0, 'errors': stage['errors']}
+        metrics = {
+            'received': self.received,
+            'skipped': self.skipped,
+            'dead_letters': self.dead_letters.count,
+            'pipeline': pipeline,
+            'graphite': self.graphite.metrics(),
+        }
+        if self.aggregator is not None:
+            metrics['aggregator'] = self.aggregator.metrics()
+        if self.alerts is not None:
+            metrics['alerts'] = self.alerts.metrics()
+        if self.radio is not None:
+            metrics['radio'] = self.radio.metrics()
+        return metrics
+
+    def on_message(self, client, userdata, message):
+        # Runs on the event loop, from paho's loop_read
+        started = time.perf_counter()
+        received_time = datetime.now().astimezone()
+        if self.shards > 1 and not self.shared_subscription and shard_of(message.topic, self.shards) != self.shard:
+            # Another worker process owns this device
+            self.skipped += 1
+            return
+        self.received += 1
+        queue = self.queues['parse']
+        queue.put_nowait(RawMessage(message.topic, message.payload, received_time))
+        self._record_depth('parse')
+        if queue.qsize() >= self.parse_limit and not self.paused:
+            # Stop reading from the broker until decode() has caught up
+            self.paused = True
+            self.loop.remove_reader(self.ttn_broker.socket())
+        ON_MESSAGE_SECONDS.observe(time.perf_counter() - started)
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc == 0:
+            self.stopped.set()
+        else:
+            logger.warning('TTN MQTT connection lost (rc %s). Will re-connect automatically', rc)
+            self.loop.create_task(self.reconnect())
+
+    async def reconnect(self):
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                self.ttn_broker.reconnect()
+                return
+            except OSError as e:
+                delay = min(delay * 2, 120)
+                logger.warning('TTN MQTT reconnect failed, retrying in %ss: %r', delay, e)
+
+    async def decode(self):
+        # Decodes uplinks and hands them to the Graphite writer and storage queue, yielding to the loop between
+        # batches of whatever is queued
+        queue = self.queues['parse']
+        storage = self.queues['storage']
+        stage = self.stage_metrics['parse']
+        while True:
+            messages = [await queue.get()]
+            while not queue.empty() and len(messages) < 100:
+                messages.append(queue.get_nowait())
+            for message in messages:
+                try:
+                    payload = self.process_message(message)
+                    if payload is not None:
+                        self.relay_to_grafana(payload)
+                        if self.alerts is not None:
+                            self.alerts.evaluate(payload)
+                        await storage.put(payload)
+                        self._record_depth('storage')
+                    stage['processed'] += 1
+                except Exception as e:
+                    stage['errors'] += 1
+                    logger.warning("Pipeline stage 'parse' failed: %r", e)
+                queue.task_done()
+            # queue.get() doesn't yield while there's a backlog, so let the POSTs and the broker socket have a turn
+            await asyncio.sleep(0)
+            if self.paused and queue.qsize() <= self.parse_limit // 2:
+                self.paused = False
+                if self.ttn_broker.socket() is not None:
+                    self.loop.add_reader(self.ttn_broker.socket(), self.read_socket)
+
+    async def persist(self):
+        queue = self.queues['storage']
+        stage = self.stage_metrics['storage']
+        while True:
+            payloads = [await queue.get()]
+            while not queue.empty():
+                payloads.append(queue.get_nowait())
+            try:
+                await self.loop.run_in_executor(None, self.store_payloads, payloads)
+                stage['processed'] += len(payloads)
+            except Exception as e:
+                stage['errors'] += len(payloads)
+                logger.warning("Pipeline stage 'storage' failed: %r", e)
+            for _ in payloads:
+                queue.task_done()
+
+    def store_payloads(self, payloads):
+        started = time.perf_counter()
+        for payload in payloads:
+            if self.store is None:
+                log_to_csv(payload, self.csv_file)
+            else:
+                self.store.append(payload)
+        # Timed per batch, as the same histogram is per uplink in the threaded runtime
+        STORAGE_SECONDS.observe((time.perf_counter() - started) / len(payloads))
+        if self.radio is not None:
+            for payload in payloads:
+                self.radio.append(payload)
+
+    # paho socket callbacks: the event loop watches the socket and calls paho back when it can read or write
+
+    def read_socket(self):
+        # paho 1.5 reads one packet per loop_read, and each readiness callback costs more than decoding a packet,
+        # so keep reading until a call brings in no new uplink (the socket is drained) or reading is paused
+        for _ in range(256):
+            before = self.received + self.skipped
+            if self.ttn_broker.loop_read() != MQTT_ERR_SUCCESS or self.paused or self.received + self.skipped == before:
+                return
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, self.read_socket)
+        self.misc = self.loop.create_task(self.keepalive())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def keepalive(self):
+        # Pings and retries, which loop_forever would otherwise do between reads
+        while self.ttn_broker.loop_misc() == MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _record_depth(self, name):
+        stage = self.stage_metrics[name]
+        depth = self.queues[name].qsize()
+        if depth > stage['max_depth']:
+            stage['max_depth'] = depth
+
+
+def async_graphite_writer(config, suffix=''):
+    # As CourseworkClient.graphite_writer, with GRAPHITE_BATCH max_in_flight POSTs at once
+    batching = config.get('GRAPHITE_BATCH', {})
+    return AsyncGraphiteWriter(config['GRAPHITE_URL'], config['GRAPHITE_USER'], config['GRAPHITE_API_KEY'],
+                               max_points=batching.get('max_points', 500),
+                               flush_interval_ms=batching.get('flush_interval_ms', 1000),
+                               max_in_flight=batching.get('max_in_flight', 8),
+                               spool=spool_from_config(config, suffix))
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from coursework.GraphiteWriter import POST_FAILURES, POST_SECONDS
+
+# aiohttp is optional, only needed by the asyncio runtime
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGraphiteWriter:
+    # GraphiteWriter for the asyncio runtime: points are buffered and POSTed in batches by a task on the event loop,
+    # with up to max_in_flight batches being sent at once. With a Spool, buffered points are appended to it every
+    # flush and read back from it to be sent, as in GraphiteWriter; batches are acknowledged in order, so a failed
+    # batch and everything after it is sent again.
+
+    def __init__(self, url, user, api_key, max_points=500, flush_interval_ms=1000, max_in_flight=8,
+                 max_buffer=100000, backoff=0.5, max_backoff=60, timeout=10, spool=None):
+        if aiohttp is None:
+            raise ImportError('The asyncio runtime needs the aiohttp package (pip install aiohttp)')
+        self.url = url
+        # Grafana Cloud users are numeric IDs, which the YAML reads as ints
+        self.auth = aiohttp.BasicAuth(str(user), str(api_key))
+        self.max_points = max_points
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_in_flight = max_in_flight
+        self.max_buffer = max_buffer
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.spool = spool
+        self.buffer = []
+        self.retry_delay = 0
+        self.closed = False
+        self.session = None
+        self.task = None
+        self.wakeup = None
+
+        # Metrics
+        self.sent = 0
+        self.dropped = 0
+        self.requests = 0
+        self.failures = 0
+
+    async def start(self):
+        # Must be called from the event loop the writer is used on
+        self.session = aiohttp.ClientSession(auth=self.auth, connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def write(self, points):
+        # points are Graphite JSON objects, as strings. Only called from the event loop.
+        self.buffer.extend(points)
+        overflow = len(self.buffer) - self.max_buffer
+        if overflow > 0 and self.spool is None:
+            # Bound memory during long outages by dropping the oldest points
+            del self.buffer[:overflow]
+            self.dropped += overflow
+        if len(self.buffer) >= self.max_points:
+            self.wakeup.set()
+
+    def pending(self):
+        return len(self.buffer) + (self.spool.pending() if self.spool is not None else 0)
+
+    async def flush(self):
+        # Send everything buffered right now. Returns False if a POST failed, leaving the unsent points buffered.
+        if self.spool is not None:
+            if self.buffer:
+                points, self.buffer = self.buffer, []
+                await asyncio.get_running_loop().run_in_executor(None, self.spool.append, points)
+            return await self._drain()
+        while self.buffer:
+            batches = [self.buffer[i:i + self.max_points]
+                       for i in range(0, min(len(self.buffer), self.max_points * self.max_in_flight), self.max_points)]
+            del self.buffer[:sum(map(len, batches))]
+            results = await asyncio.gather(*map(self._post, batches))
+            failed = [point for batch, ok in zip(batches, results) if not ok for point in batch]
+            if failed:
+                self.buffer[:0] = failed
+                return False
+        return True
+
+    async def close(self):
+        self.closed = True
+        self.wakeup.set()
+        await self.task
+        await self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def metrics(self):
+        metrics = {
+            'pending': self.pending(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+        if self.spool is not None:
+            metrics['dropped'] += self.spool.dropped
+            metrics['spool'] = self.spool.metrics()
+        return metrics
+
+    async def _drain(self):
+        # Read up to max_in_flight batches ahead from the spool, send them all at once, and acknowledge the batches
+        # up to the first that failed
+        loop = asyncio.get_running_loop()
+        while True:
+            reads, position = [], None
+            for _ in range(self.max_in_flight):
+                batch, position = await loop.run_in_executor(None, self.spool.read, self.max_points, position)
+                if not batch:
+                    break
+                reads.append((batch, position))
+            if not reads:
+                return True
+            results = await asyncio.gather(*(self._post(batch) for batch, _ in reads))
+            sent = 0
+            for ok, (batch, position) in zip(results, reads):
+                if not ok:
+                    break
+                sent += len(batch)
+                acked = position
+            if sent:
+                self.spool.ack(acked[:2] + (sent,))
+            if not all(results):
+                return False
+
+    async def _post(self, batch):
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            # Points arrive already serialised as JSON objects (see MetricSchema.points), so just join them
+            body = ('[' + ','.join(batch) + ']').encode('utf-8')
+            async with self.session.post(self.url, data=body, headers={'Content-Type': 'application/json'}) as result:
+                ok = result.status == 200
+                error = await result.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            ok = False
+            error = repr(e)
+        POST_SECONDS.observe(time.perf_counter() - started)
+
+        if ok:
+            self.sent += len(batch)
+            self.retry_delay = 0
+        else:
+            self.failures += 1
+            POST_FAILURES.inc()
+            # Exponential backoff between attempts while Graphite is unhealthy
+            self.retry_delay = min(max(self.retry_delay * 2, self.backoff), self.max_backoff)
+            logger.warning('Graphite POST of %s points failed, retrying in %ss: %s', len(batch), self.retry_delay, error)
+        return ok
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline = loop.time() + max(self.flush_interval, self.retry_delay)
+            while not self.closed and (len(self.buffer) < self.max_points or self.retry_delay):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            closed = self.closed
+            if not await self.flush() and closed:
+                logger.warning('Graphite writer closed with %s unsent points', self.pending())
+                return
+            if closed:
+                return
@@ -0,0 +1,142 @@
+import struct
+from collections import namedtuple
+from google.protobuf.message import DecodeError
+from pb import SensorPayload_pb2
+
+# CBOR is optional, for fleets that send CBOR-encoded payloads
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# What a kitchen sensor payload carries, whatever the encoding. Temperature is in °C, the activity timings are
+# None until the sensor has seen some activity.
+SensorReading = namedtuple('SensorReading', 'temperature humidity ldr sec_since_pir sec_since_fridge')
+SensorPayload = SensorPayload_pb2.SensorPayload
+
+
+class UndecodablePayload(ValueError):
+    pass
+
+
+class ProtobufCodec:
+    # The original kitchen sensor encoding, pb/SensorPayload_pb2.py
+    name = 'protobuf'
+
+    def decode(self, data):
+        try:
+            payload = SensorPayload.FromString(data)
+        except DecodeError as e:
+            raise UndecodablePayload('Invalid protobuf sensor payload: {}'.format(e))
+        return SensorReading(payload.temperature / 100, payload.humidity, payload.ldr,
+                             payload.sec_since_pir if payload.HasField('sec_since_pir') else None,
+                             payload.sec_since_fridge if payload.HasField('sec_since_fridge') else None)
+
+    def encode(self, reading):
+        payload = SensorPayload(temperature=round(reading.temperature * 100), humidity=reading.humidity,
+                                ldr=reading.ldr)
+        if reading.sec_since_pir is not None:
+            payload.sec_since_pir = reading.sec_since_pir
+        if reading.sec_since_fridge is not None:
+            payload.sec_since_fridge = reading.sec_since_fridge
+        return payload.SerializeToString()
+
+
+class StructCodec:
+    # Fixed-width packed fields: temperature in hundredths of a degree, humidity, LDR, then the seconds since PIR
+    # and fridge activity (all ones for none). The layout is compiled once.
+    name = 'struct'
+    NONE = 0xFFFFFFFF
+
+    def __init__(self, layout='<hBHII'):
+        self.layout = struct.Struct(layout)
+
+    def decode(self, data):
+        try:
+            temperature, humidity, ldr, sec_since_pir, sec_since_fridge = self.layout.unpack(data)
+        except struct.error as e:
+            raise UndecodablePayload('{} byte payload does not match struct layout {}: {}'.format(
+                len(data), self.layout.format, e))
+        return SensorReading(temperature / 100, humidity, ldr,
+                             None if sec_since_pir == self.NONE else sec_since_pir,
+                             None if sec_since_fridge == self.NONE else sec_since_fridge)
+
+    def encode(self, reading):
+        return self.layout.pack(round(reading.temperature * 100), reading.humidity, reading.ldr,
+                                self.NONE if reading.sec_since_pir is None else reading.sec_since_pir,
+                                self.NONE if reading.sec_since_fridge is None else reading.sec_since_fridge)
+
+
+class CborCodec:
+    # A CBOR map keyed by small integers (0 temperature in hundredths of a degree, 1 humidity, 2 LDR, 3 seconds
+    # since PIR activity, 4 seconds since the fridge was opened), leaving out activity that hasn't happened
+    name = 'cbor'
+
+    def __init__(self):
+        if cbor2 is None:
+            raise ImportError('The cbor codec needs the cbor2 package (pip install cbor2)')
+
+    def decode(self, data):
+        try:
+            fields = cbor2.loads(data)
+            return SensorReading(fields[0] / 100, fields[1], fields[2], fields.get(3), fields.get(4))
+        except (cbor2.CBORDecodeError, KeyError, TypeError, AttributeError) as e:
+            raise UndecodablePayload('Invalid CBOR sensor payload: {!r}'.format(e))
+
+    def encode(self, reading):
+        fields = {0: round(reading.temperature * 100), 1: reading.humidity, 2: reading.ldr}
+        if reading.sec_since_pir is not None:
+            fields[3] = reading.sec_since_pir
+        if reading.sec_since_fridge is not None:
+            fields[4] = reading.sec_since_fridge
+        return cbor2.dumps(fields)
+
+
+CODECS = {'protobuf': ProtobufCodec, 'struct': StructCodec, 'cbor': CborCodec}
+
+
+class CodecRegistry:
+    # Maps (device, LoRaWAN port) to the codec its payloads are decoded with. Codecs registered without a device
+    # apply to every device on that port, unless the device has its own. Codecs are built once, when registered.
+
+    def __init__(self):
+        self.codecs = {}  # (device or None, port) -> codec
+
+    @classmethod
+    def from_config(cls, config):
+        # CODECS:
+        #   ports: {3: protobuf, 4: struct}
+        #   devices: {kitchen-sensor-9: {5: cbor}}
+        #   struct_layout: '<hBHII'
+        codecs = config.get('CODECS', {})
+        registry = cls()
+        options = {'struct': {'layout': codecs['struct_layout']}} if 'struct_layout' in codecs else {}
+        for port, name in codecs.get('ports', {3: 'protobuf'}).items():
+            registry.register(int(port), registry.build(name, options))
+        for device, ports in codecs.get('devices', {}).items():
+            for port, name in ports.items():
+                registry.register(int(port), registry.build(name, options), device=device)
+        return registry
+
+    @staticmethod
+    def build(name, options):
+        if name not in CODECS:
+            raise ValueError('Unknown payload codec {}, expected one of {}'.format(name, sorted(CODECS)))
+        return CODECS[name](**options.get(name, {}))
+
+    def register(self, port, codec, device=None):
+        self.codecs[(device, port)] = codec
+
+    def lookup(self, device, port):
+        codec = self.codecs.get((device, port)) or self.codecs.get((None, port))
+        if codec is None:
+            raise UndecodablePayload('No payload codec for port {} of device {}'.format(port, device))
+        return codec
+
+    def decode(self, device, port, data):
+        return self.lookup(device, port).decode(data)
+
+
+# The kitchen sensor's protobuf payloads on port 3
+DEFAULT_CODECS = CodecRegistry()
+DEFAULT_CODECS.register(3, ProtobufCodec())
@@ -0,0 +1,133 @@
+import json
+import marshal
+import os
+
+# The coursework config, next to this module so it's found whatever the working directory. KITCHENIOT_CONFIG or
+# main.py --config point elsewhere.
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CW_Mqtt_Secrets.yaml')
+ENV_PREFIX = 'KITCHENIOT_'
+
+REQUIRED = ('TTN_MQTT_BROKER', 'TTN_MQTT_USER', 'TTN_MQTT_PASS', 'GRAPHITE_URL', 'GRAPHITE_USER', 'GRAPHITE_API_KEY')
+TTN_REQUIRED = ('TTN_MQTT_BROKER', 'TTN_MQTT_USER', 'TTN_MQTT_PASS')
+# Optional sections, and what they may be
+SECTIONS = {
+    'PIPELINE': (dict,), 'GRAPHITE_BATCH': (dict,), 'STORAGE': (dict,), 'SHARDING': (dict,), 'CODECS': (dict,),
+    'METRICS': (dict,), 'AGGREGATION': (dict,), 'ALERTS': (dict,), 'LOGGING': (dict,),
+    'GRAPHITE_SPOOL': (dict, 'none'), 'METRICS_ENDPOINT': (dict, 'none'), 'RADIO': (dict, 'none'),
+    'DEAD_LETTERS': (str,), 'ACTIVITY_STATE': (str,), 'TTN_MQTT_PORT': (int,),
+}
+SECRETS = ('PASS', 'KEY', 'SECRET', 'TOKEN')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Config(dict):
+    # The parsed config: a plain dict of the YAML, overridden by KITCHENIOT_* environment variables and validated,
+    # so the rest of the client can index it without checking. Printing it hides secrets.
+
+    def __init__(self, values, path=None):
+        super().__init__(values)
+        self.path = path
+
+    def redacted(self):
+        return redacted(self)
+
+    def __repr__(self):
+        return 'Config({!r})'.format(self.redacted())
+
+    __str__ = __repr__
+
+
+def redacted(config):
+    # A copy of the config for logs, with passwords and API keys masked
+    return {key: '***' if any(secret in str(key).upper() for secret in SECRETS) and value else
+            redacted(value) if isinstance(value, dict) else value for key, value in config.items()}
+
+
+def load_config(path=None, required=REQUIRED, environ=None):
+    # Parses the YAML once per change: the parsed config is cached by the file's size and modification time in
+    # __pycache__ next to it, so later starts don't import or run the YAML parser at all. Environment overrides are
+    # applied on every load, as they're not part of the file.
+    environ = os.environ if environ is None else environ
+    path = os.path.abspath(path or environ.get(ENV_PREFIX + 'CONFIG') or CONFIG_PATH)
+    values = _read_cached(path)
+    apply_env(values, environ)
+    config = Config(values, path)
+    validate(config, required)
+    return config
+
+
+def apply_env(values, environ):
+    # KITCHENIOT_TTN_MQTT_PASS=secret sets TTN_MQTT_PASS, KITCHENIOT_GRAPHITE_BATCH__MAX_POINTS=1000 sets
+    # GRAPHITE_BATCH: {max_points: 1000}. Values are read as JSON where they parse (numbers, true/false, objects),
+    # otherwise as strings, except that settings which are strings in the file stay strings.
+    for name, text in environ.items():
+        if not name.startswith(ENV_PREFIX) or name == ENV_PREFIX + 'CONFIG':
+            continue
+        keys = name[len(ENV_PREFIX):].split('__')
+        keys = keys[:1] + [key.lower() for key in keys[1:]]
+        section = values
+        for key in keys[:-1]:
+            if not isinstance(section.get(key), dict):
+                section[key] = {}
+            section = section[key]
+        try:
+            value = text if isinstance(section.get(keys[-1]), str) else json.loads(text)
+        except ValueError:
+            value = text
+        section[keys[-1]] = value
+
+
+def validate(config, required=REQUIRED):
+    problems = ['{} is missing'.format(key) for key in required if not config.get(key)]
+    for key, allowed in SECTIONS.items():
+        if key not in config:
+            continue
+        value = config[key]
+        if not any(value == option if isinstance(option, str) else isinstance(value, option) for option in allowed):
+            problems.append('{} should be {}, not {!r}'.format(
+                key, ' or '.join(repr(option) if isinstance(option, str) else
+                                 ('an ' if option.__name__[0] in 'aeiou' else 'a ') + option.__name__
+                                 for option in allowed), value))
+    if problems:
+        raise ConfigError('Invalid config {}: {}'.format(config.path, '; '.join(problems)))
+
+
+def _read_cached(path):
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    # marshal keeps the int keys of e.g. CODECS ports, which JSON wouldn't. Like pickle it isn't safe against
+    # malicious or malformed data, so the cache is only read if it belongs to this user and nobody else can write
+    # it, as mkstemp creates it: anyone able to replace it could already edit the YAML.
+    cache_path = os.path.join(os.path.dirname(path), '__pycache__', os.path.basename(path) + '.marshal')
+    try:
+        with open(cache_path, 'rb') as cache:
+            owner = os.fstat(cache.fileno())
+            if owner.st_uid == os.getuid() and not owner.st_mode & 0o022:
+                cached_signature, values = marshal.load(cache)
+                if cached_signature == signature:
+                    return values
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import yaml
+    with open(path) as configuration:
+        # The libyaml parser where PyYAML was built with it. The config is plain data, so the safe loader will do.
+        values = yaml.load(configuration, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+    import tempfile
+    temporary = None
+    try:
+        # Holds the same secrets as the YAML, so readable only by its owner
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(descriptor, 'wb') as cache:
+            marshal.dump((signature, values), cache)
+        os.replace(temporary, cache_path)
+    except (OSError, ValueError):
+        # e.g. a read-only container image, or YAML dates which marshal can't hold. Either way the YAML is parsed
+        # every time.
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+    return values
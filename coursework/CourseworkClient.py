@@ -1,211 +1,373 @@
 import uuid
 from dataclasses import dataclass
-import yaml
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 import csv
+import logging
 import time
-import requests
+import zlib
+from functools import partial
 from paho.mqtt.client import Client
 from coursework.KitchenSensor import KitchenSensorParser, KitchenData
+from coursework.Pipeline import Pipeline, RawMessage, BLOCK
+from coursework.GraphiteWriter import GraphiteWriter
+from coursework.Spool import Spool
+from coursework.SensorStore import SensorStore
+from coursework.EventStore import ActivityTracker, EventStore
+from coursework.GraphiteSchema import MetricSchema
+from coursework.Aggregator import Aggregator
+from coursework.Alerts import AlertEngine
+from coursework.RadioStats import RadioLog
+from coursework.Config import load_config, redacted
+from coursework.Codecs import CodecRegistry
+from coursework.DeadLetters import DeadLetters, DiscardedLetters
+from coursework.Instrumentation import REGISTRY, MetricsServer
 
 csv_file = os.path.join(os.getcwd(), 'sensor_data.csv')
+store_dir = os.path.join(os.getcwd(), 'sensor_data')
+activity_file = os.path.join(os.getcwd(), 'activity_state.bin')
+spool_dir = os.path.join(os.getcwd(), 'graphite_spool')
+dead_letter_file = os.path.join(os.getcwd(), 'dead_letters.jsonl')
+radio_dir = os.path.join(os.getcwd(), 'radio_log')
+
+logger = logging.getLogger(__name__)
+ON_MESSAGE_SECONDS = REGISTRY.histogram('kitcheniot_on_message_seconds',
+                                        'Time on_message held the MQTT network loop per uplink')
+UPLINK_LAG_SECONDS = REGISTRY.histogram('kitcheniot_uplink_lag_seconds',
+                                        'Delay from the gateway receiving an uplink until on_message ran',
+                                        buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('kitcheniot_queue_wait_seconds',
+                                        'Time from on_message until the parse stage picked the uplink up')
+DECODE_SECONDS = REGISTRY.histogram('kitcheniot_decode_seconds', 'Time to decode an uplink envelope and payload')
+STORAGE_SECONDS = REGISTRY.histogram('kitcheniot_storage_write_seconds',
+                                     'Time to append an uplink to the SensorStore or CSV')
 
 
 class CourseworkClient:
 
-    def __init__(self):
-        with open(os.path.join('coursework', r'CW_Mqtt_Secrets.yaml')) as configuration:
-            self.config = yaml.load(configuration, Loader=yaml.FullLoader)
-            print(self.config)
+    def __init__(self, config=None, shard=0, shards=1, run=True):
+        self.config = config or load_config()
+        logger.info('Config: %s', redacted(self.config))
+        self.metrics_server = None
 
         self.mqtt_clients = []
 
-        self.ttn_broker = Client(client_id=str(uuid.getnode()), clean_session=False)
-        self.ttn_broker.username_pw_set(username=self.config['TTN_MQTT_USER'],
-                                        password=self.config['TTN_MQTT_PASS'])
-        self.ttn_broker.connect(host=self.config['TTN_MQTT_BROKER'])
-        self.ttn_broker.subscribe(topic="+/devices/+/up")
-        self.ttn_broker.on_subscribe = self.on_subscribe
-        self.ttn_broker.on_connect = self.on_connect
-        self.ttn_broker.on_message = self.on_message
-        self.ttn_broker.on_disconnect = self.on_disconnect
-        self.last_PIR_triggered = None
-        self.last_fridge_opened = None
+        # When several worker processes share the ingest (see Supervisor), each one handles a shard of the devices
+        self.shard = shard
+        self.shards = shards
+        self.received = 0
+        self.skipped = 0
+
+        self.ttn_broker = self.mqtt_client()
+        self.ttn_broker.connect(host=self.config['TTN_MQTT_BROKER'], port=self.config.get('TTN_MQTT_PORT', 1883))
+        self.ttn_broker.subscribe(topic=self.topic)
+        suffix = '' if shards == 1 else '-{}'.format(shard)
+        self.open_sinks(suffix)
+
+        # Points are buffered and POSTed in batches over a pooled connection rather than one request per uplink
+        self.graphite = graphite_writer(self.config, suffix=suffix)
+
+        # Decouple the MQTT network loop from the sinks: on_message only enqueues the raw message, then parsing,
+        # Graphite relaying and CSV logging each run on their own worker threads with bounded queues.
+        self.pipeline = build_pipeline(self, self.config.get('PIPELINE', {}))
+        self.pipeline.start()
+        self.metrics_server = metrics_endpoint(self, self.config)
 
         # Uncomment to replay saved CSV messages to Graphite
         # replay_csv(self)
 
+        if run:
+            self.run()
+
+    def mqtt_client(self):
+        # Not yet connected, so the asyncio runtime can hook the socket in first
+        sharding = self.config.get('SHARDING', {})
+        self.shared_subscription = self.shards > 1 and sharding.get('mode', 'hash') == 'shared'
+        self.topic = "+/devices/+/up"
+        if self.shared_subscription:
+            # The broker balances messages between the workers in the group, with no affinity of a device to a
+            # worker, so per-device state (activity, aggregation, alerts) is split between them
+            self.topic = "$share/{}/{}".format(sharding.get('group', 'kitcheniot'), self.topic)
+
+        client_id = str(uuid.getnode()) if self.shards == 1 else '{}-{}'.format(uuid.getnode(), self.shard)
+        client = Client(client_id=client_id, clean_session=False)
+        client.username_pw_set(username=self.config['TTN_MQTT_USER'], password=self.config['TTN_MQTT_PASS'])
+        client.on_subscribe = self.on_subscribe
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        return client
+
+    def open_sinks(self, suffix):
+        # Everything an uplink is decoded with and written to, besides the Graphite writer. Shared with
+        # AsyncCourseworkClient.
+        # Each device's fridge and PIR events are only sent to Graphite once, even across restarts and replays
+        self.activity = activity_store(self.config, suffix=suffix)
+
+        # Payloads are decoded by the codec for their device and port. Uplinks that can't be decoded are kept aside.
+        self.codecs = CodecRegistry.from_config(self.config)
+        self.dead_letters = dead_letter_log(self.config, suffix=suffix)
+
+        # The kitcheniot.* series are described once, so each uplink is serialised straight to Graphite JSON
+        self.schema = MetricSchema.from_config(self.config)
+        # With AGGREGATION enabled, only windowed roll-ups of the uplinks are sent
+        self.aggregator = Aggregator.from_config(self.schema, self.config)
+        # ALERTS rules are evaluated against every uplink, if there are any
+        self.alerts = AlertEngine.from_config(self.config, suffix=suffix)
+
+        # Uplinks are persisted to the binary SensorStore, unless the config asks for the legacy per-message CSV.
+        # Each shard writes its own files, so there's only ever one writer per file.
+        storage = self.config.get('STORAGE', {})
+        if storage.get('backend', 'binary') == 'csv':
+            self.store = None
+            self.csv_file = os.path.splitext(csv_file)[0] + suffix + '.csv'
+        else:
+            self.store = SensorStore(storage.get('path', store_dir) + suffix,
+                                     chunk_records=storage.get('chunk_records', 65536),
+                                     fsync_interval=storage.get('fsync_interval', 5.0))
+        # Every gateway's reception of each uplink, with running link-quality stats per device and gateway
+        self.radio = radio_log(self.config, suffix=suffix)
+
+    def run(self):
         # Start new threads for each broker
-        self.ttn_broker.loop_forever()
+        try:
+            self.ttn_broker.loop_forever()
+        finally:
+            self.pipeline.stop()
+            if self.aggregator is not None:
+                self.graphite.write(self.aggregator.flush())
+            self.graphite.close()
+            self.close_sinks()
+
+    def stop(self):
+        # Disconnects from the broker, after which run() returns once every queued uplink has been handled
+        self.ttn_broker.disconnect()
+
+    def close_sinks(self):
+        if self.alerts is not None:
+            self.alerts.close()
+        self.activity.close()
+        self.dead_letters.close()
+        if self.store is not None:
+            self.store.close()
+        if self.radio is not None:
+            self.radio.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
+    def metrics(self):
+        metrics = {
+            'received': self.received,
+            'skipped': self.skipped,
+            'dead_letters': self.dead_letters.count,
+            'pipeline': self.pipeline.metrics(),
+            'graphite': self.graphite.metrics(),
+        }
+        if self.aggregator is not None:
+            metrics['aggregator'] = self.aggregator.metrics()
+        if self.alerts is not None:
+            metrics['alerts'] = self.alerts.metrics()
+        if self.radio is not None:
+            metrics['radio'] = self.radio.metrics()
+        return metrics
 
     def on_subscribe(self, mosq, obj, mid, granted_qos):
-        print('----------------')
-        print("Subscribed: " + str(mid) + " " + str(granted_qos))
+        logger.info('Subscribed: %s %s', mid, granted_qos)
 
     def on_connect(self, client, userdata, flags, rc):
-        print('connected:', client._client_id)
+        logger.info('Connected: %s', client._client_id)
         client.subscribe(topic='[topic]', qos=2)
 
     def on_publish(self, client, userdata, mid):
-        print("Published")
+        logger.debug('Published %s', mid)
 
     def on_disconnect(self, client, userdata, rc):
         if rc != 0:
-            print("TTN MQTT connection lost. Will re-conect automatically")
+            logger.warning('TTN MQTT connection lost (rc %s). Will re-connect automatically', rc)
 
     def on_message(self, client, userdata, message):
-        print('----------------')
+        # Runs on the paho network loop thread, so must not block on the sinks
+        started = time.perf_counter()
         received_time = datetime.now().astimezone()
-        print('Message received at:', received_time)
-        print('topic:', message.topic)
-        print('message:', message.payload)
-        payload = KitchenSensorParser.parse_message(message, received_time)
-
-        print('Metadata:')
-        print('     Payload sent:', payload.time)
-        print('     RSSI:', payload.rssi)
-        print('     SNR:', payload.snr)
-        print('     Data rate:', payload.data_rate)
-        print('Sensor data:')
-        print('     Temperature:', payload.temperature)
-        print('     Humidity:', payload.humidity)
-        print('     LDR:', payload.ldr)
-        print('     PIR last triggered:', payload.PIR_triggered_time)
-        print('     Fridge last opened:', payload.fridge_opened_time)
-
-        # Send to grafana graphite
-        self.relay_to_grafana(payload)
-        print("Logging to CSV")
-        log_to_csv(payload)
+        if self.shards > 1 and not self.shared_subscription and shard_of(message.topic, self.shards) != self.shard:
+            # Another worker process owns this device
+            self.skipped += 1
+            return
+        self.received += 1
+        self.pipeline.stages[0].put(RawMessage(message.topic, message.payload, received_time))
+        ON_MESSAGE_SECONDS.observe(time.perf_counter() - started)
+
+    def process_message(self, message: RawMessage):
+        received_time = message.received_time
+        QUEUE_WAIT_SECONDS.observe(time.time() - received_time.timestamp())
+        started = time.perf_counter()
+        try:
+            payload = KitchenSensorParser.parse_message(message, received_time, self.codecs)
+        except Exception as e:
+            # Unknown port, or a malformed payload or envelope: set it aside rather than fail the stage
+            logger.warning('Undecodable uplink on %s, sent to dead letters: %r', message.topic, e)
+            self.dead_letters.write(message, repr(e))
+            return None
+        DECODE_SECONDS.observe(time.perf_counter() - started)
+        UPLINK_LAG_SECONDS.observe((received_time - payload.time).total_seconds())
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Uplink from %s sent %s, received %s: %s °C, %s%% humidity, LDR %s, RSSI %s, SNR %s, %s',
+                         payload.device_id, payload.time, received_time, payload.temperature, payload.humidity,
+                         payload.ldr, payload.rssi, payload.snr, payload.data_rate,
+                         extra={'topic': message.topic, 'device': payload.device_id, 'sent_time': payload.time,
+                                'received_time': received_time, 'rssi': payload.rssi, 'snr': payload.snr,
+                                'data_rate': payload.data_rate, 'temperature': payload.temperature,
+                                'humidity': payload.humidity, 'ldr': payload.ldr,
+                                'pir_triggered_time': payload.PIR_triggered_time,
+                                'fridge_opened_time': payload.fridge_opened_time})
+        return payload
 
     def relay_to_grafana(self, payload: KitchenData):
+        if self.aggregator is not None:
+            graphite_data = self.aggregator.add(payload, self.activity)
+        else:
+            graphite_data = self.schema.points(payload, self.activity)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Graphite data: %s', graphite_data)
+        self.graphite.write(graphite_data)
+
+    def store_payload(self, payload: KitchenData):
+        started = time.perf_counter()
+        if self.store is None:
+            log_to_csv(payload, self.csv_file)
+        else:
+            self.store.append(payload)
+        STORAGE_SECONDS.observe(time.perf_counter() - started)
+        if self.radio is not None:
+            self.radio.append(payload)
+
+
+def activity_store(config, suffix=''):
+    # ACTIVITY_STATE: none keeps the state in memory only
+    path = config.get('ACTIVITY_STATE', activity_file)
+    if path == 'none':
+        return ActivityTracker()
+    root, extension = os.path.splitext(path)
+    return EventStore(root + suffix + extension)
+
 
-        interval = 120
-        graphite_data = [
-            {
-                "name": "kitcheniot.meta.rssi",
-                "value": payload.rssi,
-                "interval": interval,
-                "unit": "rssi",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            },
-            {
-                "name": "kitcheniot.meta.snr",
-                "value": payload.snr,
-                "interval": interval,
-                "unit": "dB",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            },
-            {
-                "name": "kitcheniot.meta.data_rate",
-                "value": int(payload.data_rate),
-                "interval": interval,
-                "unit": "",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            },
-            {
-                "name": "kitcheniot.meta.payload_size",
-                "value": int(payload.payload_size),
-                "interval": interval,
-                "unit": "b",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge"
-            },
-            {
-                "name": "kitcheniot.sensor.temperature",
-                "value": payload.temperature,
-                "interval": interval,
-                "unit": "°C",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            },
-            {
-                "name": "kitcheniot.sensor.humidity",
-                "value": payload.humidity,
-                "interval": interval,
-                "unit": "%",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            },
-            {
-                "name": "kitcheniot.sensor.ldr",
-                "value": payload.ldr,
-                "interval": interval,
-                "unit": "",
-                "time": int(payload.time.timestamp()),
-                "mtype": "gauge",
-            }
-        ]
-
-        # Round fridge opened and PIR triggered time to nearest minute
-        fridge_opened_rounded = round_minute(payload.fridge_opened_time)
-        pir_triggered_rounded = round_minute(payload.PIR_triggered_time)
-        # Graphite histogram bins:
-        hist_bins = ['0000', '0030', '0100', '0130', '0200', '0230', '0300', '0330', '0400', '0430', '0500', '0530',
-                     '0600', '0630', '0700', '0730', '0800', '0830', '0900', '0930', '1000', '1030', '1100', '1130',
-                     '1200', '1230', '1300', '1330', '1400', '1430', '1500', '1530', '1600', '1630', '1700', '1730',
-                     '1800', '1830', '1900', '1930', '2000', '2030', '2100', '2130', '2200', '2230', '2300', '2330']
-
-        # Don't send duplicate timestamps
-        if fridge_opened_rounded != self.last_fridge_opened:
-            self.last_fridge_opened = fridge_opened_rounded
-            h = fridge_opened_rounded.hour
-            m = fridge_opened_rounded.minute
-            index = int((h * 60 + m) / 30)
-
-            graphite_data.append({
-                "name": "kitcheniot.activity.fridge",
-                "value": 1,
-                "interval": interval,
-                "unit": "",
-                "time": int(fridge_opened_rounded.timestamp()),
-                "mtype": "gauge",
-            })
-            graphite_data.append({
-                "name": "kitcheniot.activity.fridge.{}".format(hist_bins[index]),
-                "value": 1,
-                "interval": interval,
-                "unit": "",
-                "time": int(fridge_opened_rounded.timestamp()),
-                "mtype": "gauge",
-            })
-
-        if pir_triggered_rounded != self.last_PIR_triggered:
-            self.last_PIR_triggered = pir_triggered_rounded
-            h = pir_triggered_rounded.hour
-            m = pir_triggered_rounded.minute
-            index = int((h * 60 + m) / 30)
-            graphite_data.append({
-                "name": "kitcheniot.activity.pir",
-                "value": 1,
-                "interval": interval,
-                "unit": "",
-                "time": int(pir_triggered_rounded.timestamp()),
-                "mtype": "gauge",
-            })
-            graphite_data.append({
-                "name": "kitcheniot.activity.pir.{}".format(hist_bins[index]),
-                "value": 1,
-                "interval": interval,
-                "unit": "",
-                "time": int(pir_triggered_rounded.timestamp()),
-                "mtype": "gauge",
-            })
-
-        print("graphite data: ", graphite_data)
-
-        result = requests.post(self.config['GRAPHITE_URL'],
-                               auth=(self.config['GRAPHITE_USER'], self.config['GRAPHITE_API_KEY']), json=graphite_data)
-        if result.status_code != 200:
-            raise Exception(result.text)
-        print('%s: %s' % (result.status_code, result.text))
-
-
-def log_to_csv(payload: KitchenData):
+def dead_letter_log(config, suffix=''):
+    # DEAD_LETTERS: none only counts undecodable uplinks
+    path = config.get('DEAD_LETTERS', dead_letter_file)
+    if path == 'none':
+        return DiscardedLetters()
+    root, extension = os.path.splitext(path)
+    return DeadLetters(root + suffix + extension)
+
+
+def radio_log(config, suffix=''):
+    # RADIO: none keeps no record of the gateways that received each uplink
+    options = config.get('RADIO', {})
+    if options == 'none':
+        return None
+    return RadioLog(options.get('path', radio_dir) + suffix, chunk_rows=options.get('chunk_rows', 65536),
+                    flush_interval=options.get('flush_interval', 5.0))
+
+
+def spool_from_config(config, suffix=''):
+    # GRAPHITE_SPOOL: none holds unsent points in memory only (bounded, dropping the oldest)
+    spooling = config.get('GRAPHITE_SPOOL', {})
+    if spooling == 'none':
+        return None
+    return Spool(spooling.get('path', spool_dir) + suffix, segment_bytes=spooling.get('segment_mb', 4) * 1024 * 1024,
+                 max_bytes=spooling.get('max_mb', 1024) * 1024 * 1024,
+                 fsync_interval=spooling.get('fsync_interval', 5.0))
+
+
+def graphite_writer(config, suffix='', background=True, spooled=True):
+    batching = config.get('GRAPHITE_BATCH', {})
+    spool = spool_from_config(config, suffix) if spooled else None
+    return GraphiteWriter(config['GRAPHITE_URL'], config['GRAPHITE_USER'], config['GRAPHITE_API_KEY'],
+                          max_points=batching.get('max_points', 500),
+                          flush_interval_ms=batching.get('flush_interval_ms', 1000),
+                          pool_size=batching.get('pool_size', 4),
+                          background=background, spool=spool)
+
+
+def metrics_endpoint(client: CourseworkClient, config):
+    # METRICS_ENDPOINT: none serves no metrics. Shards serve on consecutive ports.
+    options = config.get('METRICS_ENDPOINT', 'none')
+    if options == 'none':
+        return None
+    REGISTRY.callback('kitcheniot_received_total', 'Uplinks received from the broker', lambda: client.received,
+                      type='counter')
+    REGISTRY.callback('kitcheniot_skipped_total', 'Uplinks left to another shard', lambda: client.skipped,
+                      type='counter')
+    REGISTRY.callback('kitcheniot_dead_letters_total', 'Uplinks that could not be decoded',
+                      lambda: client.dead_letters.count, type='counter')
+    for key, help in (('depth', 'Uplinks queued in each pipeline stage'),
+                      ('spill_depth', 'Uplinks spilled to disk by each pipeline stage')):
+        REGISTRY.callback('kitcheniot_pipeline_' + key, help, partial(stage_metric, client, key),
+                          label='stage')
+    for key, help in (('processed', 'Items handled by each pipeline stage'),
+                      ('dropped', 'Items dropped by each pipeline stage'),
+                      ('errors', 'Items each pipeline stage failed on')):
+        REGISTRY.callback('kitcheniot_pipeline_{}_total'.format(key), help,
+                          partial(stage_metric, client, key), type='counter', label='stage')
+    if client.radio is not None:
+        REGISTRY.callback('kitcheniot_radio_receptions_total', 'Gateway receptions of uplinks',
+                          lambda: client.radio.metrics()['receptions'], type='counter')
+        REGISTRY.callback('kitcheniot_radio_frames_lost_total', 'Uplinks missing from the devices\' frame counters',
+                          lambda: client.radio.metrics()['lost'], type='counter')
+    REGISTRY.callback('kitcheniot_graphite_pending_points', 'Points waiting to be sent to Graphite',
+                      client.graphite.pending)
+    REGISTRY.callback('kitcheniot_graphite_sent_points_total', 'Points sent to Graphite',
+                      lambda: client.graphite.sent, type='counter')
+    server = MetricsServer(REGISTRY, host=options.get('host', '127.0.0.1'),
+                           port=options.get('port', 9108) + client.shard, profiler=options.get('profiler', False))
+    logger.info('Serving metrics on http://%s:%s/metrics', server.host, server.port)
+    return server
+
+
+def stage_metric(client: CourseworkClient, key):
+    return {name: metrics[key] for name, metrics in client.metrics()['pipeline'].items()}
+
+
+def build_pipeline(client: CourseworkClient, config):
+    # Each stage can be tuned from the PIPELINE section of the config, e.g.
+    #   PIPELINE:
+    #     graphite: {concurrency: 2, maxsize: 5000, policy: spill}
+    # Spill files are kept in spill_dir (by default the working directory) under a name that's the same every run,
+    # so anything still spilled when the client stops is handled by the next run
+    pipeline = Pipeline(report_interval=config.get('report_interval'),
+                        spill_suffix='' if client.shards == 1 else '-{}'.format(client.shard))
+    spill_dir = config.get('spill_dir', os.getcwd())
+
+    def stage_options(name):
+        options = config.get(name, {})
+        return dict(concurrency=options.get('concurrency', 1),
+                    maxsize=options.get('maxsize', 1000),
+                    policy=options.get('policy', BLOCK),
+                    spill_dir=spill_dir)
+
+    parse = pipeline.add_stage('parse', client.process_message, **stage_options('parse'))
+    # Storage is appended to from a single writer so records can't interleave
+    storage_options = stage_options('storage')
+    storage_options['concurrency'] = 1
+    # Each device's uplinks go to one Graphite worker, so its events are recorded as sent in order. Otherwise an older
+    # uplink handled after a newer one would have its fridge/PIR event taken as already sent.
+    parse.connect(pipeline.add_stage('graphite', client.relay_to_grafana, partition=device_of,
+                                     **stage_options('graphite')))
+    parse.connect(pipeline.add_stage('storage', client.store_payload, **storage_options))
+    if client.alerts is not None:
+        # Rules keep per-device state that depends on uplink order, so they're evaluated by a single thread
+        alert_options = stage_options('alerts')
+        alert_options['concurrency'] = 1
+        parse.connect(pipeline.add_stage('alerts', client.alerts.evaluate, **alert_options))
+    return pipeline
+
+
+def device_of(payload: KitchenData):
+    return payload.device_id
+
+
+def log_to_csv(payload: KitchenData, csv_file=csv_file):
     if os.path.isfile(csv_file):
         # CSV exists, append to end of file
         with open(csv_file, 'a', encoding="utf-8", newline='') as sensor_file:
@@ -222,13 +384,15 @@ def log_to_csv(payload: KitchenData):
                              payload.PIR_triggered_time,
                              payload.sec_since_fridge,
                              payload.fridge_opened_time,
-                             payload.payload_size])
+                             payload.payload_size,
+                             payload.device_id])
     else:
         # CSV does not exist. Write the headings
         with open(csv_file, 'w', encoding="utf-8", newline='') as sensor_file:
             writer = csv.writer(sensor_file)
             writer.writerow(['sent_time', 'received_time', 'rssi', 'snr', 'data_rate', 'temperature', 'humidity', 'ldr',
-                             'sec_since_pir', 'PIR_triggered_time', 'sec_since_fridge', 'fridge_opened_time', 'payload_size'])
+                             'sec_since_pir', 'PIR_triggered_time', 'sec_since_fridge', 'fridge_opened_time', 'payload_size',
+                             'device_id'])
             writer.writerow([payload.time,
                              payload.received_time,
                              payload.rssi,
@@ -241,20 +405,15 @@ def log_to_csv(payload: KitchenData):
                              payload.PIR_triggered_time,
                              payload.sec_since_fridge,
                              payload.fridge_opened_time,
-                             payload.payload_size])
+                             payload.payload_size,
+                             payload.device_id])
 
 
 def replay_csv(client: CourseworkClient):
-    with open(csv_file, 'r', encoding='utf-8') as past_data:
-        reader = csv.reader(past_data, delimiter=',')
-        next(reader)  # Skip first row containing headings
-        for row in reader:
-            parsed = KitchenSensorParser.parse_csv_row(row)
-            client.relay_to_grafana(parsed)
-            time.sleep(0.1)  # Leave a small delay so we don't spam Graphite
-
-
-def round_minute(date_time):
-    # Rounds to nearest minute by adding a timedelta if seconds>=30
-    return (date_time.replace(second=0, microsecond=0, minute=date_time.minute)
-            + timedelta(minutes=date_time.second // 30))
+    from coursework.Replay import Replayer
+    Replayer(client.graphite, client.schema, client.activity).replay(csv_file)
+
+
+def shard_of(topic, shards):
+    # Topics look like <app_id>/devices/<dev_id>/up. crc32 rather than hash() so every process agrees.
+    return zlib.crc32(topic.split('/')[2].encode()) % shards
@@ -0,0 +1,49 @@
+import base64
+import json
+import os
+import threading
+
+
+class DeadLetters:
+    # Uplinks that couldn't be decoded (unknown port, malformed payload or envelope), kept as JSON lines so they
+    # can be inspected or re-processed once a codec for them exists. The file is rotated to <path>.1 at max_bytes.
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.count = 0
+
+    def write(self, message, reason):
+        letter = json.dumps({
+            'topic': message.topic,
+            'received_time': message.received_time.isoformat() if message.received_time else None,
+            'reason': reason,
+            'payload': base64.b64encode(message.payload).decode('ascii'),
+        })
+        with self.lock:
+            self.count += 1
+            self.file.write(letter + '\n')
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.file.close()
+                os.replace(self.path, self.path + '.1')
+                self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class DiscardedLetters:
+    # DEAD_LETTERS: none only counts undecodable uplinks
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, message, reason):
+        self.count += 1
+
+    def close(self):
+        pass
@@ -0,0 +1,184 @@
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'KIOTEVT2'
+HEADER = struct.Struct('<8sI')  # magic, number of slots in use
+# One slot per device and (UTC) day with events: device ID, days since the epoch, then a bitmap of the minutes of that
+# day in which a fridge opening was sent, and one of those in which a PIR trigger was sent
+SLOT = struct.Struct('<64si180s180s')
+BITMAPS = struct.calcsize('<64si')
+MINUTE_BYTES = 24 * 60 // 8
+
+
+class ActivityTracker:
+    # Remembers which (rounded) fridge openings and PIR triggers have been sent for each device, so each event is
+    # only sent to Graphite once, however out of order the uplinks reporting it arrive. Times are epoch seconds, or
+    # None if the uplink didn't report that event.
+    # In memory only; EventStore is the persistent equivalent.
+
+    def __init__(self):
+        self.events = set()  # (device, kind index, event time)
+        self.lock = threading.Lock()
+
+    def update(self, device_id, fridge, pir):
+        # Marks the events as sent, returning whether each one is new
+        with self.lock:
+            new = tuple(event is not None and (device_id, kind, event) not in self.events
+                        for kind, event in enumerate((fridge, pir)))
+            for kind, event in enumerate((fridge, pir)):
+                if event is not None:
+                    self.events.add((device_id, kind, event))
+        return new
+
+    def sent(self, device_id, fridge, pir):
+        # Whether each event has been sent, without marking them
+        with self.lock:
+            return tuple(event is not None and (device_id, kind, event) in self.events
+                         for kind, event in enumerate((fridge, pir)))
+
+    def close(self):
+        pass
+
+
+class EventStore:
+    # Persistent per-device activity state: a memory-mapped table of fixed-width slots, each a device's sent events
+    # of one day as a bitmap of minutes, with an in-memory (device, day) -> slot index for O(1) lookups. Updates are
+    # writes into the shared mapping, so they survive the process being killed and are seen by the next run (or a
+    # replay), which then won't re-send those events. Any minute not marked is sent, so replaying an older range
+    # after a newer one (or backfilling behind the live client) still sends its events once.
+    # Several processes can share the file (a replay runs alongside the live client): updates hold an flock on it,
+    # and slots allocated or table growth by another process are picked up from the header under that lock.
+
+    def __init__(self, path, capacity=256):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as state_file:
+                state_file.write(HEADER.pack(MAGIC, 0))
+                state_file.truncate(HEADER.size + capacity * SLOT.size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not an activity state file of this version'.format(path))
+        self.capacity = (len(self.map) - HEADER.size) // SLOT.size
+        self.slots = {}  # (device, day) -> slot
+        self.used = 0
+        self._refresh()
+
+    def update(self, device_id, fridge, pir):
+        # Marks the events as sent, returning whether each one is new
+        device = (device_id or '').encode('utf-8')[:64]
+        new = []
+        with self.lock, self._file_locked():
+            for kind, event in enumerate((fridge, pir)):
+                if event is None:
+                    new.append(False)
+                    continue
+                offset, bit = self._bit(device, kind, event, allocate=True)
+                new.append(not self.map[offset] & bit)
+                self.map[offset] |= bit
+        return tuple(new)
+
+    def sent(self, device_id, fridge, pir):
+        # Whether each event has been sent, without marking them
+        device = (device_id or '').encode('utf-8')[:64]
+        sent = []
+        with self.lock, self._file_locked():
+            for kind, event in enumerate((fridge, pir)):
+                found = None if event is None else self._bit(device, kind, event, allocate=False)
+                sent.append(found is not None and bool(self.map[found[0]] & found[1]))
+        return tuple(sent)
+
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+    @contextlib.contextmanager
+    def _file_locked(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def _bit(self, device, kind, event, allocate):
+        # (byte offset, mask) of the event's minute in the bitmap of its kind, or None if its day has no slot yet
+        day, seconds = divmod(event, 86400)
+        slot = self.slots.get((device, day))
+        if slot is None:
+            self._refresh()
+            slot = self.slots.get((device, day))
+        if slot is None:
+            if not allocate:
+                return None
+            slot = self._allocate(device, day)
+        minute = seconds // 60
+        return HEADER.size + slot * SLOT.size + BITMAPS + kind * MINUTE_BYTES + minute // 8, 1 << minute % 8
+
+    def _refresh(self):
+        # With the file locked: remap if another process has grown the table, and index the slots it allocated
+        if os.fstat(self.file.fileno()).st_size != len(self.map):
+            self._remap()
+        _, used = HEADER.unpack_from(self.map, 0)
+        for slot in range(self.used, used):
+            device, day = SLOT.unpack_from(self.map, HEADER.size + slot * SLOT.size)[:2]
+            self.slots[(device.rstrip(b'\0'), day)] = slot
+        self.used = used
+
+    def _remap(self):
+        self.map.flush()
+        self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.capacity = (len(self.map) - HEADER.size) // SLOT.size
+
+    def _allocate(self, device, day):
+        # With the file locked and refreshed, so self.used is the file's
+        if self.used == self.capacity:
+            # Double the table. Other processes keep their smaller mapping, which stays valid, until they refresh.
+            self.file.truncate(HEADER.size + self.capacity * 2 * SLOT.size)
+            self._remap()
+        slot = self.used
+        SLOT.pack_into(self.map, HEADER.size + slot * SLOT.size, device, day, b'', b'')
+        self.used += 1
+        HEADER.pack_into(self.map, 0, MAGIC, self.used)
+        self.slots[(device, day)] = slot
+        return slot
+
+
+class PendingEvents:
+    # Fridge and PIR events about to be sent, which stands in for the activity store in MetricSchema.events: an
+    # event is new if the store hasn't sent it and it isn't pending already. Pending events are only recorded in the
+    # store by commit(), once the points carrying them have been sent, so after a crash in between they are sent
+    # again instead of being lost.
+    __slots__ = ('store', 'events')
+
+    def __init__(self, store):
+        self.store = store
+        self.events = {}  # device -> set of pending (kind index, event time)
+
+    def update(self, device_id, fridge, pir):
+        pending = self.events.get(device_id, ())
+        sent = self.store.sent(device_id, fridge, pir)
+        new = tuple(event is not None and not was_sent and (kind, event) not in pending
+                    for kind, (event, was_sent) in enumerate(zip((fridge, pir), sent)))
+        if any(new):
+            self.events.setdefault(device_id, set()).update(
+                (kind, event) for kind, event in enumerate((fridge, pir)) if new[kind])
+        return new
+
+    def commit(self, devices=None):
+        # Records the pending events of these devices (all of them by default) as sent
+        for device in list(self.events) if devices is None else devices:
+            for kind, event in self.events.pop(device, ()):
+                self.store.update(device, *((event, None) if kind == 0 else (None, event)))
@@ -0,0 +1,129 @@
+import json
+import pickle
+import struct
+from coursework.KitchenSensor import KitchenData
+
+# key: (default name under the prefix, unit, value getter)
+GAUGES = {
+    'rssi': ('meta.rssi', 'rssi', lambda payload: payload.rssi),
+    'snr': ('meta.snr', 'dB', lambda payload: payload.snr),
+    'data_rate': ('meta.data_rate', '', lambda payload: int(payload.data_rate)),
+    'payload_size': ('meta.payload_size', 'b', lambda payload: int(payload.payload_size)),
+    'temperature': ('sensor.temperature', '°C', lambda payload: payload.temperature),
+    'humidity': ('sensor.humidity', '%', lambda payload: payload.humidity),
+    'ldr': ('sensor.ldr', '', lambda payload: payload.ldr),
+}
+# Activity events are sent as a count, plus a count in the event's time-of-day histogram bin ({bin} is e.g. 1330)
+ACTIVITY = {
+    'fridge': 'activity.fridge',
+    'fridge_histogram': 'activity.fridge.{bin}',
+    'pir': 'activity.pir',
+    'pir_histogram': 'activity.pir.{bin}',
+}
+
+
+def round_minute(epoch):
+    return (epoch + 30) // 60 * 60
+
+
+class MetricSchema:
+    # Describes the kitcheniot.* series once. Everything static about a point (name, unit, interval, type) is
+    # pre-rendered as a JSON fragment, so serialising an uplink only formats its values and timestamps.
+    # Names can be overridden per key, and may contain {device} to split series per device.
+
+    def __init__(self, prefix='kitcheniot', interval=120, histogram_bin_minutes=30, names=None):
+        if (24 * 60) % histogram_bin_minutes:
+            raise ValueError('histogram_bin_minutes must divide a day evenly, got {}'.format(histogram_bin_minutes))
+        self.interval = interval
+        self.bin_minutes = histogram_bin_minutes
+        self.bins = ['{:02d}{:02d}'.format(*divmod(start, 60)) for start in range(0, 24 * 60, histogram_bin_minutes)]
+        self.names = {key: '{}.{}'.format(prefix, name) for key, (name, _, _) in GAUGES.items()}
+        self.names.update({key: '{}.{}'.format(prefix, name) for key, name in ACTIVITY.items()})
+        self.names.update(names or {})
+        self.getters = [(key, getter) for key, (_, _, getter) in GAUGES.items()]
+        self.per_device = any('{device}' in name for name in self.names.values())
+        self.templates = {}  # device -> pre-rendered names and JSON prefixes
+
+    @classmethod
+    def from_config(cls, config):
+        metrics = config.get('METRICS', {})
+        return cls(prefix=metrics.get('prefix', 'kitcheniot'), interval=metrics.get('interval', 120),
+                   histogram_bin_minutes=metrics.get('histogram_bin_minutes', 30), names=metrics.get('names'))
+
+    def json_prefix(self, name, unit='', interval=None):
+        return '{{"name": {}, "interval": {}, "unit": {}, "mtype": "gauge", "value": '.format(
+            json.dumps(name), interval or self.interval, json.dumps(unit))
+
+    def template(self, device_id):
+        template = self.templates.get(device_id if self.per_device else None)
+        if template is not None:
+            return template
+        names = {key: name.replace('{device}', device_id or 'unknown') for key, name in self.names.items()}
+        gauges = [(names[key], self.json_prefix(names[key], GAUGES[key][1]), getter) for key, getter in self.getters]
+        activity = {}
+        for kind in ('fridge', 'pir'):
+            histogram = [names[kind + '_histogram'].replace('{bin}', label) for label in self.bins]
+            activity[kind] = (names[kind], self.json_prefix(names[kind]),
+                              histogram, [self.json_prefix(name) for name in histogram])
+        template = self.templates[device_id if self.per_device else None] = (gauges, activity)
+        return template
+
+    def samples(self, payload: KitchenData, activity):
+        # (name, value, epoch seconds) for every point of the uplink. Updates `activity`, so call once per uplink.
+        gauges, activity_templates = self.template(payload.device_id)
+        time = int(payload.time.timestamp())
+        samples = [(name, getter(payload), time) for name, _, getter in gauges]
+        for kind, bin_index, _, event_time in self.events(payload, activity):
+            name, _, histogram, _ = activity_templates[kind]
+            samples.append((name, 1, event_time))
+            samples.append((histogram[bin_index], 1, event_time))
+        return samples
+
+    def points(self, payload: KitchenData, activity):
+        # Graphite JSON for each point of the uplink, as fragments ready to be joined into a POST body
+        gauges, activity_templates = self.template(payload.device_id)
+        time = ', "time": {}}}'.format(int(payload.time.timestamp()))
+        points = [prefix + repr(getter(payload)) + time for _, prefix, getter in gauges]
+        for kind, bin_index, _, event_time in self.events(payload, activity):
+            _, prefix, _, histogram = activity_templates[kind]
+            event = '1, "time": {}}}'.format(event_time)
+            points.append(prefix + event)
+            points.append(histogram[bin_index] + event)
+        return points
+
+    def to_json(self, payload: KitchenData, activity):
+        return '[' + ', '.join(self.points(payload, activity)) + ']'
+
+    def to_plaintext(self, payload: KitchenData, activity):
+        # Carbon plaintext protocol: one "name value timestamp" line per point
+        return ''.join('{} {} {}\n'.format(name, value, time)
+                       for name, value, time in self.samples(payload, activity)).encode()
+
+    def to_pickle(self, payload: KitchenData, activity):
+        # Carbon pickle protocol: a length-prefixed pickled list of (name, (timestamp, value))
+        body = pickle.dumps([(name, (time, value)) for name, value, time in self.samples(payload, activity)],
+                            protocol=2)
+        return struct.pack('!L', len(body)) + body
+
+    def events(self, payload, activity):
+        # Fridge and PIR events rounded to the nearest minute, which haven't been sent for this device before, as
+        # (kind, histogram bin index, start of that bin as epoch seconds, event time as epoch seconds)
+        fridge = pir = None
+        if payload.fridge_opened_time is not None:
+            fridge = round_minute(int(payload.fridge_opened_time.timestamp()))
+        if payload.PIR_triggered_time is not None:
+            pir = round_minute(int(payload.PIR_triggered_time.timestamp()))
+        fridge_new, pir_new = activity.update(payload.device_id, fridge, pir)
+        events = []
+        if fridge_new:
+            events.append(('fridge', *self._bin(payload.fridge_opened_time, fridge), fridge))
+        if pir_new:
+            events.append(('pir', *self._bin(payload.PIR_triggered_time, pir), pir))
+        return events
+
+    def _bin(self, event_time, rounded_epoch):
+        # Histogram bins are by local time of day, as in the event's own timezone. Returns (bin index, bin start).
+        offset = event_time.utcoffset()
+        seconds = rounded_epoch + (int(offset.total_seconds()) if offset else 0)
+        into_bin = seconds % (self.bin_minutes * 60)
+        return (seconds // 60 % (24 * 60)) // self.bin_minutes, rounded_epoch - into_bin
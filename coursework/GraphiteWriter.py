@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from coursework.Instrumentation import REGISTRY
+
+logger = logging.getLogger(__name__)
+POST_SECONDS = REGISTRY.histogram('kitcheniot_graphite_post_seconds', 'Time of each Graphite POST, failed or not')
+POST_FAILURES = REGISTRY.counter('kitcheniot_graphite_post_failures_total', 'Graphite POSTs that failed')
+
+
+class GraphiteWriter:
+
+    def __init__(self, url, user, api_key, max_points=500, flush_interval_ms=1000, pool_size=4,
+                 max_buffer=100000, backoff=0.5, max_backoff=60, timeout=10, background=True, spool=None):
+        self.url = url
+        self.max_points = max_points
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_buffer = max_buffer
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        # One session for the lifetime of the writer, so the TLS connection is kept alive between POSTs
+        self.session = requests.Session()
+        self.session.auth = (user, api_key)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # With a Spool, points wait on disk instead of in the buffer, so an outage of any length neither loses
+        # them nor grows memory. Without one, at most max_buffer points are held in memory.
+        self.spool = spool
+        self.buffer = []
+        self.condition = threading.Condition()
+        self.retry_delay = 0
+        self.closed = False
+
+        # Metrics
+        self.sent = 0
+        self.dropped = 0
+        self.requests = 0
+        self.failures = 0
+
+        # Without the background flusher the caller decides when to flush, e.g. replay checkpoints after each flush
+        self.flusher = None
+        if background:
+            self.flusher = threading.Thread(target=self._run, name='graphite-writer', daemon=True)
+            self.flusher.start()
+
+    def write(self, points):
+        # points are Graphite JSON objects, as strings
+        with self.condition:
+            if self.spool is not None:
+                self.spool.append(points)
+                if self.spool.pending() >= self.max_points and self.flusher is not None:
+                    self.condition.notify()
+                return
+            self.buffer.extend(points)
+            overflow = len(self.buffer) - self.max_buffer
+            if overflow > 0:
+                # Bound memory during long outages by dropping the oldest points
+                del self.buffer[:overflow]
+                self.dropped += overflow
+            if len(self.buffer) >= self.max_points and self.flusher is not None:
+                self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return self._pending()
+
+    def flush(self):
+        # Send everything buffered right now. Returns False if a POST failed, leaving the unsent points buffered.
+        if self.spool is not None:
+            return self._drain()
+        while True:
+            with self.condition:
+                batch = self.buffer[:self.max_points]
+                del self.buffer[:self.max_points]
+            if not batch:
+                return True
+            if not self._post(batch):
+                with self.condition:
+                    self.buffer[:0] = batch
+                return False
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.flusher is not None:
+            self.flusher.join(timeout)
+        self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def metrics(self):
+        with self.condition:
+            metrics = {
+                'pending': self._pending(),
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'requests': self.requests,
+                'failures': self.failures,
+            }
+        if self.spool is not None:
+            metrics['dropped'] += self.spool.dropped
+            metrics['spool'] = self.spool.metrics()
+        return metrics
+
+    def _pending(self):
+        return self.spool.pending() if self.spool is not None else len(self.buffer)
+
+    def _drain(self):
+        # Send spooled points oldest first, as fast as Graphite accepts them, acknowledging each batch once sent
+        while True:
+            batch, position = self.spool.read(self.max_points)
+            if not batch:
+                return True
+            if not self._post(batch):
+                return False
+            self.spool.ack(position)
+
+    def _post(self, batch):
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            # Points arrive already serialised as JSON objects (see MetricSchema.points), so just join them
+            body = ('[' + ','.join(batch) + ']').encode('utf-8')
+            result = self.session.post(self.url, data=body, headers={'Content-Type': 'application/json'},
+                                       timeout=self.timeout)
+            ok = result.status_code == 200
+            error = result.text
+        except requests.RequestException as e:
+            ok = False
+            error = e
+        POST_SECONDS.observe(time.perf_counter() - started)
+
+        if ok:
+            self.sent += len(batch)
+            self.retry_delay = 0
+        else:
+            self.failures += 1
+            # Exponential backoff between attempts while Graphite is unhealthy
+            self.retry_delay = min(max(self.retry_delay * 2, self.backoff), self.max_backoff)
+            POST_FAILURES.inc()
+            logger.warning('Graphite POST of %s points failed, retrying in %ss: %s', len(batch), self.retry_delay, error)
+        return ok
+
+    def _run(self):
+        while True:
+            with self.condition:
+                deadline = time.monotonic() + max(self.flush_interval, self.retry_delay)
+                while not self.closed and (self._pending() < self.max_points or self.retry_delay):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                closed = self.closed
+            if not self.flush() and closed:
+                logger.warning('Graphite writer closed with %s unsent points', self.pending())
+                return
+            if closed:
+                return
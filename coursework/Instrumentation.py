@@ -0,0 +1,238 @@
+import bisect
+import collections
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Latency buckets in seconds, from 50us to 10s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name),
+                '{} {}'.format(self.name, self.value)]
+
+
+class Histogram:
+    # Cumulative-bucket histogram, as Prometheus expects. observe() is a binary search and two additions.
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[slot] += 1
+            self.sum += value
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th quantile, a rough reading for logs and tests
+        with self.lock:
+            counts = list(self.counts)
+        target = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.bounds + [float('inf')], counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+    def render(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.bounds + ['+Inf'], counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_sum {}'.format(self.name, total))
+        lines.append('{}_count {}'.format(self.name, cumulative))
+        return lines
+
+
+class Callback:
+    # A gauge or counter read from existing state when scraped, e.g. queue depths. function returns a number, or
+    # a dict of {label value: number} which is rendered with the label name `label`.
+
+    def __init__(self, name, help, function, type='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+        self.label = label
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        value = self.function()
+        if isinstance(value, dict):
+            lines.extend('{}{{{}="{}"}} {}'.format(self.name, self.label, key, item) for key, item in value.items())
+        else:
+            lines.append('{} {}'.format(self.name, value))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def callback(self, name, help, function, type='gauge', label=None):
+        # Re-registering replaces the callback, e.g. when a client is recreated in the same process
+        with self.lock:
+            self.metrics[name] = Callback(name, help, function, type, label)
+            return self.metrics[name]
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning('Could not read metric %s: %r', metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+
+REGISTRY = Registry()
+logger = logging.getLogger(__name__)
+
+
+def sample_stacks(seconds, interval=0.005):
+    # Sampling profiler: every `interval`, records where each thread is, for `seconds`. Returns collapsed stacks
+    # ("thread;outer;...;inner count" per line, as flamegraph.pl and speedscope read), most frequent first.
+    # Nothing runs until it is asked for, so it can be left enabled in production.
+    me = threading.get_ident()
+    names = {}
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if len(names) != threading.active_count():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, code.co_filename.rsplit('/', 1)[-1],
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+class MetricsServer:
+    # Local HTTP endpoint: /metrics in the Prometheus text format, and (if enabled) /profile?seconds=10 for a
+    # sampling profile of the running process
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9108, profiler=False):
+        self.registry = registry
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    self._respond(200, 'text/plain; version=0.0.4', server.registry.render())
+                elif url.path == '/profile' and profiler:
+                    query = parse_qs(url.query)
+                    try:
+                        seconds = float(query.get('seconds', ['10'])[0])
+                        interval = float(query.get('interval', ['0.005'])[0])
+                    except ValueError:
+                        seconds = interval = math.nan
+                    if not (0 < seconds <= 300 and 0 < interval <= seconds):
+                        self._respond(400, 'text/plain', 'seconds must be a number in (0, 300], and interval a '
+                                                         'positive number no larger than it\n')
+                        return
+                    self._respond(200, 'text/plain', sample_stacks(seconds, max(interval, 0.001)))
+                else:
+                    self._respond(404, 'text/plain', 'Not found\n')
+
+            def _respond(self, status, content_type, body):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, including any `extra` fields passed to the logging call
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(config):
+    # LOGGING: {level: INFO, format: text|json}
+    options = config.get('LOGGING', {})
+    handler = logging.StreamHandler()
+    if options.get('format', 'text') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(options.get('level', 'INFO'))
@@ -1,9 +1,81 @@
-import base64
+import binascii
+import collections
 import json
+import logging
+import operator
+import re
 from dataclasses import dataclass
+from functools import lru_cache
 from dateutil import parser
-from datetime import datetime, timedelta
-from pb import SensorPayload_pb2
+from datetime import datetime, timedelta, timezone
+from coursework.Codecs import DEFAULT_CODECS
+
+# orjson parses the TTN envelopes several times faster than json, so use it where it's installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+# TTN metadata times, e.g. 2021-01-20T14:33:03.123456789Z. Older Pythons' fromisoformat can't read these.
+ISO_TIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?(Z|[+-]\d\d:?\d\d)?$')
+
+
+def parse_timestamp(text):
+    # Our CSV output and TTN both use fixed ISO-8601 layouts, so only fall back to dateutil for anything else
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    match = ISO_TIME.match(text)
+    if match is None:
+        return parser.parse(text)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    if offset is None:
+        tz = None
+    elif offset == 'Z':
+        tz = timezone.utc
+    else:
+        sign = -1 if offset[0] == '-' else 1
+        tz = timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:])))
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tz)
+
+
+# TTN data rates look like SF7BW125: spreading factor and bandwidth (kHz). Our own stores write a bare spreading
+# factor when the bandwidth isn't known.
+DATA_RATE = re.compile(r'SF(\d+)BW(\d+)$')
+
+
+@lru_cache(maxsize=64)
+def parse_data_rate(data_rate_raw):
+    # (spreading factor, bandwidth kHz, or 0 if unknown)
+    match = DATA_RATE.match(data_rate_raw)
+    if match is None:
+        return int(data_rate_raw), 0
+    return int(match.group(1)), int(match.group(2))
+
+
+def spreading_factor(data_rate_raw):
+    return parse_data_rate(data_rate_raw)[0]
+
+
+# Everything TTN reports about how an uplink was received, besides the first gateway's RSSI/SNR which KitchenData
+# has always carried. receptions has one Reception per gateway that heard the uplink, strongest SNR first.
+RadioMetadata = collections.namedtuple('RadioMetadata', 'counter frequency coding_rate receptions')
+Reception = collections.namedtuple('Reception', 'gateway rssi snr channel')
+RECEPTION_SNR = operator.attrgetter('snr')
+
+
+# How CSV rows spell a missing value
+MISSING = ('', 'None')
+
+
+@lru_cache(maxsize=4096)
+def parse_repeated_timestamp(text):
+    # PIR and fridge times stay the same across many consecutive rows, so are worth memoizing
+    return parse_timestamp(text)
 
 
 @dataclass
@@ -22,75 +94,74 @@ class KitchenData:
     sec_since_fridge: int
     fridge_opened_time: datetime
     payload_size: int
+    device_id: str = None
+    # Only for uplinks parsed from a TTN envelope, not ones read back from storage
+    radio: RadioMetadata = None
 
 
 class KitchenSensorParser:
 
     @staticmethod
     def parse_csv_row(row):
-        received_time = parser.parse(row[1])
-        time = parser.parse(row[0])
+        received_time = parse_timestamp(row[1])
+        time = parse_timestamp(row[0])
         rssi = int(row[2])
         snr = float(row[3])
         data_rate_raw = row[4]
-        data_rate = int(''.join(filter(str.isdigit, data_rate_raw)))
+        data_rate = spreading_factor(data_rate_raw)
         temperature = float(row[5])
         humidity = int(row[6])
         ldr = int(row[7])
-        sec_since_pir = int(row[8])
-        PIR_triggered_time = parser.parse(row[9])
-        sec_since_fridge = int(row[10])
-        fridge_opened_time = parser.parse(row[11])
+        # No PIR or fridge activity yet is written as an empty field (or None, by older versions)
+        sec_since_pir = None if row[8] in MISSING else int(row[8])
+        PIR_triggered_time = None if row[9] in MISSING else parse_repeated_timestamp(row[9])
+        sec_since_fridge = None if row[10] in MISSING else int(row[10])
+        fridge_opened_time = None if row[11] in MISSING else parse_repeated_timestamp(row[11])
         # When I first started collecting data, I did not store the payload size metadata
         try:
             payload_size = row[12]
         except IndexError:
             payload_size = 0
-        return KitchenData(time, received_time, rssi, snr, data_rate_raw, data_rate, temperature, humidity, ldr, sec_since_pir, PIR_triggered_time, sec_since_fridge, fridge_opened_time, payload_size)
+        # Nor the device ID, before there was more than one sensor
+        device_id = row[13] if len(row) > 13 and row[13] else None
+        return KitchenData(time, received_time, rssi, snr, data_rate_raw, data_rate, temperature, humidity, ldr, sec_since_pir, PIR_triggered_time, sec_since_fridge, fridge_opened_time, payload_size, device_id)
 
     @staticmethod
-    def parse_message(message, received_time):
-        payload_dict = json.loads(message.payload)
+    def parse_message(message, received_time, codecs=DEFAULT_CODECS):
+        # The payload is decoded by the codec registered for the device and port (see Codecs.CodecRegistry).
+        # Raises UndecodablePayload for ports without one.
+        payload_dict = json_loads(message.payload)
         received_time = received_time
+        # Topics look like <app_id>/devices/<dev_id>/up
+        device_id = message.topic.split('/')[2]
         # Get metadata
-        time = parser.parse(payload_dict['metadata']['time'])
-        rssi = payload_dict['metadata']['gateways'][0]['rssi']
-        snr = payload_dict['metadata']['gateways'][0]['snr']
-        data_rate_raw = payload_dict['metadata']['data_rate']
-        data_rate = int(''.join(filter(str.isdigit, data_rate_raw)))
-
-        if payload_dict['port'] == 3:
-            # Decode protocol buffer payload
-            payload_hex = base64.b64decode(payload_dict['payload_raw'])
-            payload_size = len(payload_hex)
-            sensor_payload = SensorPayload_pb2.SensorPayload()
-            sensor_payload.ParseFromString(payload_hex)
-
-            # Prepare sensor data
-            temperature = sensor_payload.temperature / 100
-            humidity = sensor_payload.humidity
-            ldr = sensor_payload.ldr
-
-
-            payload_fields = set([field.name for field in sensor_payload._fields])
-            if 'sec_since_pir' in payload_fields:
-                print(str(sensor_payload.sec_since_pir) + " seconds since last PIR activity")
-                sec_since_pir = sensor_payload.sec_since_pir
-                PIR_triggered_time = time - timedelta(seconds=sensor_payload.sec_since_pir)
-                print("So, the PIR was triggered at:", PIR_triggered_time)
-            else:
-                sec_since_pir = None
-                PIR_triggered_time = None
-
-            if 'sec_since_fridge' in payload_fields:
-                print(str(sensor_payload.sec_since_fridge) + " seconds since the fridge was opened")
-                sec_since_fridge = sensor_payload.sec_since_fridge
-                fridge_opened_time = time - timedelta(seconds=sensor_payload.sec_since_fridge)
-                print("So, the fridge was opened at:", fridge_opened_time)
-            else:
-                sec_since_fridge = None
-                fridge_opened_time = None
-        else:
-            raise ValueError("KitchenSensorParser initialised with incorrect payload type (expected port: 3)")
-
-        return KitchenData(time, received_time, rssi, snr, data_rate_raw, data_rate, temperature, humidity, ldr, sec_since_pir, PIR_triggered_time, sec_since_fridge, fridge_opened_time, payload_size)
+        metadata = payload_dict['metadata']
+        gateway = metadata['gateways'][0]
+        time = parse_timestamp(metadata['time'])
+        rssi = gateway['rssi']
+        snr = gateway['snr']
+        data_rate_raw = metadata['data_rate']
+        data_rate = spreading_factor(data_rate_raw)
+        receptions = [Reception(gateway['gtw_id'], gateway['rssi'], gateway['snr'], gateway.get('channel', 0))
+                      for gateway in metadata['gateways']]
+        if len(receptions) > 1:
+            receptions.sort(key=RECEPTION_SNR, reverse=True)
+        radio = RadioMetadata(payload_dict.get('counter'), metadata.get('frequency'), metadata.get('coding_rate'),
+                              receptions)
+
+        codec = codecs.lookup(device_id, payload_dict['port'])
+        payload_hex = binascii.a2b_base64(payload_dict['payload_raw'])
+        payload_size = len(payload_hex)
+        temperature, humidity, ldr, sec_since_pir, sec_since_fridge = codec.decode(payload_hex)
+
+        # PIR and fridge timings are optional fields, only sent once there has been some activity
+        PIR_triggered_time = None if sec_since_pir is None else time - timedelta(seconds=sec_since_pir)
+        fridge_opened_time = None if sec_since_fridge is None else time - timedelta(seconds=sec_since_fridge)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %s seconds since last PIR activity, so the PIR was triggered at %s",
+                         device_id, sec_since_pir, PIR_triggered_time)
+            logger.debug("%s: %s seconds since the fridge was opened, so the fridge was opened at %s",
+                         device_id, sec_since_fridge, fridge_opened_time)
+
+        return KitchenData(time, received_time, rssi, snr, data_rate_raw, data_rate, temperature, humidity, ldr, sec_since_pir, PIR_triggered_time, sec_since_fridge, fridge_opened_time, payload_size, device_id, radio)
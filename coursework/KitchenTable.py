@@ -0,0 +1,169 @@
+import csv
+import os
+import numpy as np
+from coursework.KitchenSensor import KitchenData, parse_timestamp
+from coursework.SensorStore import SensorStore, FIELDS, NO_COUNT, NO_TIME, to_epoch_us, from_epoch_us
+
+# Struct-of-arrays column types. Timestamps are int64 microseconds since the epoch, NO_TIME where missing.
+COLUMNS = {
+    'time': np.int64,
+    'received_time': np.int64,
+    'rssi': np.int16,
+    'snr': np.float32,
+    'spreading_factor': np.uint8,
+    'bandwidth': np.uint16,
+    'temperature': np.float32,
+    'humidity': np.uint8,
+    'ldr': np.uint16,
+    'sec_since_pir': np.int32,
+    'PIR_triggered_time': np.int64,
+    'sec_since_fridge': np.int32,
+    'fridge_opened_time': np.int64,
+    'payload_size': np.uint16,
+    'device': np.uint16,
+}
+
+# Matches SensorStore.RECORD, so chunk files can be mapped straight into a structured array
+RECORD_DTYPE = np.dtype([('time', '<i8'), ('received_time', '<i8'), ('PIR_triggered_time', '<i8'),
+                         ('fridge_opened_time', '<i8'), ('sec_since_pir', '<i4'), ('sec_since_fridge', '<i4'),
+                         ('snr', '<f4'), ('temperature', '<f4'), ('rssi', '<i2'), ('humidity', '<u2'),
+                         ('ldr', '<u2'), ('payload_size', '<u2'), ('spreading_factor', 'u1'), ('padding', 'V1'),
+                         ('bandwidth', '<u2'), ('device', '<u2')])
+assert tuple(name for name in RECORD_DTYPE.names if name != 'padding') == FIELDS
+
+
+def parse_epoch_us(strings):
+    # ISO-8601 strings to epoch microseconds. PIR/fridge times repeat across many rows, so each distinct string is
+    # only parsed once. (Per-element fromisoformat is faster than numpy's datetime64 string parsing here.)
+    parsed = {'': NO_TIME, 'None': NO_TIME}
+
+    def epoch_us(text):
+        value = parsed.get(text)
+        if value is None:
+            value = parsed[text] = to_epoch_us(parse_timestamp(text))
+        return value
+
+    return np.fromiter(map(epoch_us, strings), dtype=np.int64, count=len(strings))
+
+
+def parse_numbers(strings, dtype, missing=NO_COUNT):
+    try:
+        return np.fromiter(map(float if np.issubdtype(dtype, np.floating) else int, strings), dtype=dtype,
+                           count=len(strings))
+    except ValueError:
+        # Optional fields are written as empty strings when the payload didn't include them
+        return np.array([int(text) if text not in ('', 'None') else missing for text in strings]).astype(dtype)
+
+
+def parse_data_rates(strings):
+    # Vectorised split of e.g. SF7BW125 into (7, 125). There are only a handful of distinct data rates, so the
+    # string operations run over those and are broadcast back with the inverse index.
+    unique, inverse = np.unique(np.asarray(strings, dtype=str), return_inverse=True)
+    parts = np.char.partition(np.char.lstrip(unique, 'SF'), 'BW')
+    spreading_factor = parts[:, 0].astype(np.uint8)
+    bandwidth = np.where(parts[:, 2] == '', '0', parts[:, 2]).astype(np.uint16)
+    return spreading_factor[inverse], bandwidth[inverse]
+
+
+class KitchenTable:
+    # Columnar, struct-of-arrays view over many KitchenData uplinks. Rows are only turned back into KitchenData
+    # objects when they are indexed or iterated. The device column indexes into `devices` (0 is an unknown device).
+
+    def __init__(self, columns, devices=(None,)):
+        self.columns = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.devices = list(devices)
+
+    @classmethod
+    def empty(cls):
+        return cls({name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()})
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as past_data:
+            reader = csv.reader(past_data, delimiter=',')
+            next(reader)  # Skip first row containing headings
+            rows = list(reader)
+        if not rows:
+            return cls.empty()
+        # When I first started collecting data, I did not store the payload size metadata or device ID
+        missing = ['0', '']
+        columns = list(zip(*(row if len(row) >= 14 else row + missing[len(row) - 12:] for row in rows)))
+        spreading_factor, bandwidth = parse_data_rates(columns[4])
+        names, inverse = np.unique(np.asarray(columns[13], dtype=str), return_inverse=True)
+        devices = [None] + [name for name in names.tolist() if name]
+        device = np.array([devices.index(name) if name else 0 for name in names.tolist()])[inverse]
+        return cls({
+            'time': parse_epoch_us(columns[0]),
+            'received_time': parse_epoch_us(columns[1]),
+            'rssi': parse_numbers(columns[2], np.int16),
+            'snr': parse_numbers(columns[3], np.float32),
+            'spreading_factor': spreading_factor,
+            'bandwidth': bandwidth,
+            'temperature': parse_numbers(columns[5], np.float32),
+            'humidity': parse_numbers(columns[6], np.uint8),
+            'ldr': parse_numbers(columns[7], np.uint16),
+            'sec_since_pir': parse_numbers(columns[8], np.int32),
+            'PIR_triggered_time': parse_epoch_us(columns[9]),
+            'sec_since_fridge': parse_numbers(columns[10], np.int32),
+            'fridge_opened_time': parse_epoch_us(columns[11]),
+            'payload_size': parse_numbers(columns[12], np.uint16, missing=0),
+            'device': device,
+        }, devices)
+
+    @classmethod
+    def from_store(cls, store: SensorStore, start=None, end=None):
+        # Only the chunks overlapping [start, end) are memory-mapped
+        start_us = None if start is None else to_epoch_us(start)
+        end_us = None if end is None else to_epoch_us(end)
+        store.flush()
+        parts = []
+        for chunk in store.chunks_between(start, end):
+            records = np.memmap(os.path.join(store.path, chunk['file']), dtype=RECORD_DTYPE, mode='r',
+                                shape=(chunk['count'],))
+            mask = np.ones(len(records), dtype=bool)
+            if start_us is not None:
+                mask &= records['time'] >= start_us
+            if end_us is not None:
+                mask &= records['time'] < end_us
+            parts.append(records[mask])
+        if not parts:
+            return cls.empty()
+        records = np.concatenate(parts)
+        return cls({name: records[name] for name in COLUMNS}, store.devices)
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            return self.row(key)
+        # Slices, index arrays and boolean masks select a sub-table
+        return KitchenTable({name: column[key] for name, column in self.columns.items()}, self.devices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def row(self, i) -> KitchenData:
+        c = {name: column[i].item() for name, column in self.columns.items()}
+        data_rate_raw = 'SF{}BW{}'.format(c['spreading_factor'], c['bandwidth']) if c['bandwidth'] \
+            else str(c['spreading_factor'])
+        return KitchenData(from_epoch_us(c['time']), from_epoch_us(c['received_time']), c['rssi'],
+                           round(c['snr'], 2), data_rate_raw, c['spreading_factor'], round(c['temperature'], 2),
+                           c['humidity'], c['ldr'], None if c['sec_since_pir'] == NO_COUNT else c['sec_since_pir'],
+                           from_epoch_us(c['PIR_triggered_time']),
+                           None if c['sec_since_fridge'] == NO_COUNT else c['sec_since_fridge'],
+                           from_epoch_us(c['fridge_opened_time']), c['payload_size'], self.devices[c['device']])
+
+    def between(self, start=None, end=None):
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.columns['time'] >= to_epoch_us(start)
+        if end is not None:
+            mask &= self.columns['time'] < to_epoch_us(end)
+        return self[mask]
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
@@ -0,0 +1,270 @@
+import logging
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import zlib
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Backpressure policies, applied when a stage's queue is full
+BLOCK = 'block'  # Block the producer until there is space
+DROP_OLDEST = 'drop_oldest'  # Discard the oldest queued item to make space
+SPILL = 'spill'  # Append the item to a file on disk, read back once the queue drains
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+# paho's MQTTMessage holds a threading.Condition so can't be spilled to disk. We only need the topic and payload.
+RawMessage = namedtuple('RawMessage', ['topic', 'payload', 'received_time'])
+
+_STOP = object()
+
+
+class Stage:
+
+    def __init__(self, name, handler, concurrency=1, maxsize=1000, policy=BLOCK, spill_dir=None, partition=None,
+                 spill_suffix=''):
+        if policy not in POLICIES:
+            raise ValueError("Unknown backpressure policy '{}' (expected one of {})".format(policy, POLICIES))
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.policy = policy
+        # With a partition function (item -> key), items with the same key always go to the same worker, each
+        # worker having its own queue, so they're handled in the order they were put
+        self.partition = partition
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(concurrency if partition else 1)]
+        self.downstream = []
+        self.threads = []
+
+        # Metrics
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._metrics_lock = threading.Lock()
+
+        # Spill file state. Items are pickled back to back and read from _spill_read_pos onwards. The file is named
+        # after the stage (and shard), so items still spilled when the process died are picked up by the next run.
+        self._spill_lock = threading.Lock()
+        self._spill_path = os.path.join(spill_dir or tempfile.gettempdir(),
+                                        'kitcheniot-{}{}.spill'.format(name, spill_suffix))
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spill_pending = 0
+        if policy == SPILL:
+            self._recover_spill()
+
+    def connect(self, stage):
+        # Results returned by this stage's handler are passed on to every connected stage
+        self.downstream.append(stage)
+        return stage
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._work, args=(self.queues[i % len(self.queues)],),
+                                      name='{}-{}'.format(self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Handles everything queued, including what was spilled to disk, before the workers are told to stop
+        while True:
+            for stage_queue in self.queues:
+                stage_queue.join()
+            if self._spill_pending == 0 or not self.threads:
+                break
+            self._unspill()
+        for i in range(len(self.threads)):
+            self.queues[i % len(self.queues)].put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self._spill_lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+                if self._spill_pending == 0:
+                    os.remove(self._spill_path)
+
+    def put(self, item):
+        stage_queue = self._queue_for(item)
+        if self.policy == BLOCK:
+            stage_queue.put(item)
+        elif self.policy == DROP_OLDEST:
+            while True:
+                try:
+                    stage_queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        stage_queue.get_nowait()
+                        stage_queue.task_done()
+                        with self._metrics_lock:
+                            self.dropped += 1
+                    except queue.Empty:
+                        pass
+        else:
+            # Preserve ordering: once items are spilled, keep spilling until the backlog on disk is read back
+            if self._spill_pending == 0:
+                try:
+                    stage_queue.put_nowait(item)
+                    self._record_depth()
+                    return
+                except queue.Full:
+                    pass
+            self._spill(item)
+            return
+        self._record_depth()
+
+    def depth(self):
+        return self._queued() + self._spill_pending
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                'depth': self._queued(),
+                'max_depth': self.max_depth,
+                'spill_depth': self._spill_pending,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'errors': self.errors,
+            }
+
+    def _queue_for(self, item):
+        if len(self.queues) == 1:
+            return self.queues[0]
+        # crc32 rather than hash(), so a key keeps its worker across runs too
+        return self.queues[zlib.crc32(str(self.partition(item)).encode()) % len(self.queues)]
+
+    def _queued(self):
+        return sum(stage_queue.qsize() for stage_queue in self.queues)
+
+    def _record_depth(self):
+        depth = self._queued()
+        if depth > self.max_depth:
+            with self._metrics_lock:
+                self.max_depth = max(self.max_depth, depth)
+
+    def _spill(self, item):
+        with self._spill_lock:
+            if self._spill_file is None:
+                self._spill_file = open(self._spill_path, 'w+b')
+                self._spill_read_pos = 0
+            self._spill_file.seek(0, os.SEEK_END)
+            pickle.dump(item, self._spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._spill_pending += 1
+        with self._metrics_lock:
+            self.spilled += 1
+
+    def _unspill(self):
+        # Move as many spilled items as will fit back into the in-memory queue
+        with self._spill_lock:
+            if self._spill_pending == 0:
+                return
+            self._spill_file.flush()
+            self._spill_file.seek(self._spill_read_pos)
+            while self._spill_pending > 0:
+                position = self._spill_file.tell()
+                item = pickle.load(self._spill_file)
+                stage_queue = self._queue_for(item)
+                if stage_queue.full():
+                    # Read again next time, ahead of everything after it
+                    self._spill_file.seek(position)
+                    break
+                stage_queue.put_nowait(item)
+                self._spill_pending -= 1
+            self._spill_read_pos = self._spill_file.tell()
+            if self._spill_pending == 0:
+                # Backlog fully read back, so the file can be reused from the start
+                self._spill_file.seek(0)
+                self._spill_file.truncate()
+                self._spill_read_pos = 0
+
+    def _recover_spill(self):
+        # Counts the items a previous run left spilled, dropping a partly written one at the end
+        if not os.path.isfile(self._spill_path):
+            return
+        self._spill_file = open(self._spill_path, 'r+b')
+        end = 0
+        while True:
+            try:
+                pickle.load(self._spill_file)
+            except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                break
+            self._spill_pending += 1
+            end = self._spill_file.tell()
+        self._spill_file.truncate(end)
+        if self._spill_pending:
+            logger.info("Pipeline stage '%s' recovered %d spilled items from %s", self.name, self._spill_pending,
+                        self._spill_path)
+
+    def _work(self, stage_queue):
+        while True:
+            try:
+                item = stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._spill_pending:
+                    self._unspill()
+                continue
+
+            if item is _STOP:
+                stage_queue.task_done()
+                return
+
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                with self._metrics_lock:
+                    self.errors += 1
+                logger.warning("Pipeline stage '%s' failed: %r", self.name, e)
+            else:
+                with self._metrics_lock:
+                    self.processed += 1
+                if result is not None:
+                    for stage in self.downstream:
+                        stage.put(result)
+            finally:
+                stage_queue.task_done()
+
+            if self._spill_pending and stage_queue.empty():
+                self._unspill()
+
+
+class Pipeline:
+
+    def __init__(self, report_interval=None, spill_suffix=''):
+        # spill_suffix tells apart the spill files of pipelines sharing a spill_dir, e.g. one per shard
+        self.spill_suffix = spill_suffix
+        self.stages = []
+        self.report_interval = report_interval
+        self._reporting = threading.Event()
+
+    def add_stage(self, name, handler, concurrency=1, maxsize=1000, policy=BLOCK, spill_dir=None, partition=None):
+        stage = Stage(name, handler, concurrency=concurrency, maxsize=maxsize, policy=policy, spill_dir=spill_dir,
+                      partition=partition, spill_suffix=self.spill_suffix)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.report_interval:
+            threading.Thread(target=self._report, name='pipeline-metrics', daemon=True).start()
+
+    def stop(self):
+        # Stop stages in the order they were added so upstream stages flush into downstream ones first
+        self._reporting.set()
+        for stage in self.stages:
+            stage.stop()
+
+    def metrics(self):
+        return {stage.name: stage.metrics() for stage in self.stages}
+
+    def _report(self):
+        while not self._reporting.wait(self.report_interval):
+            for name, metrics in self.metrics().items():
+                logger.info('Pipeline %s: %s', name, metrics)
@@ -0,0 +1,552 @@
+import copy
+import csv
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+import numpy as np
+from coursework.KitchenSensor import KitchenData, parse_data_rate
+from coursework.SensorStore import EPOCH, to_epoch_us
+
+FORMAT_VERSION = 1
+# One row per gateway reception of an uplink, so an uplink heard by three gateways is three rows. Rows of an uplink
+# are consecutive, strongest SNR first (rank 0). snr is in tenths of a dB, frequency in kHz, bandwidth in kHz and
+# coding_rate is n of 4/(4+n). device and gateway index the log's devices and gateways.
+ROW_DTYPE = np.dtype([('time', '<i8'), ('device', '<u2'), ('gateway', '<u2'), ('counter', '<u4'), ('rssi', '<i2'),
+                      ('snr', '<i2'), ('channel', 'u1'), ('frequency', '<u4'), ('spreading_factor', 'u1'),
+                      ('bandwidth', '<u2'), ('coding_rate', 'u1'), ('payload_size', 'u1'), ('gateways', 'u1'),
+                      ('rank', 'u1')])
+COLUMNS = ROW_DTYPE.names
+NO_COUNTER = 2 ** 32 - 1
+
+# LoRaWAN MAC header, device address, frame control and counter, port, and MIC around every application payload
+LORAWAN_OVERHEAD = 13
+# Lowest SNR (dB) a LoRa demodulator can decode at each spreading factor
+SNR_FLOOR = {7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+# Margin (dB) kept above the floor when suggesting a spreading factor, as the LoRaWAN ADR algorithm does. Each
+# 3 dB of margin beyond it is worth one step down in spreading factor.
+ADR_MARGIN = 10.0
+# A frame counter jump larger than this is a device reset rather than lost frames (LoRaWAN MAX_FCNT_GAP)
+MAX_FCNT_GAP = 16384
+
+# Fixed histogram bins, so distributions are a few counters per device and gateway however many uplinks they
+# cover, and merge by adding. Values outside the range land in the end bins.
+RSSI_RANGE = (-140, -20)  # dB, 1 dB bins
+SNR_RANGE = (-25, 15)  # dB, 0.5 dB bins
+MARGIN_RANGE = (-20, 40)  # dB above the SNR floor, 1 dB bins
+RSSI_BINS = RSSI_RANGE[1] - RSSI_RANGE[0] + 1
+SNR_BINS = (SNR_RANGE[1] - SNR_RANGE[0]) * 2 + 1
+MARGIN_BINS = MARGIN_RANGE[1] - MARGIN_RANGE[0] + 1
+SPREADING_FACTORS = 13
+FLOORS = np.array([SNR_FLOOR.get(spreading_factor, 0.0) for spreading_factor in range(SPREADING_FACTORS)])
+
+# Per-device counters, columns of RadioStats.device_counts
+UPLINKS, LOST, DUPLICATES, RESETS, RECEPTIONS, SOLE = range(6)
+# Per-gateway counters, columns of RadioStats.gateway_counts: receptions, uplinks it heard best, uplinks only it heard
+GATEWAY_RECEPTIONS, BEST, ONLY = range(3)
+
+
+def lora_airtime(payload_bytes, spreading_factor, bandwidth=125000, coding_rate=1, preamble=8):
+    # Time on air in seconds of one LoRa frame (Semtech AN1200.13), with explicit header and CRC. Takes numbers or
+    # numpy arrays of them.
+    spreading_factor = np.asarray(spreading_factor, dtype=np.int64)
+    symbol_time = 2.0 ** spreading_factor / bandwidth
+    low_data_rate = (symbol_time > 0.016).astype(np.int64)
+    payload_symbols = 8 + np.maximum(np.ceil((8 * np.asarray(payload_bytes, dtype=np.int64) - 4 * spreading_factor
+                                              + 28 + 16) / (4 * (spreading_factor - 2 * low_data_rate)))
+                                     * (np.asarray(coding_rate) + 4), 0)
+    airtime = (preamble + 4.25 + payload_symbols) * symbol_time
+    return airtime.item() if airtime.ndim == 0 else airtime
+
+
+@lru_cache(maxsize=16)
+def coding_rate_index(coding_rate):
+    # '4/5' -> 1 ... '4/8' -> 4, the CR of the airtime formula
+    try:
+        return int(coding_rate.split('/')[1]) - 4
+    except (AttributeError, IndexError, ValueError):
+        return 1
+
+
+def histogram_bin(values, low, high, per_unit=1):
+    return np.clip(np.floor((values - low) * per_unit), 0, (high - low) * per_unit).astype(np.intp)
+
+
+def histogram_quantile(histograms, q, low, per_unit=1):
+    # The q quantile (bin lower edge) of each row of a 2D array of histograms, NaN for empty rows
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1]
+    bins = (cumulative < np.maximum(q * totals, 1)[:, None]).sum(axis=1)
+    return np.where(totals > 0, low + bins / per_unit, np.nan)
+
+
+class RadioStats:
+    # Running link-quality statistics of a RadioLog's rows, per device, per gateway and per (device, gateway) link.
+    # Updated a batch of rows at a time with numpy, so they cost next to nothing per uplink, and every statistic
+    # is a counter or a fixed-bin histogram, so a batch only ever adds to them. Packet loss comes from gaps in
+    # each device's frame counters; a counter that goes backwards (or jumps past MAX_FCNT_GAP) is a device reset.
+    # Device RSSI/SNR distributions are of each uplink's best reception, gateway ones of every reception.
+
+    def __init__(self, devices, gateways):
+        # devices and gateways are the names of the indices in the rows, shared with (and grown by) the log
+        self.devices = devices
+        self.gateways = gateways
+        self.device_counts = np.zeros((0, 6), np.int64)
+        self.last_counter = np.zeros(0, np.int64)
+        self.airtime = np.zeros(0)
+        self.first_seen = np.zeros(0, np.int64)
+        self.last_seen = np.zeros(0, np.int64)
+        self.spreading_factors = np.zeros((0, SPREADING_FACTORS), np.int64)
+        self.device_rssi = np.zeros((0, RSSI_BINS), np.int32)
+        self.device_snr = np.zeros((0, SNR_BINS), np.int32)
+        self.device_margin = np.zeros((0, MARGIN_BINS), np.int32)
+        self.gateway_counts = np.zeros((0, 3), np.int64)
+        self.gateway_rssi = np.zeros((0, RSSI_BINS), np.int32)
+        self.gateway_snr = np.zeros((0, SNR_BINS), np.int32)
+        self.links = {}  # (device, gateway) -> [receptions, RSSI sum, SNR sum (tenths)]
+
+    def add(self, columns):
+        # Folds a batch of rows (dict of column arrays, in arrival order) into the statistics
+        if len(columns['time']) == 0:
+            return
+        self._grow(int(columns['device'].max()) + 1, int(columns['gateway'].max()) + 1)
+        device = columns['device'].astype(np.intp)
+        gateway = columns['gateway'].astype(np.intp)
+        rssi_bin = histogram_bin(columns['rssi'], *RSSI_RANGE)
+        snr_bin = histogram_bin(columns['snr'] / 10, *SNR_RANGE, per_unit=2)
+
+        # Every reception
+        np.add.at(self.device_counts[:, RECEPTIONS], device, 1)
+        np.add.at(self.gateway_counts[:, GATEWAY_RECEPTIONS], gateway, 1)
+        np.add.at(self.gateway_rssi, (gateway, rssi_bin), 1)
+        np.add.at(self.gateway_snr, (gateway, snr_bin), 1)
+        pairs, inverse = np.unique(np.stack([device, gateway], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        receptions = np.bincount(inverse)
+        rssi_sums = np.bincount(inverse, weights=columns['rssi'])
+        snr_sums = np.bincount(inverse, weights=columns['snr'])
+        for (d, g), count, rssi_sum, snr_sum in zip(pairs.tolist(), receptions.tolist(), rssi_sums.tolist(),
+                                                    snr_sums.tolist()):
+            link = self.links.setdefault((d, g), [0, 0.0, 0.0])
+            link[0] += count
+            link[1] += rssi_sum
+            link[2] += snr_sum
+
+        # Each uplink's best reception, which is what the network server decodes and ADR works from
+        best = columns['rank'] == 0
+        device, gateway = device[best], gateway[best]
+        only = columns['gateways'][best] == 1
+        np.add.at(self.gateway_counts[:, BEST], gateway, 1)
+        np.add.at(self.gateway_counts[:, ONLY], gateway[only], 1)
+        np.add.at(self.device_counts[:, SOLE], device[only], 1)
+        np.add.at(self.device_rssi, (device, rssi_bin[best]), 1)
+        np.add.at(self.device_snr, (device, snr_bin[best]), 1)
+        sent = columns['time'][best]
+        np.minimum.at(self.first_seen, device, sent)
+        np.maximum.at(self.last_seen, device, sent)
+
+        spreading_factor = np.minimum(columns['spreading_factor'][best], SPREADING_FACTORS - 1).astype(np.intp)
+        np.add.at(self.spreading_factors, (device, spreading_factor), 1)
+        known = np.isin(spreading_factor, list(SNR_FLOOR))
+        floor = FLOORS[spreading_factor]
+        margin_bin = histogram_bin(columns['snr'][best] / 10 - floor, *MARGIN_RANGE)
+        np.add.at(self.device_margin, (device[known], margin_bin[known]), 1)
+        bandwidth = columns['bandwidth'][best]
+        timed = known & (bandwidth > 0)
+        np.add.at(self.airtime, device[timed], lora_airtime(
+            columns['payload_size'][best][timed].astype(np.int64) + LORAWAN_OVERHEAD, spreading_factor[timed],
+            bandwidth[timed] * 1000.0, columns['coding_rate'][best][timed]))
+        self._count_frames(device, columns['counter'][best].astype(np.int64))
+
+    def _count_frames(self, device, counter):
+        # Compares each uplink's frame counter with the device's previous one: the last of the previous batch,
+        # or the one before it in this batch. Repeats of the previous frame don't count as uplinks.
+        np.add.at(self.device_counts[:, UPLINKS], device, 1)
+        has_counter = counter != NO_COUNTER
+        device, counter = device[has_counter], counter[has_counter]
+        if len(device) == 0:
+            return
+        order = np.argsort(device, kind='stable')
+        device, counter = device[order], counter[order]
+        first = np.ones(len(device), dtype=bool)
+        first[1:] = device[1:] != device[:-1]
+        previous = np.empty_like(counter)
+        previous[1:] = counter[:-1]
+        previous[first] = self.last_counter[device[first]]
+        gap = counter - previous
+        seen = previous >= 0
+        lost = seen & (gap > 1) & (gap <= MAX_FCNT_GAP)
+        duplicate = seen & (gap == 0)
+        reset = seen & ((gap < 0) | (gap > MAX_FCNT_GAP))
+        np.add.at(self.device_counts[:, LOST], device[lost], gap[lost] - 1)
+        np.add.at(self.device_counts[:, DUPLICATES], device[duplicate], 1)
+        np.add.at(self.device_counts[:, UPLINKS], device[duplicate], -1)
+        np.add.at(self.device_counts[:, RESETS], device[reset], 1)
+        last = np.ones(len(device), dtype=bool)
+        last[:-1] = first[1:]
+        self.last_counter[device[last]] = counter[last]
+
+    def device_table(self, device=None):
+        # Aggregates per device, as a list of dicts (see DEVICE_HEADINGS). The suggested spreading factor is the
+        # current one moved a step for every 3 dB the 10th percentile SNR margin is beyond ADR_MARGIN.
+        counts = self.device_counts
+        uplinks = counts[:, UPLINKS]
+        frames = uplinks + counts[:, DUPLICATES]
+        expected = uplinks + counts[:, LOST]
+        heard = np.zeros(len(counts), np.int64)
+        for d, _ in self.links:
+            heard[d] += 1
+        spreading_factor = self.spreading_factors.argmax(axis=1)
+        margin_p10 = histogram_quantile(self.device_margin, 0.1, MARGIN_RANGE[0])
+        steps = np.floor((np.nan_to_num(margin_p10, nan=ADR_MARGIN) - ADR_MARGIN) / 3)
+        suggested = np.clip(spreading_factor - steps, min(SNR_FLOOR), max(SNR_FLOOR)).astype(np.int64)
+        span = (self.last_seen - self.first_seen) / 1e6
+        columns = {
+            'device': self.devices[:len(counts)],
+            'uplinks': uplinks,
+            'lost': counts[:, LOST],
+            'loss_rate': np.divide(counts[:, LOST], expected, out=np.zeros(len(expected)), where=expected > 0),
+            'duplicates': counts[:, DUPLICATES],
+            'resets': counts[:, RESETS],
+            'gateways': heard,
+            'gateways_per_uplink': np.divide(counts[:, RECEPTIONS], frames, out=np.zeros(len(frames)),
+                                             where=frames > 0),
+            'single_gateway_uplinks': counts[:, SOLE],
+            'rssi_median': histogram_quantile(self.device_rssi, 0.5, RSSI_RANGE[0]),
+            'rssi_p10': histogram_quantile(self.device_rssi, 0.1, RSSI_RANGE[0]),
+            'snr_median': histogram_quantile(self.device_snr, 0.5, SNR_RANGE[0], per_unit=2),
+            'snr_p10': histogram_quantile(self.device_snr, 0.1, SNR_RANGE[0], per_unit=2),
+            'snr_margin_p10': margin_p10,
+            'spreading_factor': spreading_factor,
+            'suggested_spreading_factor': np.where(np.isnan(margin_p10), spreading_factor, suggested),
+            'airtime_s': self.airtime,
+            'duty_cycle': np.divide(self.airtime, span, out=np.zeros(len(span)), where=span > 0),
+            'first_seen': [from_epoch_us(sent) for sent in self.first_seen.tolist()],
+            'last_seen': [from_epoch_us(sent) for sent in self.last_seen.tolist()],
+        }
+        return self._rows(columns, 'device', device, frames > 0)
+
+    def gateway_table(self, gateway=None):
+        # Aggregates per gateway (see GATEWAY_HEADINGS). best is the uplinks it heard most clearly, only_gateway the
+        # uplinks no other gateway heard: those devices depend on it.
+        counts = self.gateway_counts
+        heard = np.zeros(len(counts), np.int64)
+        for _, g in self.links:
+            heard[g] += 1
+        columns = {
+            'gateway': self.gateways[:len(counts)],
+            'receptions': counts[:, GATEWAY_RECEPTIONS],
+            'devices': heard,
+            'best': counts[:, BEST],
+            'only_gateway': counts[:, ONLY],
+            'rssi_median': histogram_quantile(self.gateway_rssi, 0.5, RSSI_RANGE[0]),
+            'rssi_p10': histogram_quantile(self.gateway_rssi, 0.1, RSSI_RANGE[0]),
+            'snr_median': histogram_quantile(self.gateway_snr, 0.5, SNR_RANGE[0], per_unit=2),
+            'snr_p10': histogram_quantile(self.gateway_snr, 0.1, SNR_RANGE[0], per_unit=2),
+        }
+        return self._rows(columns, 'gateway', gateway, counts[:, GATEWAY_RECEPTIONS] > 0)
+
+    def link_table(self, device=None, gateway=None):
+        # Per (device, gateway) pair that has heard each other: the share of the device's uplinks the gateway
+        # received, and the mean RSSI/SNR between them
+        rows = []
+        for (d, g), (receptions, rssi_sum, snr_sum) in sorted(self.links.items()):
+            if (device is not None and self.devices[d] != device) or \
+                    (gateway is not None and self.gateways[g] != gateway):
+                continue
+            frames = self.device_counts[d, UPLINKS] + self.device_counts[d, DUPLICATES]
+            rows.append({'device': self.devices[d], 'gateway': self.gateways[g], 'receptions': receptions,
+                         'share': receptions / frames if frames else 0.0, 'rssi_mean': rssi_sum / receptions,
+                         'snr_mean': snr_sum / receptions / 10})
+        return rows
+
+    def totals(self):
+        return {'devices': len(self.devices), 'gateways': len(self.gateways),
+                'uplinks': int(self.device_counts[:, UPLINKS].sum()), 'lost': int(self.device_counts[:, LOST].sum()),
+                'receptions': int(self.device_counts[:, RECEPTIONS].sum())}
+
+    def _rows(self, columns, key, only, present):
+        # Rows of the devices or gateways in these stats, or just the one named `only`
+        names = list(columns)
+        values = [column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()]
+        return [dict(zip(names, row)) for row, keep in zip(zip(*values), present.tolist())
+                if keep and (only is None or row[0] == only)]
+
+    def _grow(self, devices, gateways):
+        if devices > len(self.device_counts):
+            extra = devices - len(self.device_counts)
+            for name, fill in (('device_counts', 0), ('last_counter', -1), ('airtime', 0), ('first_seen', 2 ** 63 - 1),
+                               ('last_seen', -2 ** 63), ('spreading_factors', 0), ('device_rssi', 0),
+                               ('device_snr', 0), ('device_margin', 0)):
+                current = getattr(self, name)
+                setattr(self, name, np.concatenate([current, np.full((extra,) + current.shape[1:], fill,
+                                                                     current.dtype)]))
+        if gateways > len(self.gateway_counts):
+            extra = gateways - len(self.gateway_counts)
+            for name in ('gateway_counts', 'gateway_rssi', 'gateway_snr'):
+                current = getattr(self, name)
+                setattr(self, name, np.concatenate([current, np.zeros((extra,) + current.shape[1:], current.dtype)]))
+
+
+DEVICE_HEADINGS = ('device', 'uplinks', 'lost', 'loss_rate', 'duplicates', 'resets', 'gateways', 'gateways_per_uplink',
+                   'single_gateway_uplinks', 'rssi_median', 'rssi_p10', 'snr_median', 'snr_p10', 'snr_margin_p10',
+                   'spreading_factor', 'suggested_spreading_factor', 'airtime_s', 'duty_cycle', 'first_seen',
+                   'last_seen')
+GATEWAY_HEADINGS = ('gateway', 'receptions', 'devices', 'best', 'only_gateway', 'rssi_median', 'rssi_p10',
+                    'snr_median', 'snr_p10')
+LINK_HEADINGS = ('device', 'gateway', 'receptions', 'share', 'rssi_mean', 'snr_mean')
+
+
+class RadioLog:
+    # Append-only, columnar log of every gateway reception of every uplink (see ROW_DTYPE), 32 bytes a reception
+    # uncompressed. The chunk being filled is kept in memory, as batches of stats_batch rows, and its new rows are
+    # appended to a raw .rows file every flush_interval seconds. Once full it is saved as a compressed .npz of its
+    # columns and the .rows file removed. index.json records each chunk's row count and time range (the chunk being
+    # filled too, as of the last flush), and the device and gateway names.
+    # The RadioStats in `stats` are rebuilt from the saved chunks on open, then kept up to date a batch of
+    # stats_batch rows at a time, and whenever they're read through the log.
+
+    def __init__(self, path, chunk_rows=65536, flush_interval=5.0, stats_batch=1024, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.stats_batch = stats_batch
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_flush = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+        self.chunks = []
+        self.devices = []
+        self.gateways = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            if index['version'] != FORMAT_VERSION:
+                raise ValueError('{} was written by an incompatible RadioLog version'.format(path))
+            self.chunks = index['chunks']
+            self.devices = index['devices']
+            self.gateways = index['gateways']
+        self.device_index = {device: i for i, device in enumerate(self.devices)}
+        self.gateway_index = {gateway: i for i, gateway in enumerate(self.gateways)}
+
+        # The chunk being filled: batches the stats have seen (the first `saved` of them in its .rows file), then
+        # row tuples they haven't
+        self.batches = []
+        self.saved = 0
+        self.rows = []
+        self.count = 0
+        self.min_time = self.max_time = None
+        self.stats = RadioStats(self.devices, self.gateways)
+        if self.chunks and self.chunks[-1]['file'].endswith('.rows') and not read_only:
+            # Carry on filling the last chunk
+            self._recover(self.chunks.pop())
+        for chunk in self.chunks:
+            self.stats.add(self.read_chunk(chunk))
+        if self.batches:
+            self.stats.add({name: self.batches[0][name] for name in COLUMNS})
+
+    def append(self, payload: KitchenData):
+        # Adds a row per gateway that received the uplink. Uplinks without radio metadata (e.g. from storage) are
+        # skipped.
+        radio = payload.radio
+        if radio is None or not radio.receptions:
+            return
+        if self.read_only:
+            raise ValueError('{} was opened read only'.format(self.path))
+        sent = to_epoch_us(payload.time)
+        spreading_factor, bandwidth = parse_data_rate(payload.data_rate_raw)
+        counter = NO_COUNTER if radio.counter is None else radio.counter
+        frequency = round((radio.frequency or 0) * 1000)
+        coding_rate = coding_rate_index(radio.coding_rate)
+        payload_size = min(int(payload.payload_size or 0), 255)
+        gateways = min(len(radio.receptions), 255)
+        with self.lock:
+            device = self.device_index.get(payload.device_id)
+            if device is None:
+                device = self.device_index[payload.device_id] = len(self.devices)
+                self.devices.append(payload.device_id)
+            for rank, reception in enumerate(radio.receptions):
+                gateway = self.gateway_index.get(reception.gateway)
+                if gateway is None:
+                    gateway = self.gateway_index[reception.gateway] = len(self.gateways)
+                    self.gateways.append(reception.gateway)
+                self.rows.append((sent, device, gateway, counter, reception.rssi, round(reception.snr * 10),
+                                  reception.channel, frequency, spreading_factor, bandwidth, coding_rate,
+                                  payload_size, gateways, min(rank, 255)))
+            self.count += len(radio.receptions)
+            if len(self.rows) >= self.stats_batch:
+                self._fold()
+            if self.count >= self.chunk_rows:
+                self._seal()
+            elif time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        if not self.read_only:
+            with self.lock:
+                self._flush()
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.chunks) + self.count
+
+    def scan(self, start=None, end=None):
+        # The rows sent in [start, end) (datetimes), as a dict of column arrays per chunk
+        start_us = None if start is None else to_epoch_us(start)
+        end_us = None if end is None else to_epoch_us(end)
+        with self.lock:
+            self._fold()
+            chunks = list(self.chunks)
+            current = self._columns()
+        for chunk in chunks:
+            if chunk['count'] == 0 or (start_us is not None and chunk['max_time'] < start_us) or \
+                    (end_us is not None and chunk['min_time'] >= end_us):
+                continue
+            yield between(self.read_chunk(chunk), start_us, end_us)
+        if len(current['time']):
+            yield between(current, start_us, end_us)
+
+    def query(self, start=None, end=None):
+        # RadioStats over the rows sent in [start, end). Without a range, a copy of the log's running stats, which
+        # a live writer carries on updating.
+        if start is None and end is None:
+            with self.lock:
+                self._fold()
+                return copy.deepcopy(self.stats)
+        stats = RadioStats(self.devices, self.gateways)
+        for columns in self.scan(start, end):
+            stats.add(columns)
+        return stats
+
+    def metrics(self):
+        with self.lock:
+            self._fold()
+            return self.stats.totals()
+
+    def read_chunk(self, chunk):
+        chunk_path = os.path.join(self.path, chunk['file'])
+        if chunk['file'].endswith('.rows'):
+            # Rows past the count are from a flush the index doesn't include yet
+            rows = np.fromfile(chunk_path, ROW_DTYPE, count=chunk['count'])
+            return {name: np.ascontiguousarray(rows[name]) for name in COLUMNS}
+        with np.load(chunk_path) as saved:
+            return {name: saved[name] for name in COLUMNS}
+
+    def _columns(self):
+        # The folded rows of the chunk being filled
+        rows = np.concatenate(self.batches) if self.batches else np.empty(0, ROW_DTYPE)
+        return {name: np.ascontiguousarray(rows[name]) for name in COLUMNS}
+
+    def _fold(self):
+        if self.rows:
+            batch = np.array(self.rows, dtype=ROW_DTYPE)
+            self.rows = []
+            self.stats.add({name: batch[name] for name in COLUMNS})
+            self._add_batch(batch)
+
+    def _add_batch(self, batch):
+        self.batches.append(batch)
+        min_time, max_time = int(batch['time'].min()), int(batch['time'].max())
+        self.min_time = min_time if self.min_time is None else min(self.min_time, min_time)
+        self.max_time = max_time if self.max_time is None else max(self.max_time, max_time)
+
+    def _flush(self):
+        # Appends the rows folded since the last flush to the .rows file, then lists them in the index
+        self._fold()
+        if self.read_only or self.saved == len(self.batches):
+            return
+        if self.file is None:
+            self.file = open(os.path.join(self.path, self._chunk_file('.rows')), 'ab')
+        for batch in self.batches[self.saved:]:
+            self.file.write(batch.tobytes())
+        self.saved = len(self.batches)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._write_index(self.chunks + [self._chunk_entry('.rows')])
+        self.last_flush = time.monotonic()
+
+    def _seal(self):
+        self._fold()
+        chunk = self._chunk_entry('.npz')
+        rows_path = os.path.join(self.path, self._chunk_file('.rows'))
+        tmp_path = os.path.join(self.path, chunk['file'] + '.tmp')
+        with open(tmp_path, 'wb') as chunk_file:
+            np.savez_compressed(chunk_file, **self._columns())
+        os.replace(tmp_path, os.path.join(self.path, chunk['file']))
+        self.chunks.append(chunk)
+        self._write_index(self.chunks)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.isfile(rows_path):
+            os.remove(rows_path)
+        self.batches = []
+        self.saved = 0
+        self.count = 0
+        self.min_time = self.max_time = None
+        self.last_flush = time.monotonic()
+
+    def _recover(self, chunk):
+        # Reads back the rows the index lists of an unsealed chunk, and drops any written after it was last saved
+        rows_path = os.path.join(self.path, chunk['file'])
+        if not os.path.isfile(rows_path):
+            return
+        rows = np.fromfile(rows_path, ROW_DTYPE, count=chunk['count'])
+        if os.path.getsize(rows_path) != rows.nbytes:
+            with open(rows_path, 'r+b') as rows_file:
+                rows_file.truncate(rows.nbytes)
+        if len(rows):
+            self._add_batch(rows)
+            self.saved = 1
+            self.count = len(rows)
+
+    def _chunk_file(self, extension):
+        return 'chunk-{:06d}{}'.format(len(self.chunks), extension)
+
+    def _chunk_entry(self, extension):
+        # Called with every row folded (and, for .rows, saved)
+        return {'file': self._chunk_file(extension), 'count': self.count, 'min_time': self.min_time,
+                'max_time': self.max_time}
+
+    def _write_index(self, chunks):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'version': FORMAT_VERSION, 'columns': list(COLUMNS), 'chunks': chunks,
+                       'devices': self.devices, 'gateways': self.gateways}, index_file)
+        os.replace(tmp_path, self.index_path)
+
+
+def between(columns, start_us, end_us):
+    if start_us is None and end_us is None:
+        return columns
+    keep = np.ones(len(columns['time']), dtype=bool)
+    if start_us is not None:
+        keep &= columns['time'] >= start_us
+    if end_us is not None:
+        keep &= columns['time'] < end_us
+    return {name: column[keep] for name, column in columns.items()}
+
+
+def from_epoch_us(value):
+    if value in (2 ** 63 - 1, -2 ** 63):
+        return None
+    return EPOCH + timedelta(microseconds=value)
+
+
+def write_csv(rows, headings, out):
+    writer = csv.DictWriter(out, fieldnames=headings)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({key: '{:.4g}'.format(value) if isinstance(value, float) else value
+                         for key, value in row.items()})
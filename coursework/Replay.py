@@ -0,0 +1,161 @@
+import csv
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from coursework.EventStore import PendingEvents
+from coursework.KitchenSensor import KitchenSensorParser
+from coursework.SensorStore import SensorStore, to_epoch_us
+
+
+class TokenBucket:
+    # Allows `rate` tokens per second on average, with bursts of up to `capacity`
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # Requests larger than the bucket are allowed through once it is full, then the bucket goes into debt
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    return
+                wait = (min(tokens, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_rows(rows, start=None, end=None):
+    # Runs in the worker processes, so filtering by time happens before results are pickled back. Compared as epoch
+    # microseconds, as the store does, since either side may be naive (local time) or carry an offset.
+    start_us = None if start is None else to_epoch_us(start)
+    end_us = None if end is None else to_epoch_us(end)
+    parsed = []
+    for row in rows:
+        payload = KitchenSensorParser.parse_csv_row(row)
+        if start_us is not None and to_epoch_us(payload.time) < start_us:
+            continue
+        if end_us is not None and to_epoch_us(payload.time) >= end_us:
+            continue
+        parsed.append(payload)
+    return parsed
+
+
+def csv_chunks(csv_path, chunk_size, skip=0):
+    # Yields (row offset after chunk, rows), skipping the first `skip` data rows without parsing them
+    with open(csv_path, 'r', encoding='utf-8') as past_data:
+        reader = csv.reader(past_data, delimiter=',')
+        next(reader)  # Skip first row containing headings
+        offset = 0
+        for _ in range(skip):
+            if next(reader, None) is None:
+                return
+            offset += 1
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                offset += len(chunk)
+                yield offset, chunk
+                chunk = []
+        if chunk:
+            yield offset + len(chunk), chunk
+
+
+class Replayer:
+
+    def __init__(self, writer, schema, activity, rate=500, chunk_size=2000, workers=None, checkpoint_path=None):
+        self.writer = writer
+        self.schema = schema
+        self.activity = activity
+        self.bucket = TokenBucket(rate)
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count()
+        self.checkpoint_path = checkpoint_path
+        self.points = 0
+        self.rows = 0
+
+    def replay(self, source, start=None, end=None):
+        self.key = {'source': os.path.abspath(source), 'start': start and start.isoformat(),
+                    'end': end and end.isoformat()}
+        offset = self._load_checkpoint()
+        if offset:
+            print('Resuming replay of {} from row {}'.format(source, offset))
+        if os.path.isdir(source):
+            self._replay_store(source, offset, start, end)
+        else:
+            self._replay_csv(source, offset, start, end)
+        print('Replayed {} rows ({} points) from {}'.format(self.rows, self.points, source))
+
+    def _replay_csv(self, csv_path, offset, start, end):
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # Keep a bounded number of chunks in flight, and consume them in file order so events stay de-duplicated
+            in_flight = deque()
+            for chunk_end, rows in csv_chunks(csv_path, self.chunk_size, skip=offset):
+                in_flight.append((chunk_end, executor.submit(parse_rows, rows, start, end)))
+                if len(in_flight) >= self.workers * 2:
+                    chunk_end, future = in_flight.popleft()
+                    self._send(future.result(), chunk_end)
+            while in_flight:
+                chunk_end, future = in_flight.popleft()
+                self._send(future.result(), chunk_end)
+
+    def _replay_store(self, path, offset, start, end):
+        # The binary store doesn't need parsing, so it's read in-process
+        store = SensorStore(path, read_only=True)
+        chunk = []
+        for row, payload in enumerate(store.scan(start, end), start=1):
+            if row <= offset:
+                continue
+            chunk.append(payload)
+            if len(chunk) == self.chunk_size:
+                self._send(chunk, row)
+                chunk = []
+        if chunk:
+            self._send(chunk, offset + self.rows + len(chunk))
+        store.close()
+
+    def _send(self, payloads, offset):
+        # Events are only recorded as sent in the activity store once their points have been flushed
+        pending = PendingEvents(self.activity)
+        points = []
+        for payload in payloads:
+            points.extend(self.schema.points(payload, pending))
+        for i in range(0, len(points), self.writer.max_points):
+            batch = points[i:i + self.writer.max_points]
+            self.bucket.acquire(len(batch))
+            self.writer.write(batch)
+            # Graphite being down pauses the replay rather than losing points; the checkpoint only moves once sent
+            while not self.writer.flush():
+                time.sleep(self.writer.retry_delay)
+        pending.commit()
+        self.points += len(points)
+        self.rows += len(payloads)
+        self._save_checkpoint(offset)
+
+    def _load_checkpoint(self):
+        # A checkpoint only applies to the same source and time range it was written for
+        if not self.checkpoint_path or not os.path.isfile(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as checkpoint:
+            state = json.load(checkpoint)
+        if state['key'] != self.key:
+            return 0
+        return state['offset']
+
+    def _save_checkpoint(self, offset):
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump({'key': self.key, 'offset': offset}, checkpoint)
+        os.replace(tmp_path, self.checkpoint_path)
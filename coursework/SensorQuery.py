@@ -0,0 +1,211 @@
+import csv
+import logging
+import os
+import threading
+from datetime import timedelta
+import numpy as np
+from coursework.GraphiteSchema import round_minute
+from coursework.KitchenTable import KitchenTable, COLUMNS, RECORD_DTYPE
+from coursework.SensorStore import SensorStore, CSV_HEADINGS, EPOCH, NO_COUNT, NO_TIME, to_epoch_us
+
+logger = logging.getLogger(__name__)
+# Per-chunk index for single-device queries, sorted by device and then sent time: each device's uplinks in a chunk
+# are a contiguous, time-ordered run, found with two binary searches. row is the record's position in the chunk.
+INDEX_DTYPE = np.dtype([('device', '<u2'), ('time', '<i8'), ('row', '<u4')])
+BUCKETS = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400}
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'count')
+# Columns that record a missing value with a sentinel, which aggregates skip
+MISSING = {'sec_since_pir': NO_COUNT, 'sec_since_fridge': NO_COUNT, 'PIR_triggered_time': NO_TIME,
+           'fridge_opened_time': NO_TIME}
+EVENTS = {'fridge': 'fridge_opened_time', 'pir': 'PIR_triggered_time'}
+
+
+class SensorQuery:
+    # Queries over a SensorStore's history that only read the records they return. Chunks outside the time range
+    # are skipped using the store's index. For one device, a sorted (device, time) index of each chunk finds the
+    # matching rows, which are then gathered from the memory-mapped chunk. Indexes of full chunks are saved next
+    # to them (chunk-NNNNNN.idx.npy) and memory-mapped by later queries; the chunk being written is indexed in
+    # memory.
+
+    def __init__(self, store: SensorStore):
+        self.store = store
+        self.lock = threading.Lock()
+        self.indexes = {}  # chunk file -> (count, index)
+
+    def range(self, start=None, end=None, device=None) -> KitchenTable:
+        # Uplinks sent in [start, end), optionally from one device, in time order
+        start_us, end_us = bounds(start, end)
+        parts = [self._rows(chunk, device, start_us, end_us) for chunk in self._chunks(start_us, end_us)]
+        return self._table(parts)
+
+    def last(self, n, device=None, before=None) -> KitchenTable:
+        # The n most recent uplinks (sent before `before`, if given), oldest first
+        _, end_us = bounds(None, before)
+        found = []  # Candidate records, per chunk
+        newest_first = sorted(self._chunks(None, end_us), key=lambda chunk: chunk['max_time'], reverse=True)
+        cutoff = None
+        for chunk in newest_first:
+            if cutoff is not None and chunk['max_time'] < cutoff:
+                # Every remaining chunk is older than the n-th newest uplink found so far
+                break
+            records = self._rows(chunk, device, None, end_us, last=n)
+            found.append(records)
+            times = np.concatenate([part['time'] for part in found])
+            if len(times) >= n:
+                cutoff = np.partition(times, len(times) - n)[len(times) - n]
+        table = self._table(found)
+        return table[len(table) - n:] if len(table) > n else table
+
+    def aggregate(self, column='temperature', every='hour', how='mean', start=None, end=None, device=None,
+                  utc_offset=0):
+        # [(bucket start, value)] of a column per time bucket (minute, hour, day, week or seconds), by sent time.
+        # utc_offset (seconds) aligns the buckets to local days/hours.
+        if how not in AGGREGATES:
+            raise ValueError('Unknown aggregate {}, expected one of {}'.format(how, AGGREGATES))
+        table = self.range(start, end, device)
+        values = table[column]
+        keep = values != MISSING[column] if column in MISSING else np.ones(len(values), dtype=bool)
+        buckets, inverse = self._buckets(table['time'][keep], every, utc_offset)
+        values = values[keep].astype(np.float64)
+        counts = np.bincount(inverse, minlength=len(buckets))
+        if how == 'count':
+            result = counts
+        elif how in ('mean', 'sum'):
+            result = np.bincount(inverse, weights=values, minlength=len(buckets))
+            if how == 'mean':
+                result = result / counts
+        else:
+            result = np.full(len(buckets), np.inf if how == 'min' else -np.inf)
+            (np.minimum if how == 'min' else np.maximum).at(result, inverse, values)
+        return [(bucket, value.item()) for bucket, value in zip(self._bucket_times(buckets, every, utc_offset),
+                                                                result)]
+
+    def events(self, kind='fridge', every='day', start=None, end=None, device=None, utc_offset=0):
+        # [(bucket start, count)] of distinct fridge openings or PIR triggers, bucketed by when they happened.
+        # Each event is reported by every uplink until the next one, so it is counted once per device.
+        table = self.range(start, end, device)
+        times = table[EVENTS[kind]]
+        keep = times != NO_TIME
+        # The event time moves with each uplink's sub-second timing, so events are rounded to the minute as they are
+        # for Graphite (GraphiteSchema.round_minute), and counted the same. Distinct (device, event minute) pairs are
+        # packed into one int64 so they can be de-duplicated in one pass.
+        events = np.unique(table['device'][keep].astype(np.int64) << 40 | round_minute(times[keep] // 1000000))
+        buckets, inverse = self._buckets((events & (1 << 40) - 1) * 1000000, every, utc_offset)
+        counts = np.bincount(inverse, minlength=len(buckets))
+        return [(bucket, count.item()) for bucket, count in zip(self._bucket_times(buckets, every, utc_offset),
+                                                                counts)]
+
+    def _chunks(self, start_us, end_us):
+        for chunk in self.store.chunks:
+            if chunk['count'] == 0:
+                continue
+            if start_us is not None and chunk['max_time'] < start_us:
+                continue
+            if end_us is not None and chunk['min_time'] >= end_us:
+                continue
+            yield chunk
+
+    def _rows(self, chunk, device, start_us, end_us, last=None):
+        # The chunk's records for the device (or every device) in [start, end), sorted by time
+        records = self._map(chunk)
+        if device is None:
+            # Every device: whole chunks are taken as they are, and only chunks straddling a bound are filtered
+            if (start_us is None or chunk['min_time'] >= start_us) and (end_us is None or chunk['max_time'] < end_us):
+                records = np.array(records)
+            else:
+                times = records['time']
+                mask = np.ones(len(records), dtype=bool)
+                if start_us is not None:
+                    mask &= times >= start_us
+                if end_us is not None:
+                    mask &= times < end_us
+                records = records[mask]
+            if last is not None and len(records) > last:
+                records = records[np.argpartition(records['time'], len(records) - last)[len(records) - last:]]
+            if np.any(records['time'][1:] < records['time'][:-1]):
+                records = records[np.argsort(records['time'], kind='stable')]
+            return records
+        number = self.store.device_index.get(device)
+        if number is None:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        index = self.index(chunk)
+        lo = np.searchsorted(index['device'], number, 'left')
+        hi = np.searchsorted(index['device'], number, 'right')
+        times = index['time'][lo:hi]
+        first = lo + (0 if start_us is None else np.searchsorted(times, start_us, 'left'))
+        stop = lo + (len(times) if end_us is None else np.searchsorted(times, end_us, 'left'))
+        if last is not None:
+            first = max(first, stop - last)
+        # Gathered in file order, then put back into the index's time order
+        rows = index['row'][first:stop]
+        order = np.argsort(rows)
+        gathered = np.empty(len(rows), dtype=RECORD_DTYPE)
+        gathered[order] = records[rows[order]]
+        return gathered
+
+    def index(self, chunk):
+        with self.lock:
+            cached = self.indexes.get(chunk['file'])
+            if cached is not None and cached[0] == chunk['count']:
+                return cached[1]
+            index_path = os.path.join(self.store.path, chunk['file'][:-len('.bin')] + '.idx.npy')
+            index = None
+            if os.path.isfile(index_path):
+                index = np.load(index_path, mmap_mode='r')
+                if len(index) != chunk['count']:
+                    index = None
+            if index is None:
+                records = self._map(chunk)
+                order = np.lexsort((records['time'], records['device']))
+                index = np.empty(len(records), dtype=INDEX_DTYPE)
+                index['device'] = records['device'][order]
+                index['time'] = records['time'][order]
+                index['row'] = order
+                if chunk is not self.store.chunks[-1]:
+                    # Full chunks don't change again, so their index is kept
+                    try:
+                        np.save(index_path, index)
+                    except OSError as e:
+                        logger.warning('Could not save the index of %s: %s', chunk['file'], e)
+            self.indexes[chunk['file']] = (chunk['count'], index)
+            return index
+
+    def _map(self, chunk):
+        return np.memmap(os.path.join(self.store.path, chunk['file']), dtype=RECORD_DTYPE, mode='r',
+                         shape=(chunk['count'],))
+
+    def _table(self, parts):
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return KitchenTable.empty()
+        records = np.concatenate(parts)
+        # Chunks are usually in time order already, unless e.g. old history was imported after newer uplinks
+        if any(earlier['time'][-1] > later['time'][0] for earlier, later in zip(parts, parts[1:])):
+            records = records[np.argsort(records['time'], kind='stable')]
+        return KitchenTable({name: records[name] for name in COLUMNS}, self.store.devices)
+
+    @staticmethod
+    def _buckets(times_us, every, utc_offset):
+        # Bucket numbers present, and each time's position among them
+        seconds = BUCKETS.get(every, every)
+        return np.unique((times_us // 1000000 + utc_offset) // int(seconds), return_inverse=True)
+
+    @staticmethod
+    def _bucket_times(buckets, every, utc_offset):
+        seconds = int(BUCKETS.get(every, every))
+        return [EPOCH + timedelta(seconds=bucket * seconds - utc_offset) for bucket in buckets.tolist()]
+
+
+def bounds(start, end):
+    return (None if start is None else to_epoch_us(start)), (None if end is None else to_epoch_us(end))
+
+
+def write_csv(table: KitchenTable, out):
+    # Same layout as SensorStore.export_csv
+    writer = csv.writer(out)
+    writer.writerow(CSV_HEADINGS)
+    for payload in table:
+        writer.writerow([payload.time, payload.received_time, payload.rssi, payload.snr, payload.data_rate_raw,
+                         payload.temperature, payload.humidity, payload.ldr, payload.sec_since_pir,
+                         payload.PIR_triggered_time, payload.sec_since_fridge, payload.fridge_opened_time,
+                         payload.payload_size, payload.device_id])
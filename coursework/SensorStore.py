@@ -0,0 +1,251 @@
+import csv
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from coursework.KitchenSensor import KitchenSensorParser, KitchenData, parse_data_rate
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_US = timedelta(microseconds=1)
+# Stored in place of a missing timestamp / counter (e.g. no PIR activity reported in the payload)
+NO_TIME = -2 ** 63
+NO_COUNT = -1
+
+FORMAT_VERSION = 2
+# One fixed-width record per uplink. Timestamps are int64 microseconds since the epoch (UTC).
+#   time, received_time, PIR_triggered_time, fridge_opened_time, sec_since_pir, sec_since_fridge, snr, temperature,
+#   rssi, humidity, ldr, payload_size, spreading factor, bandwidth (kHz), device (index into the store's devices)
+RECORD = struct.Struct('<qqqqiiffhHHHBxHH')
+FIELDS = ('time', 'received_time', 'PIR_triggered_time', 'fridge_opened_time', 'sec_since_pir', 'sec_since_fridge',
+          'snr', 'temperature', 'rssi', 'humidity', 'ldr', 'payload_size', 'spreading_factor', 'bandwidth', 'device')
+CSV_HEADINGS = ['sent_time', 'received_time', 'rssi', 'snr', 'data_rate', 'temperature', 'humidity', 'ldr',
+                'sec_since_pir', 'PIR_triggered_time', 'sec_since_fridge', 'fridge_opened_time', 'payload_size',
+                'device_id']
+
+
+def to_epoch_us(date_time):
+    if date_time is None:
+        return NO_TIME
+    if date_time.tzinfo is None:
+        date_time = date_time.astimezone()
+    return (date_time - EPOCH) // ONE_US
+
+
+def from_epoch_us(value):
+    if value == NO_TIME:
+        return None
+    return EPOCH + timedelta(microseconds=value)
+
+
+def pack(payload: KitchenData, device):
+    spreading_factor, bandwidth = parse_data_rate(payload.data_rate_raw) if payload.data_rate_raw else \
+        (payload.data_rate, 0)
+    return RECORD.pack(to_epoch_us(payload.time),
+                       to_epoch_us(payload.received_time),
+                       to_epoch_us(payload.PIR_triggered_time),
+                       to_epoch_us(payload.fridge_opened_time),
+                       NO_COUNT if payload.sec_since_pir is None else payload.sec_since_pir,
+                       NO_COUNT if payload.sec_since_fridge is None else payload.sec_since_fridge,
+                       payload.snr,
+                       payload.temperature,
+                       payload.rssi,
+                       payload.humidity,
+                       payload.ldr,
+                       int(payload.payload_size or 0),
+                       spreading_factor,
+                       bandwidth,
+                       device)
+
+
+def unpack(record, devices) -> KitchenData:
+    (sent, received, pir_time, fridge_time, sec_since_pir, sec_since_fridge, snr, temperature, rssi, humidity, ldr,
+     payload_size, spreading_factor, bandwidth, device) = record
+    data_rate_raw = 'SF{}BW{}'.format(spreading_factor, bandwidth) if bandwidth else str(spreading_factor)
+    return KitchenData(from_epoch_us(sent), from_epoch_us(received), rssi, round(snr, 2), data_rate_raw,
+                       spreading_factor, round(temperature, 2), humidity, ldr,
+                       None if sec_since_pir == NO_COUNT else sec_since_pir, from_epoch_us(pir_time),
+                       None if sec_since_fridge == NO_COUNT else sec_since_fridge, from_epoch_us(fridge_time),
+                       payload_size, devices[device])
+
+
+class SensorStore:
+    # Append-only store of KitchenData, written as fixed-width binary records into fixed-size chunk files.
+    # index.json records each chunk's record count and time range, so reads only map the chunks they need.
+    # Readers in other processes open it read_only, which leaves the live writer's last chunk untouched.
+
+    def __init__(self, path, chunk_records=65536, fsync_interval=5.0, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.chunk_records = chunk_records
+        self.fsync_interval = fsync_interval
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_fsync = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+        self.chunks = []
+        # Device IDs are stored once here and referenced by index from each record. 0 is an unknown device.
+        self.devices = [None]
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            if index['version'] != FORMAT_VERSION or index['record_size'] != RECORD.size:
+                raise ValueError('{} was written by an incompatible SensorStore version'.format(path))
+            self.chunks = index['chunks']
+            self.devices = index['devices']
+        self.device_index = {device: i for i, device in enumerate(self.devices)}
+        if self.chunks:
+            self._recover(self.chunks[-1])
+
+    def append(self, payload: KitchenData):
+        if self.read_only:
+            raise ValueError('{} was opened read only'.format(self.path))
+        sent = to_epoch_us(payload.time)
+        with self.lock:
+            device = self.device_index.get(payload.device_id)
+            if device is None:
+                device = self.device_index[payload.device_id] = len(self.devices)
+                self.devices.append(payload.device_id)
+                self._write_index()
+            record = pack(payload, device)
+            if not self.chunks or self.chunks[-1]['count'] >= self.chunk_records:
+                self._roll()
+            chunk = self.chunks[-1]
+            self.file.write(record)
+            chunk['count'] += 1
+            chunk['min_time'] = sent if chunk['min_time'] is None else min(chunk['min_time'], sent)
+            chunk['max_time'] = sent if chunk['max_time'] is None else max(chunk['max_time'], sent)
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+
+    def flush(self):
+        # Make appended records visible to readers, without the cost of an fsync
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.chunks)
+
+    def chunks_between(self, start=None, end=None):
+        # Chunks whose [min_time, max_time] overlaps the requested range. start/end are datetimes, end exclusive.
+        start_us = None if start is None else to_epoch_us(start)
+        end_us = None if end is None else to_epoch_us(end)
+        for chunk in self.chunks:
+            if chunk['count'] == 0:
+                continue
+            if start_us is not None and chunk['max_time'] < start_us:
+                continue
+            if end_us is not None and chunk['min_time'] >= end_us:
+                continue
+            yield chunk
+
+    def map_chunk(self, chunk):
+        # Returns a read-only memory map over the chunk's complete records (None for an empty file)
+        size = chunk['count'] * RECORD.size
+        if size == 0:
+            return None
+        with open(os.path.join(self.path, chunk['file']), 'rb') as chunk_file:
+            return mmap.mmap(chunk_file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def records(self, start=None, end=None):
+        # Raw record tuples (see FIELDS), filtered to start <= time < end
+        self.flush()
+        start_us = None if start is None else to_epoch_us(start)
+        end_us = None if end is None else to_epoch_us(end)
+        for chunk in list(self.chunks_between(start, end)):
+            mapped = self.map_chunk(chunk)
+            if mapped is None:
+                continue
+            with mapped:
+                for record in RECORD.iter_unpack(mapped):
+                    if start_us is not None and record[0] < start_us:
+                        continue
+                    if end_us is not None and record[0] >= end_us:
+                        continue
+                    yield record
+
+    def scan(self, start=None, end=None):
+        for record in self.records(start, end):
+            yield unpack(record, self.devices)
+
+    def export_csv(self, csv_path, start=None, end=None):
+        # Writes the same layout as log_to_csv, so the output can still be replayed with parse_csv_row
+        with open(csv_path, 'w', encoding='utf-8', newline='') as sensor_file:
+            writer = csv.writer(sensor_file)
+            writer.writerow(CSV_HEADINGS)
+            for payload in self.scan(start, end):
+                writer.writerow([payload.time, payload.received_time, payload.rssi, payload.snr, payload.data_rate_raw,
+                                 payload.temperature, payload.humidity, payload.ldr, payload.sec_since_pir,
+                                 payload.PIR_triggered_time, payload.sec_since_fridge, payload.fridge_opened_time,
+                                 payload.payload_size, payload.device_id])
+
+    def import_csv(self, csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as past_data:
+            reader = csv.reader(past_data, delimiter=',')
+            next(reader)  # Skip first row containing headings
+            for row in reader:
+                self.append(KitchenSensorParser.parse_csv_row(row))
+        self.sync()
+
+    def _roll(self):
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+        chunk = {'file': 'chunk-{:06d}.bin'.format(len(self.chunks)), 'count': 0, 'min_time': None, 'max_time': None}
+        self.chunks.append(chunk)
+        self.file = open(os.path.join(self.path, chunk['file']), 'ab')
+        self._write_index()
+
+    def _sync(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._write_index()
+        self.last_fsync = time.monotonic()
+
+    def _write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'version': FORMAT_VERSION, 'record_size': RECORD.size, 'chunks': self.chunks,
+                       'devices': self.devices}, index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def _recover(self, chunk):
+        # The index is only rewritten on fsync, so the last chunk may hold more (or a partial) record than it says
+        chunk_path = os.path.join(self.path, chunk['file'])
+        size = os.path.getsize(chunk_path) if os.path.isfile(chunk_path) else 0
+        count = size // RECORD.size
+        if count * RECORD.size != size and not self.read_only:
+            with open(chunk_path, 'r+b') as chunk_file:
+                chunk_file.truncate(count * RECORD.size)
+        if count != chunk['count']:
+            chunk['count'] = count
+            times = [record[0] for record in self.records_in(chunk)]
+            chunk['min_time'] = min(times) if times else None
+            chunk['max_time'] = max(times) if times else None
+        if count < self.chunk_records and not self.read_only:
+            self.file = open(chunk_path, 'ab')
+
+    def records_in(self, chunk):
+        mapped = self.map_chunk(chunk)
+        if mapped is None:
+            return []
+        with mapped:
+            return list(RECORD.iter_unpack(mapped))
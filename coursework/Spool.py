@@ -0,0 +1,215 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+# Each record is one write() of Graphite points: payload length and CRC32, then the points joined by newlines
+RECORD_HEADER = struct.Struct('<II')
+# Acknowledged position: segment number and offset within it. Everything before it has been sent.
+ACK = struct.Struct('<QQ')
+SEGMENT_SUFFIX = '.wal'
+
+
+class Spool:
+    # Durable write-ahead spool of Graphite points waiting to be sent: a directory of append-only segment files of
+    # CRC-checked records, and an acknowledged position. Points are read back from the acknowledged position,
+    # and once a POST succeeds the position moves past them and fully-sent segments are deleted.
+    # Delivery is at least once: after a crash, points sent since the last acknowledgement are sent again
+    # (Graphite keeps one value per series and timestamp, so resending is harmless).
+
+    def __init__(self, path, segment_bytes=4 * 1024 * 1024, max_bytes=1024 * 1024 * 1024, fsync_interval=5.0):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.ack_path = os.path.join(path, 'ack')
+        self.lock = threading.Lock()
+        self.last_fsync = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+        self.ack_segment, self.ack_offset = 0, 0
+        if os.path.isfile(self.ack_path):
+            with open(self.ack_path, 'rb') as ack_file:
+                self.ack_segment, self.ack_offset = ACK.unpack(ack_file.read(ACK.size))
+
+        # Metrics
+        self.dropped = 0
+        self.corrupt = 0
+
+        # segment number -> (end offset, number of unacknowledged points)
+        self.segments = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = int(name[:-len(SEGMENT_SUFFIX)])
+                if segment < self.ack_segment:
+                    os.remove(self._segment_path(segment))
+                else:
+                    self.segments[segment] = self._recover(segment)
+        self.head = max(self.segments, default=self.ack_segment)
+        self.file = open(self._segment_path(self.head), 'ab')
+        self.segments.setdefault(self.head, (0, 0))
+
+    def append(self, points):
+        if not points:
+            return
+        payload = '\n'.join(points).encode('utf-8')
+        with self.lock:
+            if self.file.tell() >= self.segment_bytes:
+                self._roll()
+            self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            # Visible to the reader straight away, durable on the next fsync
+            self.file.flush()
+            self.segments[self.head] = (self.file.tell(), self.segments[self.head][1] + len(points))
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+            self._enforce_limit()
+
+    def read(self, max_points, after=None):
+        # (points, position) from the acknowledged position, or from the position of an earlier read to read ahead:
+        # whole records, stopping once max_points or more have been read. Pass the position to ack() once the
+        # points have been sent.
+        with self.lock:
+            segment, offset = (self.ack_segment, self.ack_offset) if after is None else after[:2]
+            head = self.head
+        points = []
+        while len(points) < max_points and segment <= head:
+            if not os.path.isfile(self._segment_path(segment)):
+                segment, offset = segment + 1, 0
+                continue
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                segment_file.seek(offset)
+                while len(points) < max_points:
+                    record = read_record(segment_file)
+                    if record is None:
+                        break
+                    points.extend(record.decode('utf-8').split('\n'))
+                    offset = segment_file.tell()
+            if len(points) < max_points and segment < head:
+                segment, offset = segment + 1, 0
+            else:
+                break
+        return points, (segment, offset, len(points))
+
+    def ack(self, position):
+        segment, offset, count = position
+        with self.lock:
+            if (segment, offset) <= (self.ack_segment, self.ack_offset):
+                # Already acknowledged, or dropped by the size limit while the points were being sent
+                return
+            remaining = count
+            for acked in sorted(self.segments):
+                if acked > segment or not remaining:
+                    break
+                end, points = self.segments[acked]
+                taken = min(points, remaining)
+                self.segments[acked] = (end, points - taken)
+                remaining -= taken
+            self.ack_segment, self.ack_offset = segment, offset
+            self._write_ack()
+            # Compaction: segments wholly before the acknowledged position are deleted
+            for acked in [acked for acked in self.segments if acked < segment]:
+                self._remove(acked)
+
+    def pending(self):
+        with self.lock:
+            return sum(points for _, points in self.segments.values())
+
+    def size(self):
+        # Bytes of unacknowledged records
+        with self.lock:
+            return self._size() - (self.ack_offset if self.ack_segment in self.segments else 0)
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': self._size() - (self.ack_offset if self.ack_segment in self.segments else 0),
+                'pending': sum(points for _, points in self.segments.values()),
+                'dropped': self.dropped,
+                'corrupt': self.corrupt,
+            }
+
+    def _size(self):
+        return sum(end for end, _ in self.segments.values())
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '{:016d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def _roll(self):
+        self._sync()
+        self.file.close()
+        self.head += 1
+        self.file = open(self._segment_path(self.head), 'ab')
+        self.segments[self.head] = (0, 0)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def _write_ack(self):
+        # Replaced atomically, so a crash leaves either the old or the new position
+        tmp_path = self.ack_path + '.tmp'
+        with open(tmp_path, 'wb') as ack_file:
+            ack_file.write(ACK.pack(self.ack_segment, self.ack_offset))
+        os.replace(tmp_path, self.ack_path)
+
+    def _remove(self, segment):
+        del self.segments[segment]
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def _enforce_limit(self):
+        # Bound disk use during very long outages by dropping the oldest segments, as the in-memory buffer does
+        while len(self.segments) > 1 and self._size() > self.max_bytes:
+            oldest = min(self.segments)
+            self.dropped += self.segments[oldest][1]
+            self._remove(oldest)
+            self.ack_segment, self.ack_offset = oldest + 1, 0
+            self._write_ack()
+
+    def _recover(self, segment):
+        # Count the unacknowledged records, and cut the segment at the first torn or corrupt record, e.g. the
+        # last write before a crash. Returns (end offset, points after the acknowledged position).
+        start = self.ack_offset if segment == self.ack_segment else 0
+        points = 0
+        with open(self._segment_path(segment), 'r+b') as segment_file:
+            segment_file.seek(start)
+            while True:
+                offset = segment_file.tell()
+                record = read_record(segment_file)
+                if record is None:
+                    break
+                points += record.count(b'\n') + 1
+            end = segment_file.seek(0, os.SEEK_END)
+            if offset < end:
+                self.corrupt += 1
+                logger.warning('Spool segment %s truncated from %s to %s bytes', segment, end, offset)
+                segment_file.truncate(offset)
+        return offset, points
+
+
+def read_record(segment_file):
+    # The next record's payload, or None at the end of the segment or a torn or corrupt record
+    header = segment_file.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    length, crc = RECORD_HEADER.unpack(header)
+    payload = segment_file.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return payload
@@ -0,0 +1,117 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+
+def run_worker(config, shard, shards, status, report_interval, runtime='threads'):
+    # Entry point of each worker process: a full CourseworkClient (decode pipeline and sinks) for one shard
+    if runtime == 'asyncio':
+        from coursework.AsyncCourseworkClient import AsyncCourseworkClient as CourseworkClient
+    else:
+        from coursework.CourseworkClient import CourseworkClient
+    from coursework.Instrumentation import configure_logging
+    configure_logging(config)
+    client = CourseworkClient(config, shard=shard, shards=shards, run=False)
+
+    def report():
+        while True:
+            status.put((shard, time.time(), client.metrics()))
+            time.sleep(report_interval)
+
+    threading.Thread(target=report, name='worker-status', daemon=True).start()
+    client.run()
+
+
+class Supervisor:
+    # Runs one CourseworkClient per worker process, each subscribed through an MQTT shared subscription or
+    # handling the devices that hash to its shard. Aggregates their health and throughput counters, and restarts
+    # workers that exit or stop reporting.
+
+    def __init__(self, config, workers, report_interval=10, runtime='threads'):
+        self.config = config
+        self.workers = workers
+        self.runtime = runtime
+        self.report_interval = report_interval
+        self.context = multiprocessing.get_context('spawn')
+        self.status = self.context.Queue()
+        self.processes = {}
+        self.latest = {}  # shard -> (report time, metrics)
+        self.restarts = 0
+        self.retired_received = 0  # Messages handled by workers that have since been restarted
+        self.stopping = threading.Event()
+
+    def start(self):
+        for shard in range(self.workers):
+            self._start_worker(shard)
+
+    def stop(self):
+        self.stopping.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+    def run(self):
+        self.start()
+        last_total, last_time = 0, time.monotonic()
+        try:
+            while not self.stopping.is_set():
+                deadline = time.monotonic() + self.report_interval
+                while time.monotonic() < deadline:
+                    try:
+                        shard, reported, metrics = self.status.get(timeout=max(0.0, deadline - time.monotonic()))
+                        self.latest[shard] = (reported, metrics)
+                    except queue.Empty:
+                        break
+                self.check_health()
+                totals = self.totals()
+                now = time.monotonic()
+                rate = (totals['received'] - last_total) / (now - last_time)
+                last_total, last_time = totals['received'], now
+                print('Supervisor: {} workers healthy, {:.1f} msg/s, totals {}'.format(
+                    totals['healthy'], rate, totals))
+        finally:
+            self.stop()
+
+    def check_health(self):
+        # Restart workers that died, or haven't reported for three intervals (e.g. wedged on a dead connection)
+        now = time.time()
+        for shard, process in list(self.processes.items()):
+            reported = self.latest.get(shard, (None,))[0]
+            stale = reported is not None and now - reported > 3 * self.report_interval
+            if not process.is_alive() or stale:
+                print('Supervisor: worker {} (pid {}) {}, restarting'.format(
+                    shard, process.pid, 'stopped reporting' if process.is_alive() else 'exited'))
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                if shard in self.latest:
+                    self.retired_received += self.latest.pop(shard)[1]['received']
+                self.restarts += 1
+                self._start_worker(shard)
+
+    def totals(self):
+        totals = {'healthy': 0, 'received': self.retired_received, 'skipped': 0, 'restarts': self.restarts,
+                  'graphite_sent': 0, 'graphite_pending': 0, 'graphite_dropped': 0, 'stage_errors': 0,
+                  'stage_dropped': 0}
+        for shard, (reported, metrics) in self.latest.items():
+            if self.processes[shard].is_alive():
+                totals['healthy'] += 1
+            totals['received'] += metrics['received']
+            totals['skipped'] += metrics['skipped']
+            totals['graphite_sent'] += metrics['graphite']['sent']
+            totals['graphite_pending'] += metrics['graphite']['pending']
+            totals['graphite_dropped'] += metrics['graphite']['dropped']
+            for stage in metrics['pipeline'].values():
+                totals['stage_errors'] += stage['errors']
+                totals['stage_dropped'] += stage['dropped']
+        return totals
+
+    def _start_worker(self, shard):
+        process = self.context.Process(target=run_worker, name='kitcheniot-worker-{}'.format(shard),
+                                       args=(self.config, shard, self.workers, self.status, self.report_interval,
+                                             self.runtime),
+                                       daemon=True)
+        process.start()
+        self.processes[shard] = process
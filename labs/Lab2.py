@@ -1,16 +1,17 @@
 from paho.mqtt.client import Client
 import uuid
 import json
-import yaml
 import os
 import base64
+from coursework.Codecs import DEFAULT_CODECS, UndecodablePayload
+from coursework.Config import TTN_REQUIRED, load_config
 
 
 class Lab2:
     def __init__(self):
-        with open(os.path.join('labs', r'Lab2_Mqtt_Secrets.yaml')) as configuration:
-            config = yaml.load(configuration, Loader=yaml.FullLoader)
-            print(config)
+        config = load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Lab2_Mqtt_Secrets.yaml'),
+                             required=TTN_REQUIRED)
+        print(config)
 
         client = Client(client_id=str(uuid.getnode()), clean_session=False)
         client.username_pw_set(username=config['TTN_MQTT_USER'], password=config['TTN_MQTT_PASS'])
@@ -37,4 +38,9 @@ class Lab2:
         print('message:', message.payload)
         payload_dict = json.loads(message.payload)
         print(payload_dict)
-        print("Decoded payload:", base64.b64decode(payload_dict['payload_raw']))
+        payload_raw = base64.b64decode(payload_dict['payload_raw'])
+        try:
+            print("Decoded payload:", DEFAULT_CODECS.decode(payload_dict.get('dev_id'), payload_dict.get('port'),
+                                                            payload_raw))
+        except UndecodablePayload:
+            print("Decoded payload:", payload_raw)
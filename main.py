@@ -1,22 +1,182 @@
 import click
-from labs import Lab2
-from coursework import CourseworkClient
 
+# Each command imports what it needs when it runs, so --help and startup don't pay for paho, requests, protobuf and
+# numpy. benchmarks/bench_startup.py tracks the cost.
 
-@click.command()
-@click.option("--coursework", is_flag=True, help="Launch the CourseworkClient MQTT code")
-@click.option("--lab", required=False, type=int, help="Which lab's MQTT code to run [2]")
-def start_IoT_lab(coursework, lab):
 
+@click.group(invoke_without_command=True)
+@click.option("--coursework", is_flag=True, help="Launch the CourseworkClient MQTT code (same as the coursework command)")
+@click.option("--lab", required=False, type=int, help="Which lab's MQTT code to run [2] (same as the lab command)")
+@click.option("--config", required=False, type=click.Path(exists=True, dir_okay=False), envvar='KITCHENIOT_CONFIG',
+              help="Coursework config file [coursework/CW_Mqtt_Secrets.yaml]. Any setting can also be overridden "
+                   "with KITCHENIOT_<KEY> or KITCHENIOT_<SECTION>__<KEY> environment variables")
+@click.pass_context
+def start_IoT_lab(context, coursework, lab, config):
+    context.obj = {'config': config}
+    if context.invoked_subcommand:
+        return
     if coursework:
-        print("Launching CourseworkClient")
-        CourseworkClient.CourseworkClient()
+        context.invoke(run_coursework)
+    elif lab:
+        context.invoke(run_lab, number=lab)
+    else:
+        raise click.UsageError("Either --coursework, --lab [lab no.] or a command must be given.")
 
-    if lab == 2:
-        print("Launching Lab 2")
-        Lab2.Lab2()
 
-    raise ValueError("Either --coursework or --lab [lab no.] must be set.")
+def load_config(context):
+    from coursework.Config import ConfigError, load_config
+    try:
+        return load_config(context.obj['config'])
+    except ConfigError as e:
+        raise click.ClickException(str(e))
+
+
+@start_IoT_lab.command('coursework')
+@click.option("--shards", default=1, show_default=True,
+              help="Run the CourseworkClient as this many worker processes, each handling a share of the devices")
+@click.option("--runtime", default="threads", show_default=True, type=click.Choice(['threads', 'asyncio']),
+              help="Run the CourseworkClient on worker threads, or as tasks on one asyncio event loop (needs aiohttp)")
+@click.pass_context
+def run_coursework(context, shards=1, runtime='threads'):
+    """Ingest uplinks from TTN into Graphite and the SensorStore."""
+    config = load_config(context)
+    if shards > 1:
+        from coursework.Supervisor import Supervisor
+        print("Launching {} CourseworkClient workers".format(shards))
+        Supervisor(config, shards, runtime=runtime).run()
+        return
+
+    from coursework.Instrumentation import configure_logging
+    print("Launching CourseworkClient")
+    configure_logging(config)
+    if runtime == 'asyncio':
+        from coursework.AsyncCourseworkClient import AsyncCourseworkClient
+        AsyncCourseworkClient(config)
+    else:
+        from coursework.CourseworkClient import CourseworkClient
+        CourseworkClient(config)
+
+
+@start_IoT_lab.command('lab')
+@click.argument("number", type=int)
+def run_lab(number):
+    """Run a lab's MQTT code [2]."""
+    if number != 2:
+        raise click.BadParameter("Only lab 2 has MQTT code", param_hint="NUMBER")
+    from labs import Lab2
+    print("Launching Lab 2")
+    Lab2.Lab2()
+
+
+@start_IoT_lab.command('replay')
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--rate", default=500.0, show_default=True, help="Replay rate limit in Graphite points/sec")
+@click.option("--start", required=False, help="Only replay uplinks sent at or after this time (ISO-8601)")
+@click.option("--end", required=False, help="Only replay uplinks sent before this time (ISO-8601)")
+@click.option("--workers", required=False, type=int, help="Number of replay parser processes [CPU count]")
+@click.option("--checkpoint", required=False, type=click.Path(),
+              help="File to record replay progress in, so an interrupted replay can resume")
+@click.pass_context
+def run_replay(context, path, rate, start, end, workers, checkpoint):
+    """Backfill Graphite from a saved sensor_data.csv or SensorStore directory."""
+    from dateutil import parser
+    from coursework.CourseworkClient import activity_store, graphite_writer
+    from coursework.GraphiteSchema import MetricSchema
+    from coursework.Replay import Replayer
+    print("Replaying", path)
+    config = load_config(context)
+    # The replay checkpoint tracks what has been sent, so the replay doesn't go through the live client's spool
+    writer = graphite_writer(config, background=False, spooled=False)
+    # Shares the live client's activity state, so fridge/PIR events that were already sent aren't sent again
+    activity = activity_store(config)
+    schema = MetricSchema.from_config(config)
+    Replayer(writer, schema, activity, rate=rate, workers=workers,
+             checkpoint_path=checkpoint).replay(path, start=start and parser.parse(start),
+                                                end=end and parser.parse(end))
+    writer.close()
+    activity.close()
+
+
+def query_interval(context, param, value):
+    # --every: a bucket name, or a positive number of seconds
+    if value is None or value in ('minute', 'hour', 'day', 'week'):
+        return value
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise click.BadParameter('expected minute, hour, day, week or a positive number of seconds, got {!r}'.format(value))
+
+
+@start_IoT_lab.command('query')
+@click.argument("path", type=click.Path(exists=True, file_okay=False))
+@click.option("--start", required=False, help="Only query uplinks sent at or after this time (ISO-8601)")
+@click.option("--end", required=False, help="Only query uplinks sent before this time (ISO-8601)")
+@click.option("--device", required=False, help="Only query this device's uplinks")
+@click.option("--last", required=False, type=int, help="Query the most recent N uplinks")
+@click.option("--every", required=False, callback=query_interval,
+              help="Aggregate the query per minute, hour, day, week or number of seconds")
+@click.option("--column", default="temperature", show_default=True, help="Column to aggregate",
+              type=click.Choice(['temperature', 'humidity', 'ldr', 'rssi', 'snr', 'spreading_factor', 'bandwidth',
+                                 'sec_since_pir', 'sec_since_fridge', 'payload_size']))
+@click.option("--how", default="mean", show_default=True, type=click.Choice(['mean', 'min', 'max', 'sum', 'count']))
+@click.option("--events", required=False, type=click.Choice(['fridge', 'pir']),
+              help="Count distinct fridge openings or PIR triggers per --every (default day)")
+def run_query(path, start, end, device, last, every, column, how, events):
+    """Query the uplink history in a SensorStore directory, printed as CSV."""
+    import sys
+    from dateutil import parser
+    from coursework.SensorQuery import SensorQuery, write_csv
+    from coursework.SensorStore import SensorStore
+    store = SensorStore(path, read_only=True)
+    history = SensorQuery(store)
+    start, end = start and parser.parse(start), end and parser.parse(end)
+    if events:
+        results = history.events(events, every or 'day', start, end, device)
+    elif every:
+        results = history.aggregate(column, every, how, start, end, device)
+    else:
+        table = history.last(last, device, end) if last else history.range(start, end, device)
+        write_csv(table, sys.stdout)
+        return
+    for bucket, value in results:
+        print('{},{:g}'.format(bucket.isoformat(), value))
+
+
+@start_IoT_lab.command('radio')
+@click.argument("path", type=click.Path(exists=True, file_okay=False))
+@click.option("--by", default="device", show_default=True, type=click.Choice(['device', 'gateway', 'link']),
+              help="Aggregate per device, per gateway or per device-gateway link")
+@click.option("--start", required=False, help="Only count uplinks sent at or after this time (ISO-8601)")
+@click.option("--end", required=False, help="Only count uplinks sent before this time (ISO-8601)")
+@click.option("--device", required=False, help="Only show this device")
+@click.option("--gateway", required=False, help="Only show this gateway")
+def run_radio(path, by, start, end, device, gateway):
+    """Link quality from a RadioLog directory: frame loss, RSSI/SNR, airtime and ADR hints, printed as CSV."""
+    import sys
+    from dateutil import parser
+    from coursework.RadioStats import RadioLog, write_csv, DEVICE_HEADINGS, GATEWAY_HEADINGS, LINK_HEADINGS
+    stats = RadioLog(path, read_only=True).query(start and parser.parse(start), end and parser.parse(end))
+    if by == 'device':
+        write_csv(stats.device_table(device), DEVICE_HEADINGS, sys.stdout)
+    elif by == 'gateway':
+        write_csv(stats.gateway_table(gateway), GATEWAY_HEADINGS, sys.stdout)
+    else:
+        write_csv(stats.link_table(device, gateway), LINK_HEADINGS, sys.stdout)
+
+
+@start_IoT_lab.command('loadgen')
+@click.option("--devices", default=1000, show_default=True, help="Number of simulated devices")
+@click.option("--messages", default=50000, show_default=True, help="Number of uplinks to publish")
+@click.option("--uplinks-per-sec", default=0.0, show_default=True,
+              help="Publish rate, 0 for as fast as the client accepts them")
+@click.option("--runtime", default="threads", show_default=True, type=click.Choice(['threads', 'asyncio', 'both']),
+              help="Client runtime to load, or both one after the other")
+@click.option("--graphite-latency", default=0.0, show_default=True,
+              help="Seconds the Graphite stub takes to answer each POST")
+def run_loadgen(devices, messages, uplinks_per_sec, runtime, graphite_latency):
+    """Load test the CourseworkClient with synthetic uplinks, through an embedded broker and Graphite stub."""
+    from benchmarks.LoadGenerator import run_load, report
+    for name in ('threads', 'asyncio') if runtime == 'both' else (runtime,):
+        report(run_load(devices, messages, uplinks_per_sec, runtime=name, graphite_latency=graphite_latency))
 
 
 if __name__ == '__main__':